@@ -1,32 +1,154 @@
-from fastapi import APIRouter, UploadFile, File, Body
-from app.services.ingestion import save_uploaded_file, process_document
-from app.services.rag import rag_pipeline
-from app.services.database import get_supabase
+import json
+from typing import Optional
+from fastapi import APIRouter, UploadFile, File, Body, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from app.core import metrics
+from app.core.config import settings
+from app.core.deadline import from_milliseconds
+from app.core.executor import run_blocking
+from app.services.ingestion import save_uploaded_file_async
+from app.services import jobs
+from app.services.rag import rag_pipeline_async, rag_pipeline_stream, get_rerank_stats, normalize_filters
+from app.services.database import list_documents_async
+from app.services.embedding import get_query_embedding_stats, get_document_embedding_stats
+from app.services.answer_cache import answer_cache
+from app.services.llm_memo import llm_memo
+from app.services.bm25_service import bm25_service
+from app.services.vector_store import count_vectors
 
 router = APIRouter()
 
-@router.post("/upload")
+def _cache_lookups() -> dict:
+    queries = get_query_embedding_stats()
+    documents = get_document_embedding_stats()
+    answers = answer_cache.stats()
+    values = {
+        ("query_embedding", "hit"): queries["hits"],
+        ("query_embedding", "persistent_hit"): queries["persistent_hits"],
+        ("query_embedding", "miss"): queries["embedded"],
+        ("document_embedding", "duplicate"): documents["duplicates"],
+        ("document_embedding", "persistent_hit"): documents["persistent_hits"],
+        ("document_embedding", "miss"): documents["embedded"],
+        ("answer", "hit"): answers["hits"],
+        ("answer", "near_hit"): answers["near_hits"],
+        ("answer", "miss"): answers["misses"] - answers["near_hits"],
+    }
+    if llm_memo:
+        memo = llm_memo.stats()
+        for namespace, count in memo["hits"].items():
+            values[(f"llm_{namespace}", "hit")] = count
+        for namespace, count in memo["misses"].items():
+            values[(f"llm_{namespace}", "miss")] = count
+    return values
+
+def _rerank_decisions() -> dict:
+    stats = get_rerank_stats()
+    return {("local",): stats["local"], ("llm",): stats["llm"]}
+
+def _index_sizes() -> dict:
+    bm25 = bm25_service.index.stats()
+    sizes = {("bm25", stat): bm25[stat] for stat in ("documents", "vocabulary", "postings", "segments", "bytes")}
+    sizes[("vector", "documents")] = count_vectors()
+    return sizes
+
+# Service statistics exposed as metrics, read when /api/metrics is scraped
+metrics.Counter("nibrasse_cache_lookups_total", "Cache lookups by cache and result", ("cache", "result"), callback=_cache_lookups)
+metrics.Counter("nibrasse_rerank_total", "Re-ranking decisions (local only, or Gemini)", ("reranker",), callback=_rerank_decisions)
+metrics.Gauge("nibrasse_index_size", "Size of the search indexes", ("index", "stat"), callback=_index_sizes)
+
+@router.post("/upload", status_code=202)
 async def upload_file(file: UploadFile = File(...)):
-    file_path = save_uploaded_file(file)
-    result = process_document(file_path)
-    return {"message": "File processed successfully", "data": result}
+    """Saves the file and queues its ingestion; poll /api/jobs/{job_id} for progress."""
+    job_id = jobs.new_job_id()
+    file_path = await save_uploaded_file_async(file, job_id)
+    job = await jobs.submit(file_path, job_id)
+    return {"message": "File queued for processing", "job_id": job["id"], "status": job["status"]}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, stage, progress and timings of an ingestion job"""
+    job = await jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @router.get("/documents")
 async def get_documents():
     """Get list of all uploaded documents"""
-    supabase = get_supabase()
-    response = supabase.table("documents").select("*").order("upload_date", desc=True).execute()
-    return {"documents": response.data}
+    documents = await list_documents_async()
+    return {"documents": documents}
+
+@router.get("/stats")
+async def get_stats():
+    """Cache counters, to check how often external calls are skipped, and BM25 index size"""
+    return {
+        "query_embeddings": get_query_embedding_stats(),
+        "document_embeddings": get_document_embedding_stats(),
+        "answers": answer_cache.stats(),
+        "llm_memo": llm_memo.stats() if llm_memo else None,
+        "rerank": get_rerank_stats(),
+        "bm25": bm25_service.index.stats(),
+    }
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text format: stage latency histograms, cache/retry/fallback/token counters, index sizes"""
+    return PlainTextResponse(await run_blocking(metrics.render), media_type="text/plain; version=0.0.4")
 
 @router.post("/query")
-async def query_rag(query: str = Body(..., embed=True)):
+async def query_rag(query: str = Body(..., embed=True), filters: Optional[dict] = Body(None),
+                    debug: bool = Body(False), deadline_ms: Optional[float] = Body(None)):
+    """
+    filters optionally scopes the search, e.g. {"filename": ["a.txt"], "document_id": [3]}.
+    With debug, the response includes the timed spans of the request ("timings").
+    deadline_ms (default QUERY_DEADLINE_SECONDS) bounds the latency: optional stages are
+    cut short and listed in "degraded".
+    """
+    try:
+        filters = normalize_filters(filters)
+        deadline = from_milliseconds(deadline_ms, settings.QUERY_DEADLINE_SECONDS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         print(f"Received query: {query}")
-        result = rag_pipeline(query)
+        with metrics.trace() as trace, metrics.span("query"):
+            result = await rag_pipeline_async(query, filters, deadline)
+        if debug:
+            # Copy: the result dict is also held by the answer cache
+            result = {**result, "timings": trace.timings()}
         return result
     except Exception as e:
         print(f"❌ API Error: {str(e)}")
         import traceback
         traceback.print_exc()
-        from fastapi import HTTPException
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/query/stream")
+async def query_rag_stream(query: str = Body(..., embed=True), filters: Optional[dict] = Body(None),
+                           deadline_ms: Optional[float] = Body(None)):
+    """
+    Server-Sent Events: a `sources` event once retrieval is done, then `token`
+    events as the answer is generated, then `done` (or `error`).
+    Accepts the same filters as /query; deadline_ms bounds the time to the `sources` event.
+    """
+    try:
+        filters = normalize_filters(filters)
+        deadline = from_milliseconds(deadline_ms, settings.QUERY_DEADLINE_SECONDS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    print(f"Received streaming query: {query}")
+
+    async def events():
+        try:
+            async for event, data in rag_pipeline_stream(query, filters, deadline):
+                payload = data if isinstance(data, dict) else {"text": data}
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            print(f"❌ API Error: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -7,7 +7,63 @@ class Settings:
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
     SUPABASE_URL = os.getenv("VITE_SUPABASE_URL")
     SUPABASE_KEY = os.getenv("VITE_SUPABASE_ANON_KEY")
+    # Document/chunk records: "supabase", or "sqlite" for a local file (offline runs, benchmarks)
+    DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "supabase")
+    DATABASE_SQLITE_PATH = os.getenv("DATABASE_SQLITE_PATH", "data/nibrasse.sqlite3")
+    # Chunk rows per insert request, pooled HTTP connections, and seconds the document list is cached
+    DATABASE_PAGE_SIZE = int(os.getenv("DATABASE_PAGE_SIZE", "500"))
+    DATABASE_MAX_CONNECTIONS = int(os.getenv("DATABASE_MAX_CONNECTIONS", "10"))
+    DOCUMENT_LIST_CACHE_TTL = float(os.getenv("DOCUMENT_LIST_CACHE_TTL", "10"))
     GEMINI_CHAT_MODEL = os.getenv("VITE_GEMINI_CHAT_MODEL")
     GEMINI_EMBEDDING_MODEL = os.getenv("VITE_GEMINI_EMBEDDING_MODEL")
+    # Threads available to async handlers for blocking Gemini/Chroma/Supabase calls (per uvicorn worker)
+    BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "32"))
+    # Query embedding cache: in-process LRU size, and SQLite file for the persistent layer ("" disables it)
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite3")
+    # Answer cache: entries, TTL in seconds, and cosine threshold for near-duplicate queries (0 disables, e.g. 0.97)
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+    # Memo of query-expansion and re-ranking completions ("" disables it); TTL in seconds
+    LLM_MEMO_PATH = os.getenv("LLM_MEMO_PATH", "data/llm_memo.sqlite3")
+    LLM_MEMO_MAX_ENTRIES = int(os.getenv("LLM_MEMO_MAX_ENTRIES", "20000"))
+    LLM_MEMO_TTL = float(os.getenv("LLM_MEMO_TTL", str(7 * 24 * 3600)))
+    # Gemini re-ranking is skipped when the local ranking margin reaches this value (> 1 always calls Gemini)
+    LOCAL_RERANK_CONFIDENCE = float(os.getenv("LOCAL_RERANK_CONFIDENCE", "0.1"))
+    # Query latency budget in seconds (0 = none, /query can set deadline_ms); shares of it by which
+    # retrieval (with query expansion) and re-ranking must be done, and the least time worth a Gemini re-ranking
+    QUERY_DEADLINE_SECONDS = float(os.getenv("QUERY_DEADLINE_SECONDS", "0"))
+    DEADLINE_RETRIEVAL_SHARE = float(os.getenv("DEADLINE_RETRIEVAL_SHARE", "0.4"))
+    DEADLINE_RERANK_SHARE = float(os.getenv("DEADLINE_RERANK_SHARE", "0.6"))
+    DEADLINE_MIN_RERANK_SECONDS = float(os.getenv("DEADLINE_MIN_RERANK_SECONDS", "1.0"))
+    # Estimated tokens of retrieved context in the answer prompt, after merging overlapping chunks (0 = no limit)
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+    # BM25 text analysis: light stemming and stop-word removal (changing them re-tokenizes the index)
+    BM25_STEMMING = os.getenv("BM25_STEMMING", "true").lower() == "true"
+    BM25_STOP_WORDS = os.getenv("BM25_STOP_WORDS", "true").lower() == "true"
+    # Vector search backend: "chroma", or "matrix" for the in-process quantized index
+    # (storage directory, "float16" or "int8", and exact re-scoring of the shortlist)
+    VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+    VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "data/vector_index")
+    VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "int8")
+    VECTOR_INDEX_RESCORE = os.getenv("VECTOR_INDEX_RESCORE", "true").lower() == "true"
+    # Ingestion: characters read per window, chunks per write batch, embedded batches waiting to be written
+    INGEST_READ_WINDOW = int(os.getenv("INGEST_READ_WINDOW", "1000000"))
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "400"))
+    INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "2"))
+    # Background ingestion jobs: concurrent jobs per uvicorn worker, and the SQLite file holding their state
+    INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+    JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "data/jobs.sqlite3")
+    # Seconds between heartbeats of running jobs, and without one after which a job's worker is considered gone
+    INGEST_JOB_HEARTBEAT = float(os.getenv("INGEST_JOB_HEARTBEAT", "10"))
+    INGEST_JOB_STALE_AFTER = float(os.getenv("INGEST_JOB_STALE_AFTER", "60"))
+    # Document embedding requests: texts and characters per request, parallel requests,
+    # requests per minute (0 = unlimited) and retries on transient API errors
+    EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+    EMBED_BATCH_MAX_CHARS = int(os.getenv("EMBED_BATCH_MAX_CHARS", "100000"))
+    EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+    EMBED_REQUESTS_PER_MINUTE = float(os.getenv("EMBED_REQUESTS_PER_MINUTE", "1500"))
+    EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
 
 settings = Settings()
@@ -0,0 +1,56 @@
+"""
+Latency budget of a query, passed down to every stage of the RAG pipeline.
+
+Stages that are only there to improve the answer (query expansion, Gemini re-ranking,
+the answer cache lookup) get a share of the budget and are skipped, truncated or
+abandoned when they cannot finish within it. Each such stage is recorded in
+`degraded` ({stage: reason}) and counted in nibrasse_fallbacks_total.
+Abandoned blocking calls still run to completion on the executor; only their result
+is dropped (expansion and re-ranking results still reach the LLM memo).
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from app.core.metrics import FALLBACKS
+
+T = TypeVar("T")
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.seconds = seconds
+        self._clock = clock
+        self.started = clock()
+        self.degraded: Dict[str, str] = {}
+
+    def remaining(self, share: float = 1.0) -> float:
+        """Seconds left until the given share of the budget has elapsed (never negative)."""
+        return max(0.0, self.started + self.seconds * share - self._clock())
+
+    def degrade(self, stage: str, reason: str):
+        """Records a degraded stage; a later reason for the same stage replaces the earlier one."""
+        if stage not in self.degraded:
+            FALLBACKS.inc(stage=stage)
+        self.degraded[stage] = reason
+
+def from_milliseconds(milliseconds: Optional[float], default_seconds: float = 0) -> Optional[Deadline]:
+    """A deadline of `milliseconds`, else of default_seconds; None when neither is set."""
+    if milliseconds is not None:
+        if milliseconds <= 0:
+            raise ValueError("deadline_ms must be positive")
+        return Deadline(milliseconds / 1000)
+    return Deadline(default_seconds) if default_seconds > 0 else None
+
+async def within(awaitable: Awaitable[T], deadline: Optional[Deadline], share: float = 1.0) -> T:
+    """Awaits within the given share of the deadline; raises DeadlineExceeded past it."""
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining(share))
+    except asyncio.TimeoutError:
+        # A timeout raised by the awaited call itself, before the deadline, is not ours
+        if deadline.remaining(share) > 0:
+            raise
+        raise DeadlineExceeded(f"{deadline.seconds * share:.2f}s budget exceeded")
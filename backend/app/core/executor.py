@@ -0,0 +1,30 @@
+"""
+Dedicated executor for the blocking calls (Gemini, ChromaDB, Supabase, BM25)
+made from async request handlers.
+
+The pool is sized explicitly (BLOCKING_IO_WORKERS) so one uvicorn worker can
+keep many requests in flight without ever blocking its event loop.
+Index mutations (ChromaDB and BM25 writes) go through a single writer thread instead,
+so concurrent ingestion jobs never interleave their writes.
+Calls run in a copy of the caller's context, so request traces follow them (app/core/metrics.py).
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import settings
+
+_executor = ThreadPoolExecutor(max_workers=settings.BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+_index_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-writer")
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking function on the dedicated executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+async def run_index_write(func, *args, **kwargs):
+    """Runs an index mutation on the single writer thread, in submission order."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_index_writer, functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,174 @@
+"""
+In-process metrics and per-request tracing, rendered in the Prometheus text format.
+
+Counters, gauges and histograms are labelled and thread-safe. Metrics that already
+exist as service statistics (cache hits, index size) are registered with a callback
+read at scrape time instead of being counted twice.
+
+span(stage) times a block of code. It observes the `nibrasse_stage_seconds` histogram
+and, inside trace(), appends the span to the request's timing breakdown. The trace is
+held in a context variable, so spans from tasks and executor threads started by the
+request are included (see app/core/executor.py).
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry: List["Metric"] = []
+_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        """callback, if given, returns {label values: value} when metrics are rendered."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        values = self.callback() if self.callback else self._snapshot()
+        for key, value in values.items():
+            yield self.name, _labels(self.labels, key if isinstance(key, tuple) else (key,)), value
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, (counts, total) in self._snapshot().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labels + ("le",), key + (_number(bound),)), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, key), total
+            yield f"{self.name}_count", _labels(self.labels, key), cumulative
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(f"Metric {metric.name} failed: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("nibrasse_stage_seconds", "Latency of pipeline stages and external calls", ("stage",))
+STAGE_ERRORS = Counter("nibrasse_stage_errors_total", "Pipeline stages and external calls that raised", ("stage",))
+RETRIES = Counter("nibrasse_retries_total", "Retried external calls", ("service",))
+FALLBACKS = Counter("nibrasse_fallbacks_total", "Stages that fell back to a degraded result", ("stage",))
+LLM_TOKENS = Counter("nibrasse_llm_tokens_total", "Gemini tokens by purpose", ("purpose", "kind"))
+CONTEXT_TOKENS = Counter("nibrasse_answer_prompt_tokens_estimated_total",
+                         "Estimated answer prompt tokens before and after context assembly", ("kind",))
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []  # (stage, start, seconds)
+
+    def timings(self) -> List[dict]:
+        """Spans in start order, in milliseconds from the start of the request (parallel spans overlap)."""
+        return [
+            {"stage": stage, "start_ms": round((start - self.started) * 1000, 2), "ms": round(seconds * 1000, 2)}
+            for stage, start, seconds in sorted(self.spans, key=lambda s: s[1])
+        ]
+
+@contextmanager
+def trace() -> Iterator[Trace]:
+    """Collects the spans of the enclosed request."""
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        current = _trace.get()
+        if current is not None:
+            current.spans.append((stage, started, seconds))
+
+def record_llm_usage(purpose: str, response):
+    """Counts the prompt and output tokens reported by a Gemini response, when available."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, field, None)
+        if isinstance(count, (int, float)):
+            LLM_TOKENS.inc(count, purpose=purpose, kind=kind)
@@ -3,9 +3,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from app.api.routes import router as api_router
+from app.services import jobs
 
 app = FastAPI(title="NIBRASSE")
 
+@app.on_event("startup")
+async def start_ingestion_workers():
+    await jobs.start_workers()
+
+@app.on_event("shutdown")
+async def stop_ingestion_workers():
+    await jobs.stop_workers()
+
 # CORS Configuration
 app.add_middleware(
     CORSMiddleware,
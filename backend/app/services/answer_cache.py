@@ -0,0 +1,83 @@
+"""
+Response cache in front of rag_pipeline.
+
+Entries are keyed on the normalized query, expire after a TTL, are evicted
+LRU-first beyond a size bound, and are dropped as soon as the index
+generation changes (i.e. whenever ingestion adds chunks). An optional
+near-duplicate lookup reuses the answer of a cached query whose embedding
+is similar enough. Scoped queries (document filters) are cached per scope.
+"""
+import json
+import re
+import threading
+from typing import Optional
+import numpy as np
+from app.core.config import settings
+from app.services.cache import LRUCache
+from app.services.embedding import normalize_query
+
+def filter_scope(filters: Optional[dict]) -> str:
+    return json.dumps(filters, sort_keys=True, ensure_ascii=False) if filters else ""
+
+def answer_cache_key(query: str, filters: Optional[dict] = None) -> str:
+    # Case and trailing punctuation do not change the question
+    key = re.sub(r"[\s?؟!.。]+$", "", normalize_query(query).casefold())
+    return f"{key}\x00{filter_scope(filters)}" if filters else key
+
+class AnswerCache:
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float = 0.0):
+        self.similarity_threshold = similarity_threshold
+        self.near_hits = 0
+        self._entries = LRUCache(max_size, ttl)  # key -> (unit query embedding or None, response, filter scope)
+        self._generation = None
+        self._lock = threading.Lock()
+
+    @property
+    def uses_embeddings(self) -> bool:
+        return self.similarity_threshold > 0
+
+    def _check_generation(self, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+
+    def get(self, query: str, generation: int, query_embedding: list[float] = None, filters: dict = None) -> Optional[dict]:
+        self._check_generation(generation)
+        entry = self._entries.get(answer_cache_key(query, filters))
+        if entry is not None:
+            return entry[1]
+        if not self.uses_embeddings or query_embedding is None:
+            return None
+
+        scope = filter_scope(filters)
+        candidates = [(key, entry) for key, entry in self._entries.items() if entry[0] is not None and entry[2] == scope]
+        if not candidates:
+            return None
+        matrix = np.stack([entry[0] for _, entry in candidates])
+        similarities = matrix @ _unit(query_embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        with self._lock:
+            self.near_hits += 1
+        return candidates[best][1][1]
+
+    def put(self, query: str, generation: int, response: dict, query_embedding: list[float] = None, filters: dict = None):
+        self._check_generation(generation)
+        embedding = _unit(query_embedding) if self.uses_embeddings and query_embedding is not None else None
+        self._entries.set(answer_cache_key(query, filters), (embedding, response, filter_scope(filters)))
+
+    def stats(self) -> dict:
+        return {**self._entries.stats(), "near_hits": self.near_hits, "generation": self._generation}
+
+def _unit(vector: list[float]) -> np.ndarray:
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+answer_cache = AnswerCache(
+    settings.ANSWER_CACHE_SIZE,
+    settings.ANSWER_CACHE_TTL,
+    settings.ANSWER_CACHE_SIMILARITY,
+)
@@ -0,0 +1,754 @@
+"""
+Inverted-index BM25 engine.
+
+Scores are computed like rank_bm25.BM25Okapi (same IDF with epsilon floor,
+same length normalization), but only the posting lists of the query terms are
+touched, and low-impact terms are pruned MaxScore-style once they can no
+longer change the top-k.
+
+The index is append-only: every batch of new chunks becomes a small immutable
+segment, corpus statistics (document count, total length, document-frequency
+histogram) are kept as running totals, and MERGE_FACTOR neighbouring segments of
+the same size tier are merged in a background thread, so the segment count grows
+logarithmically with the corpus.
+
+Several uvicorn workers may write to the same index: writes hold an exclusive
+lock on the index directory and reload the manifest first, and segment file
+names are unique per writer.
+
+Segments are stored in a versioned binary format and opened with mmap, so
+opening an index does not depend on its size, uvicorn workers share the same
+physical pages, and chunk texts are only decoded for the hits returned.
+"""
+import heapq
+import json
+import math
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, run a single worker
+    fcntl = None
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "write.lock"
+MERGE_FACTOR = 8  # segments of the same size tier that trigger a background merge
+REFRESH_INTERVAL = 1.0  # seconds between checks for segments written by other workers
+FILTER_FIELDS = ("filename", "document_id")  # metadata fields a search can be scoped to
+
+# Segment file layout: header, section table, then 8-byte aligned sections.
+FORMAT_MAGIC = b"NBM25SEG"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sIIQQ")  # magic, version, section count, num docs, num terms
+_SECTION = struct.Struct("<QQ")  # offset, byte length
+_SECTIONS = (
+    ("term_offsets", "<u8"),  # num_terms + 1 offsets into "terms"
+    ("terms", None),  # UTF-8 terms, sorted bytewise
+    ("postings_offsets", "<u8"),  # num_terms + 1 offsets into doc_ids/tfs
+    ("doc_ids", "<u4"),
+    ("tfs", "<u4"),
+    ("max_tf", "<u4"),  # per term, for the score upper bound
+    ("min_len_ratio", "<f8"),  # per term, min(doc_len / tf) over its postings
+    ("doc_len", "<u4"),
+    ("text_offsets", "<u8"),  # num_docs + 1 offsets into "texts"
+    ("texts", None),
+    ("meta_offsets", "<u8"),  # num_docs + 1 offsets into "metas"
+    ("metas", None),  # one JSON object per chunk
+    # JSON {field: {value: [[start, end], ...]}} of local doc id ranges, for FILTER_FIELDS.
+    # Segments written before it was added are read without it (see Segment.value_ranges).
+    ("filter_ranges", None),
+)
+
+ValueRanges = Dict[str, Dict[str, List[Tuple[int, int]]]]
+
+
+def _intersect_ranges(a: List[Tuple[int, int]], b: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Intersection of two sorted lists of disjoint [start, end) ranges."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _complement_ranges(ranges: List[Tuple[int, int]], n: int) -> List[Tuple[int, int]]:
+    """The parts of [0, n) outside sorted, disjoint [start, end) ranges."""
+    result = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            result.append((position, start))
+        position = max(position, end)
+    if position < n:
+        result.append((position, n))
+    return result
+
+
+def _add_range(ranges: List[Tuple[int, int]], start: int, end: int):
+    """Appends [start, end), extending the last range when they touch."""
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
+
+
+def _value_ranges(metadatas: List[dict]) -> ValueRanges:
+    """Doc id ranges per value of each filter field; chunks of a document are contiguous, so there are few."""
+    index = {field: {} for field in FILTER_FIELDS}
+    for i, meta in enumerate(metadatas):
+        for field in FILTER_FIELDS:
+            if field in meta:
+                _add_range(index[field].setdefault(str(meta[field]), []), i, i + 1)
+    return index
+
+
+def _blob(items: List[bytes]) -> Tuple[np.ndarray, bytes]:
+    offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+    if items:
+        offsets[1:] = np.cumsum([len(item) for item in items])
+    return offsets, b"".join(items)
+
+
+class Segment:
+    """Immutable, memory-mapped posting lists (CSR layout, local doc ids ascending) for a run of chunks."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_sections, self.num_docs, self.num_terms = _HEADER.unpack_from(self._mm, 0)
+        if magic != FORMAT_MAGIC:
+            raise ValueError(f"{path} is not a BM25 segment")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 segment version {version} in {path}")
+        sections = {}
+        for i, (name, dtype) in enumerate(_SECTIONS[:num_sections]):
+            offset, length = _SECTION.unpack_from(self._mm, _HEADER.size + i * _SECTION.size)
+            if dtype is None:
+                sections[name] = (offset, length)
+            else:
+                sections[name] = np.frombuffer(self._mm, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+        self.term_offsets = sections["term_offsets"]
+        self._terms_start = sections["terms"][0]
+        self.postings_offsets = sections["postings_offsets"]
+        self.doc_ids = sections["doc_ids"]
+        self.tfs = sections["tfs"]
+        self.max_tf = sections["max_tf"]
+        self.min_len_ratio = sections["min_len_ratio"]
+        self.doc_len = sections["doc_len"]
+        self.text_offsets = sections["text_offsets"]
+        self._texts_start = sections["texts"][0]
+        self.meta_offsets = sections["meta_offsets"]
+        self._metas_start = sections["metas"][0]
+        self._filter_ranges = sections.get("filter_ranges")
+        self._value_ranges = None
+
+    @staticmethod
+    def write(path: str, terms: List[bytes], postings_offsets: np.ndarray, doc_ids: np.ndarray,
+              tfs: np.ndarray, doc_len: np.ndarray, texts: List[bytes], metas: List[bytes], value_ranges: ValueRanges):
+        """Writes a segment file atomically. `terms` must be sorted bytewise."""
+        max_tf = np.zeros(len(terms), dtype=np.uint32)
+        min_len_ratio = np.zeros(len(terms), dtype=np.float64)
+        if len(doc_ids):
+            starts = postings_offsets[:-1].astype(np.int64)
+            max_tf = np.maximum.reduceat(tfs, starts)
+            min_len_ratio = np.minimum.reduceat(doc_len[doc_ids] / tfs, starts)
+        term_offsets, term_blob = _blob(terms)
+        text_offsets, text_blob = _blob(texts)
+        meta_offsets, meta_blob = _blob(metas)
+        payloads = {
+            "term_offsets": term_offsets, "terms": term_blob, "postings_offsets": postings_offsets,
+            "doc_ids": doc_ids, "tfs": tfs, "max_tf": max_tf, "min_len_ratio": min_len_ratio,
+            "doc_len": doc_len, "text_offsets": text_offsets, "texts": text_blob,
+            "meta_offsets": meta_offsets, "metas": meta_blob,
+            "filter_ranges": json.dumps(value_ranges, ensure_ascii=False).encode("utf-8"),
+        }
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            table_end = _HEADER.size + len(_SECTIONS) * _SECTION.size
+            f.write(b"\0" * table_end)
+            table = []
+            for name, dtype in _SECTIONS:
+                data = payloads[name] if dtype is None else np.ascontiguousarray(payloads[name], dtype=dtype).tobytes()
+                f.write(b"\0" * (-f.tell() % 8))
+                table.append((f.tell(), len(data)))
+                f.write(data)
+            f.seek(0)
+            f.write(_HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, len(_SECTIONS), len(doc_len), len(terms)))
+            for offset, length in table:
+                f.write(_SECTION.pack(offset, length))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def build(cls, path: str, tokenized_corpus: List[List[str]], texts: List[str], metadatas: List[dict]) -> "Segment":
+        postings = {}
+        for doc_id, tokens in enumerate(tokenized_corpus):
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term.encode("utf-8"), []).append((doc_id, tf))
+        terms = sorted(postings)
+        lengths = [len(postings[t]) for t in terms]
+        flat = [pair for t in terms for pair in postings[t]]
+        cls.write(
+            path, terms,
+            np.concatenate(([0], np.cumsum(lengths, dtype=np.uint64))).astype(np.uint64),
+            np.fromiter((d for d, _ in flat), dtype=np.uint32, count=len(flat)),
+            np.fromiter((tf for _, tf in flat), dtype=np.uint32, count=len(flat)),
+            np.fromiter((len(t) for t in tokenized_corpus), dtype=np.uint32, count=len(tokenized_corpus)),
+            [text.encode("utf-8") for text in texts],
+            [json.dumps(meta, ensure_ascii=False).encode("utf-8") for meta in metadatas],
+            _value_ranges(metadatas),
+        )
+        return cls(path)
+
+    @classmethod
+    def merge(cls, path: str, segments: List["Segment"]) -> "Segment":
+        """Concatenates segments in order, shifting their doc ids; no re-tokenization."""
+        bases = np.concatenate(([0], np.cumsum([seg.num_docs for seg in segments]))).astype(np.uint32)
+        terms, lengths, ids_parts, tfs_parts = [], [], [], []
+        # k-way merge of the sorted vocabularies; equal terms come out in segment order
+        for term, s, t in heapq.merge(*(seg.keyed_terms(s) for s, seg in enumerate(segments))):
+            ids, tfs = segments[s].postings_at(t)
+            if not terms or terms[-1] != term:
+                terms.append(term)
+                lengths.append(0)
+            lengths[-1] += len(ids)
+            ids_parts.append(ids + bases[s])
+            tfs_parts.append(tfs)
+        value_ranges = {field: {} for field in FILTER_FIELDS}
+        for seg, base in zip(segments, bases.tolist()):
+            for field, values in seg.value_ranges().items():
+                for value, ranges in values.items():
+                    merged_ranges = value_ranges.setdefault(field, {}).setdefault(value, [])
+                    for start, end in ranges:
+                        _add_range(merged_ranges, start + base, end + base)
+        cls.write(
+            path, terms,
+            np.concatenate(([0], np.cumsum(lengths, dtype=np.uint64))).astype(np.uint64),
+            np.concatenate(ids_parts).astype(np.uint32) if ids_parts else np.zeros(0, dtype=np.uint32),
+            np.concatenate(tfs_parts).astype(np.uint32) if tfs_parts else np.zeros(0, dtype=np.uint32),
+            np.concatenate([seg.doc_len for seg in segments]).astype(np.uint32),
+            [seg.raw_text(i) for seg in segments for i in range(seg.num_docs)],
+            [seg.raw_metadata(i) for seg in segments for i in range(seg.num_docs)],
+            value_ranges,
+        )
+        return cls(path)
+
+    def _term(self, t: int) -> bytes:
+        start = self._terms_start + int(self.term_offsets[t])
+        return self._mm[start:self._terms_start + int(self.term_offsets[t + 1])]
+
+    def terms(self) -> Iterator[bytes]:
+        for t in range(self.num_terms):
+            yield self._term(t)
+
+    def keyed_terms(self, key: int) -> Iterator[Tuple[bytes, int, int]]:
+        for t in range(self.num_terms):
+            yield self._term(t), key, t
+
+    def term_id(self, term: str) -> Optional[int]:
+        """Binary search over the sorted on-disk vocabulary."""
+        key = term.encode("utf-8")
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.num_terms and self._term(lo) == key else None
+
+    def postings_at(self, t: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self.postings_offsets[t]), int(self.postings_offsets[t + 1])
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def doc_freq_at(self, t: int) -> int:
+        return int(self.postings_offsets[t + 1] - self.postings_offsets[t])
+
+    def doc_freq(self, term: str) -> int:
+        t = self.term_id(term)
+        return 0 if t is None else self.doc_freq_at(t)
+
+    def raw_text(self, i: int) -> bytes:
+        return self._mm[self._texts_start + int(self.text_offsets[i]):self._texts_start + int(self.text_offsets[i + 1])]
+
+    def raw_metadata(self, i: int) -> bytes:
+        return self._mm[self._metas_start + int(self.meta_offsets[i]):self._metas_start + int(self.meta_offsets[i + 1])]
+
+    def text(self, i: int) -> str:
+        return self.raw_text(i).decode("utf-8")
+
+    def metadata(self, i: int) -> dict:
+        return json.loads(self.raw_metadata(i))
+
+    def value_ranges(self) -> ValueRanges:
+        """
+        field -> value -> [start, end) local doc id ranges, for FILTER_FIELDS.
+        Written in the segment when it is built or merged; segments from before that
+        are scanned once (they are replaced by the next merge or rebuild).
+        """
+        if self._value_ranges is None:
+            if self._filter_ranges is not None:
+                offset, length = self._filter_ranges
+                stored = json.loads(self._mm[offset:offset + length])
+                self._value_ranges = {
+                    field: {value: [tuple(r) for r in ranges] for value, ranges in values.items()}
+                    for field, values in stored.items()
+                }
+            else:
+                self._value_ranges = _value_ranges([self.metadata(i) for i in range(self.num_docs)])
+        return self._value_ranges
+
+    def doc_ranges(self, filters: Optional[dict], deleted_documents=()) -> np.ndarray:
+        """
+        (n, 2) array of [start, end) local doc id ranges matching every filter field (any of
+        its values), without the chunks of deleted documents.
+        """
+        index = self.value_ranges()
+        result = [(0, self.num_docs)]
+        for field, values in (filters or {}).items():
+            ranges = sorted(r for value in values for r in index.get(field, {}).get(str(value), []))
+            result = _intersect_ranges(result, ranges)
+        if deleted_documents:
+            deleted = sorted(r for value in deleted_documents for r in index.get("document_id", {}).get(str(value), []))
+            result = _intersect_ranges(result, _complement_ranges(deleted, self.num_docs))
+        return np.asarray(result, dtype=np.int64).reshape(-1, 2)
+
+
+class BM25Index:
+    def __init__(self, directory: str, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25, analyzer: str = None):
+        self.directory = directory
+        # Name of the tokenizer the caller indexes and queries with, and the one the stored
+        # segments were built with (None for indexes written before it was recorded)
+        self.analyzer = analyzer
+        self.built_with = analyzer
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.segments: List[Segment] = []
+        # Running corpus statistics, updated per segment instead of recomputed over the corpus
+        self.num_docs = 0
+        self.total_len = 0
+        self.df_hist = Counter()  # document frequency -> number of terms with that frequency
+        self.generation = 0
+        # Documents whose chunks are left out of searches (their ingestion failed part way);
+        # segments are immutable, so the chunks stay on disk until the next rebuild
+        self.deleted_documents = set()
+        self.next_segment = 0
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._write_depth = 0
+        self._merging = False
+        self._idf_cache = (None, None)
+        self._manifest_mtime = None
+        self._checked_at = 0.0
+
+    @property
+    def avgdl(self) -> float:
+        return self.total_len / self.num_docs if self.num_docs else 0.0
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_FILE)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._manifest_path)
+
+    @contextmanager
+    def writer(self):
+        """
+        Exclusive write access to the index, across threads and worker processes
+        (flock on the index directory). The manifest is reloaded on entry, so the
+        changes made inside apply to the latest state. Re-entrant.
+        """
+        with self._lock:
+            if self._write_depth == 0:
+                os.makedirs(self.directory, exist_ok=True)
+                self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "a+")
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._write_depth += 1
+            try:
+                if self._write_depth == 1 and self.exists():
+                    self.load()
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def load(self):
+        """Opens the segments listed in the manifest (already open ones are reused)."""
+        with self._lock:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if self._write_depth == 0 and any(name.endswith(".pkl") for name in manifest["segments"]):
+                # Upgrading rewrites segments and the manifest: reload under the write lock
+                with self.writer():
+                    return
+            self.next_segment = manifest["next_segment"]
+            names = [self._upgrade_segment(name) for name in manifest["segments"]]
+            opened = {seg.name: seg for seg in self.segments}
+            self.segments = [opened.get(name) or Segment(os.path.join(self.directory, name)) for name in names]
+            self.num_docs = manifest["num_docs"]
+            self.total_len = manifest["total_len"]
+            self.df_hist = Counter({int(df): n for df, n in manifest["df_hist"].items()})
+            self.generation = manifest["generation"]
+            self.built_with = manifest.get("analyzer")
+            self.deleted_documents = set(manifest.get("deleted_documents", []))
+            self._manifest_mtime = mtime
+            if names != manifest["segments"]:
+                self._save_manifest()
+
+    def refresh(self):
+        """Picks up segments added or merged by other workers (checked at most every REFRESH_INTERVAL)."""
+        now = time.monotonic()
+        if now - self._checked_at < REFRESH_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._manifest_mtime:
+            self.load()
+
+    def _upgrade_segment(self, name: str) -> str:
+        """Rewrites a pickled segment from older versions in the binary format."""
+        if not name.endswith(".pkl"):
+            return name
+        path = os.path.join(self.directory, name)
+        with open(path, "rb") as f:
+            old = pickle.load(f).__dict__
+        terms = list(old["vocab"])
+        order = sorted(range(len(terms)), key=lambda t: terms[t].encode("utf-8"))
+        spans = [(old["offsets"][t], old["offsets"][t + 1]) for t in order]
+        new_name = self._next_name()
+        Segment.write(
+            os.path.join(self.directory, new_name),
+            [terms[t].encode("utf-8") for t in order],
+            np.concatenate(([0], np.cumsum([end - start for start, end in spans], dtype=np.uint64))).astype(np.uint64),
+            np.concatenate([old["doc_ids"][start:end] for start, end in spans]).astype(np.uint32),
+            np.concatenate([old["tfs"][start:end] for start, end in spans]).astype(np.uint32),
+            np.asarray(old["doc_len"], dtype=np.uint32),
+            [text.encode("utf-8") for text in old["texts"]],
+            [json.dumps(meta, ensure_ascii=False).encode("utf-8") for meta in old["metadatas"]],
+            _value_ranges(old["metadatas"]),
+        )
+        os.remove(path)
+        return new_name
+
+    def reset(self):
+        self.rebuild([], [], [])
+
+    def rebuild(self, tokenized_corpus: List[List[str]], texts: List[str], metadatas: List[dict]):
+        """
+        Replaces the whole index by one segment. The segment is written before taking the
+        write lock and readers switch to it with a single manifest write, so they never
+        see an empty or partial index.
+        """
+        segment = None
+        if texts:
+            os.makedirs(self.directory, exist_ok=True)
+            segment = Segment.build(os.path.join(self.directory, self._unique_name()), tokenized_corpus, texts, metadatas)
+        with self.writer():
+            old = self.segments
+            self.segments = [segment] if segment else []
+            self.num_docs = segment.num_docs if segment else 0
+            self.total_len = int(segment.doc_len.sum()) if segment else 0
+            self.df_hist = Counter(segment.doc_freq_at(t) for t in range(segment.num_terms)) if segment else Counter()
+            self.generation += 1
+            self.built_with = self.analyzer
+            self.deleted_documents = set()
+            self._save_manifest()
+        self._remove_files(old)
+
+    def delete_documents(self, document_ids: List):
+        """Leaves the chunks of these documents out of every later search."""
+        with self.writer():
+            self.deleted_documents = self.deleted_documents | {str(document_id) for document_id in document_ids}
+            self.generation += 1
+            self._save_manifest()
+
+    @property
+    def needs_reindex(self) -> bool:
+        """True when the stored segments were tokenized differently from what queries use."""
+        return bool(self.segments) and self.built_with != self.analyzer
+
+    def stats(self) -> dict:
+        """Vocabulary size and on-disk (mapped) size of the index."""
+        with self._lock:
+            segments = self.segments
+        postings = sum(len(seg.doc_ids) for seg in segments)
+        return {
+            "analyzer": self.built_with,
+            "documents": self.num_docs,
+            "vocabulary": sum(self.df_hist.values()),
+            "postings": postings,
+            "segments": len(segments),
+            "postings_bytes": postings * 8,
+            "bytes": sum(len(seg._mm) for seg in segments),
+        }
+
+    def add(self, tokenized_corpus: List[List[str]], texts: List[str], metadatas: List[dict]):
+        """Appends one segment. Cost depends on the new chunks only, not on the corpus size."""
+        if not texts:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Built outside the write lock: the file name is unique to this writer
+        segment = Segment.build(os.path.join(self.directory, self._unique_name()), tokenized_corpus, texts, metadatas)
+        with self.writer():
+            for t, term in enumerate(segment.terms()):
+                term = term.decode("utf-8")
+                old_df = sum(seg.doc_freq(term) for seg in self.segments)
+                if old_df:
+                    self.df_hist[old_df] -= 1
+                    if not self.df_hist[old_df]:
+                        del self.df_hist[old_df]
+                self.df_hist[old_df + segment.doc_freq_at(t)] += 1
+            self.segments = self.segments + [segment]
+            self.num_docs += segment.num_docs
+            self.total_len += int(segment.doc_len.sum())
+            self.generation += 1
+            self._save_manifest()
+        self._maybe_merge()
+
+    def _next_name(self) -> str:
+        """Segment name for a write made under the write lock; the counter keeps names in creation order."""
+        name = f"seg_{self.next_segment:06d}_{uuid.uuid4().hex[:8]}.bm25"
+        self.next_segment += 1
+        return name
+
+    def _unique_name(self) -> str:
+        """Segment name for a file written before taking the write lock."""
+        return f"seg_{os.getpid()}_{uuid.uuid4().hex}.bm25"
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "analyzer": self.built_with,
+            "segments": [seg.name for seg in self.segments],
+            "num_docs": self.num_docs,
+            "total_len": self.total_len,
+            "df_hist": {str(df): n for df, n in self.df_hist.items()},
+            "generation": self.generation,
+            "next_segment": self.next_segment,
+            "deleted_documents": sorted(self.deleted_documents),
+        }
+        with open(self._manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(self._manifest_path + ".tmp", self._manifest_path)
+        self._manifest_mtime = os.stat(self._manifest_path).st_mtime_ns
+
+    def _remove_files(self, segments: List[Segment]):
+        # Readers that still map these files keep their pages until they drop them
+        for seg in segments:
+            try:
+                os.remove(seg.path)
+            except OSError:
+                pass
+
+    # Background merging
+
+    @staticmethod
+    def _tier(segment: Segment) -> int:
+        """Size tier: segments of tier t hold between MERGE_FACTOR**t and MERGE_FACTOR**(t+1) - 1 chunks."""
+        return int(math.log(max(segment.num_docs, 1), MERGE_FACTOR) + 1e-9)
+
+    def _pick_merge(self) -> List[Segment]:
+        """
+        MERGE_FACTOR neighbouring segments of the same size tier, the smallest tier first.
+        A merge produces a segment of a higher tier, so each tier holds fewer than
+        MERGE_FACTOR segments once merges are done and the count stays logarithmic.
+        Only neighbours are merged, so chunks keep their corpus order.
+        """
+        best = []
+        run = []
+        for seg in self.segments:
+            if run and self._tier(run[-1]) != self._tier(seg):
+                run = []
+            run.append(seg)
+            if len(run) == MERGE_FACTOR:
+                if not best or self._tier(seg) < self._tier(best[0]):
+                    best = run
+                run = []
+        return best
+
+    def _maybe_merge(self):
+        with self._lock:
+            if self._merging or not self._pick_merge():
+                return
+            self._merging = True
+        threading.Thread(target=self._merge_loop, daemon=True).start()
+
+    def _merge_loop(self):
+        try:
+            while True:
+                with self._lock:
+                    run = self._pick_merge()
+                if not run:
+                    return
+                merged = Segment.merge(os.path.join(self.directory, self._unique_name()), run)
+                with self.writer():
+                    names = [seg.name for seg in self.segments]
+                    run_names = [seg.name for seg in run]
+                    start = names.index(run_names[0]) if run_names[0] in names else -1
+                    if start < 0 or names[start:start + len(run)] != run_names:
+                        # Reset, or merged by another worker, while this merge was running
+                        self._remove_files([merged])
+                        continue
+                    self.segments = self.segments[:start] + [merged] + self.segments[start + len(run):]
+                    self._save_manifest()
+                self._remove_files(run)
+        except Exception as e:
+            print(f"BM25 segment merge failed: {e}")
+        finally:
+            with self._lock:
+                self._merging = False
+
+    # Scoring
+
+    def _average_idf(self) -> float:
+        generation, average_idf = self._idf_cache
+        if generation != self.generation:
+            n = self.num_docs
+            vocab_size = sum(self.df_hist.values())
+            idf_sum = sum(count * (math.log(n - df + 0.5) - math.log(df + 0.5)) for df, count in self.df_hist.items())
+            average_idf = idf_sum / vocab_size if vocab_size else 0.0
+            self._idf_cache = (self.generation, average_idf)
+        return average_idf
+
+    def _idf(self, df: int) -> float:
+        # Same formula and epsilon floor as BM25Okapi._calc_idf
+        idf = math.log(self.num_docs - df + 0.5) - math.log(df + 0.5)
+        return self.epsilon * self._average_idf() if idf < 0 else idf
+
+    def _term_weights(self, idf: float, doc_len: np.ndarray, tfs: np.ndarray) -> np.ndarray:
+        # Operand order mirrors BM25Okapi.get_scores
+        return idf * (tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)))
+
+    def _upper_bound(self, idf: float, seg: Segment, t: int) -> float:
+        # tf / (tf + k1*(1-b) + k1*b*dl/avgdl) is bounded using the largest tf and smallest dl/tf of the list
+        denom = 1 + self.k1 * (1 - self.b) / seg.max_tf[t] + self.k1 * self.b * seg.min_len_ratio[t] / self.avgdl
+        return idf * (self.k1 + 1) / denom
+
+    def top_k(self, query_tokens: List[str], k: int, filters: Optional[dict] = None) -> List[Tuple[Segment, int, float]]:
+        """
+        Returns up to k (segment, local doc id, score) hits with score > 0, best first.
+        Ties are broken by position in the corpus, like a stable sort over get_scores.
+        filters ({field: [values]}) restricts the search to matching chunks: only the
+        matching doc id ranges of each posting list are scored, and segments without
+        matching chunks are skipped. IDF stays computed over the whole corpus.
+        Chunks of deleted documents are left out the same way.
+        """
+        with self._lock:
+            segments, deleted = self.segments, self.deleted_documents
+        if not segments or k <= 0:
+            return []
+        bases = np.concatenate(([0], np.cumsum([seg.num_docs for seg in segments]))).astype(np.int64)
+        ranges = [seg.doc_ranges(filters, deleted) for seg in segments] if filters or deleted else None
+
+        def postings(s: int, seg: Segment, t: int) -> Tuple[np.ndarray, np.ndarray]:
+            ids, tfs = seg.postings_at(t)
+            if ranges is None:
+                return ids, tfs
+            bounds = np.searchsorted(ids, ranges[s])
+            if len(bounds) == 1:
+                return ids[bounds[0, 0]:bounds[0, 1]], tfs[bounds[0, 0]:bounds[0, 1]]
+            rows = np.concatenate([np.arange(start, end) for start, end in bounds])
+            return ids[rows], tfs[rows]
+
+        weights = Counter()
+        doc_freqs = {}
+        term_segments = {}  # term -> [(segment index, segment, term id)], in scope
+        for term in query_tokens:
+            if term not in term_segments:
+                lookups = [(s, seg, seg.term_id(term)) for s, seg in enumerate(segments)]
+                lookups = [(s, seg, t) for s, seg, t in lookups if t is not None]
+                doc_freqs[term] = sum(seg.doc_freq_at(t) for _, seg, t in lookups)
+                term_segments[term] = [(s, seg, t) for s, seg, t in lookups if ranges is None or len(ranges[s])]
+            if term_segments[term]:
+                weights[term] += 1
+        if not weights:
+            return []
+
+        idfs = {term: self._idf(doc_freqs[term]) for term in weights}
+        bounds = {
+            term: weights[term] * max(self._upper_bound(idfs[term], seg, t) for _, seg, t in term_segments[term])
+            for term in weights
+        }
+        # Highest-impact terms first; the tail can then be treated as non-essential
+        terms = sorted(weights, key=lambda t: bounds[t], reverse=True)
+        can_prune = all(idfs[t] >= 0 for t in terms)
+        remaining = np.cumsum([bounds[t] for t in terms][::-1])[::-1]
+
+        cand_ids = np.zeros(0, dtype=np.int64)
+        cand_scores = np.zeros(0, dtype=np.float64)
+        for i, term in enumerate(terms):
+            if can_prune and i > 0 and len(cand_ids) >= k:
+                theta = np.partition(cand_scores, len(cand_scores) - k)[len(cand_scores) - k]
+                if remaining[i] < theta:
+                    # No unseen document can reach the top-k any more: only
+                    # probe the remaining lists for the surviving candidates.
+                    keep = cand_scores + remaining[i] >= theta
+                    cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+                    for term in terms[i:]:
+                        for s, seg, t in term_segments[term]:
+                            ids, tfs = postings(s, seg, t)
+                            if not len(ids):
+                                # The term only occurs outside the filtered ranges of this segment
+                                continue
+                            in_seg = np.nonzero((cand_ids >= bases[s]) & (cand_ids < bases[s + 1]))[0]
+                            local = cand_ids[in_seg] - bases[s]
+                            pos = np.minimum(np.searchsorted(ids, local), len(ids) - 1)
+                            hit = ids[pos] == local
+                            rows = in_seg[hit]
+                            cand_scores[rows] += weights[term] * self._term_weights(idfs[term], seg.doc_len[local[hit]], tfs[pos[hit]])
+                    break
+
+            ids_parts, score_parts = [cand_ids], [cand_scores]
+            for s, seg, t in term_segments[term]:
+                ids, tfs = postings(s, seg, t)
+                ids_parts.append(ids + bases[s])
+                score_parts.append(weights[term] * self._term_weights(idfs[term], seg.doc_len[ids], tfs))
+            merged_ids, inverse = np.unique(np.concatenate(ids_parts), return_inverse=True)
+            cand_scores = np.bincount(inverse, weights=np.concatenate(score_parts), minlength=len(merged_ids))
+            cand_ids = merged_ids
+
+        positive = cand_scores > 0
+        cand_ids, cand_scores = cand_ids[positive], cand_scores[positive]
+        if len(cand_scores) > k:
+            # Partition down to the k best (keeping ties at the boundary), then sort only those
+            theta = np.partition(cand_scores, len(cand_scores) - k)[len(cand_scores) - k]
+            shortlist = cand_scores >= theta
+            cand_ids, cand_scores = cand_ids[shortlist], cand_scores[shortlist]
+        order = np.lexsort((cand_ids, -cand_scores))[:k]
+
+        hits = []
+        for i in order:
+            s = int(np.searchsorted(bases, cand_ids[i], side="right")) - 1
+            hits.append((segments[s], int(cand_ids[i] - bases[s]), float(cand_scores[i])))
+        return hits
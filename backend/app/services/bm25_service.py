@@ -1,69 +1,88 @@
 import pickle
 import os
-from rank_bm25 import BM25Okapi
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from app.core.metrics import span
+from app.services.bm25_index import BM25Index
+from app.services.tokenizer import analyzer
 
-INDEX_FILE = "data/bm25_index.pkl"
+INDEX_DIR = "data/bm25"
+LEGACY_INDEX_FILE = "data/bm25_index.pkl"
 
 class BM25Service:
     def __init__(self):
-        self.bm25 = None
-        self.corpus = [] # List of texts (chunks)
-        self.metadatas = [] # List of metadata corresponding to chunks
+        self.index = BM25Index(INDEX_DIR, analyzer=analyzer.name)
         self.load_index()
 
+    @property
+    def generation(self) -> int:
+        """Bumped every time chunks are added or the index is rebuilt (by any worker)."""
+        self.index.refresh()
+        return self.index.generation
+
     def build_index(self, corpus: List[str], metadatas: List[dict]):
-        """Builds and saves the BM25 index."""
-        tokenized_corpus = [doc.split(" ") for doc in corpus]
-        self.bm25 = BM25Okapi(tokenized_corpus)
-        self.corpus = corpus
-        self.metadatas = metadatas
-        self.save_index()
+        """Rebuilds the BM25 index from scratch; other workers never see it half built."""
+        tokenized_corpus = [analyzer.analyze(doc) for doc in corpus]
+        self.index.rebuild(tokenized_corpus, corpus, metadatas)
+
+    def add_documents(self, chunks: List[str], metadatas: List[dict]):
+        """Appends chunks as a new index segment (only the new chunks are tokenized and written)."""
+        tokenized_chunks = [analyzer.analyze(doc) for doc in chunks]
+        self.index.add(tokenized_chunks, chunks, metadatas)
 
-    def save_index(self):
-        """Saves the index and corpus to disk."""
-        os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
-        with open(INDEX_FILE, "wb") as f:
-            pickle.dump({
-                "bm25": self.bm25,
-                "corpus": self.corpus,
-                "metadatas": self.metadatas
-            }, f)
+    def delete_document(self, document_id):
+        """Leaves a document's chunks out of searches (segments are immutable; a rebuild drops them)."""
+        self.index.delete_documents([document_id])
 
     def load_index(self):
         """Loads the index from disk if it exists."""
-        if os.path.exists(INDEX_FILE):
-            try:
-                with open(INDEX_FILE, "rb") as f:
-                    data = pickle.load(f)
-                    self.bm25 = data["bm25"]
-                    self.corpus = data["corpus"]
-                    self.metadatas = data.get("metadatas", [])
-            except Exception as e:
-                print(f"Error loading BM25 index: {e}")
+        try:
+            if self.index.exists():
+                self.index.load()
+                if not self.index.needs_reindex:
+                    return
+            elif not os.path.exists(LEGACY_INDEX_FILE):
+                return
+            # Every worker starts here: convert under the write lock, once, after re-checking
+            with self.index.writer():
+                if self.index.exists():
+                    if self.index.needs_reindex:
+                        self.reindex()
+                elif os.path.exists(LEGACY_INDEX_FILE):
+                    # Single-pickle index from older versions: convert it to a segment once
+                    with open(LEGACY_INDEX_FILE, "rb") as f:
+                        data = pickle.load(f)
+                    self.build_index(data["corpus"], data.get("metadatas", []) or [{} for _ in data["corpus"]])
+        except Exception as e:
+            print(f"Error loading BM25 index: {e}")
+
+    def reindex(self):
+        """Re-tokenizes the stored chunks with the current analyzer (tokenizer version or options changed)."""
+        print(f"🔄 Re-tokenizing the BM25 index ({self.index.built_with} -> {analyzer.name})...")
+        before = self.index.stats()
+        texts, metadatas = [], []
+        for segment in self.index.segments:
+            for i in range(segment.num_docs):
+                texts.append(segment.text(i))
+                metadatas.append(segment.metadata(i))
+        self.build_index(texts, metadatas)
+        after = self.index.stats()
+        print(f"✅ BM25 vocabulary {before['vocabulary']} -> {after['vocabulary']} terms, "
+              f"{before['bytes'] / 1e6:.1f} -> {after['bytes'] / 1e6:.1f} MB")
 
-    def search(self, query: str, top_k: int = 5) -> List[Tuple[str, float, dict]]:
+    def search(self, query: str, top_k: int = 5, filters: Optional[dict] = None) -> List[Tuple[str, float, dict]]:
         """
         Search the corpus using BM25.
+        filters ({"filename": [...], "document_id": [...]}) restricts the search to matching chunks.
         Returns a list of (chunk, score, metadata) tuples.
         """
-        if not self.bm25:
-            return []
+        with span("bm25"):
+            self.index.refresh()
+            tokenized_query = analyzer.analyze(query)
+            # Only the posting lists of the query terms are scored, within the filtered doc ranges
+            hits = self.index.top_k(tokenized_query, top_k, filters=filters)
 
-        tokenized_query = query.split(" ")
-        # Get scores for all documents
-        scores = self.bm25.get_scores(tokenized_query)
-        
-        # Pair scores with docs and metadata
-        results = []
-        for i, score in enumerate(scores):
-            if score > 0:
-                results.append((self.corpus[i], score, self.metadatas[i] if i < len(self.metadatas) else {}))
-        
-        # Sort by score descending
-        results.sort(key=lambda x: x[1], reverse=True)
-        
-        return results[:top_k]
+            # Texts and metadata are read from the mapped segment for the returned hits only
+            return [(segment.text(i), score, segment.metadata(i)) for segment, i, score in hits]
 
 # Global instance
 bm25_service = BM25Service()
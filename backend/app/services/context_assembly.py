@@ -0,0 +1,145 @@
+"""
+Turns the re-ranked chunks into the passages pasted in the answer prompt.
+
+Consecutive chunks of a document repeat up to CHUNK_OVERLAP characters of each other
+(see ingestion.py). Chunks of the same document that are adjacent (by chunk_index) or
+overlap are merged into one passage with the repeated span removed, and passages
+contained in another one are dropped. Passages keep the rank of their best chunk, so
+source [1] is still the most relevant one, and are cut to a token budget.
+
+Token counts are estimates (runs of up to 4 letters or digits, and punctuation marks,
+count as one token each); Gemini's own counts are in the nibrasse_llm_tokens_total metric.
+"""
+import re
+from typing import List, Optional, Tuple
+
+_TOKEN_RE = re.compile(r"[^\W_]{1,4}|[^\w\s]|_")
+_SENTENCE_END_RE = re.compile(r"[.!?؟۔\n]")
+
+# Shortest repeated span treated as chunk overlap rather than a coincidence
+MIN_OVERLAP = 20
+# Below this many tokens of remaining budget, a truncated passage is not worth adding
+MIN_PASSAGE_TOKENS = 50
+
+class Passage:
+    def __init__(self, rank: int, text: str, metadata: dict):
+        self.rank = rank
+        self.text = text
+        self.metadata = metadata
+        self.chunk_indices = [metadata["chunk_index"]] if "chunk_index" in metadata else []
+
+def estimate_tokens(text: str) -> int:
+    return len(_TOKEN_RE.findall(text))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts text after max_tokens tokens, at the last sentence end or space when possible."""
+    if max_tokens <= 0:
+        return ""
+    for count, match in enumerate(_TOKEN_RE.finditer(text), 1):
+        if count == max_tokens:
+            cut = text[:match.end()]
+            break
+    else:
+        return text
+    sentence_end = max((m.end() for m in _SENTENCE_END_RE.finditer(cut)), default=0)
+    if sentence_end > len(cut) // 2:
+        return cut[:sentence_end].rstrip()
+    space = cut.rfind(" ")
+    return (cut[:space] if space > len(cut) // 2 else cut).rstrip() + " …"
+
+def overlap_length(head: str, tail: str) -> int:
+    """Length of the longest suffix of head that is a prefix of tail (0 below MIN_OVERLAP)."""
+    if len(head) < MIN_OVERLAP or len(tail) < MIN_OVERLAP:
+        return 0
+    probe = tail[:MIN_OVERLAP]
+    start = max(0, len(head) - len(tail))
+    position = head.find(probe, start)
+    # The first match that extends to the end of head gives the longest overlap
+    while position != -1:
+        if tail.startswith(head[position:]):
+            return len(head) - position
+        position = head.find(probe, position + 1)
+    return 0
+
+def _source_key(metadata: dict):
+    if metadata.get("document_id") is not None:
+        return ("document_id", metadata["document_id"])
+    if metadata.get("filename"):
+        return ("filename", metadata["filename"])
+    return None
+
+def _merge_document(chunks: List[Tuple[int, str, dict]]) -> List[Passage]:
+    """Merges the chunks of one document, in document order, into passages."""
+    chunks = sorted(chunks, key=lambda c: (c[2].get("chunk_index", float("inf")), c[0]))
+    passages: List[Passage] = []
+    for rank, text, metadata in chunks:
+        current = passages[-1] if passages else None
+        if current is not None:
+            if text in current.text:
+                current.rank = min(current.rank, rank)
+                continue
+            overlap = overlap_length(current.text, text)
+            index = metadata.get("chunk_index")
+            adjacent = index is not None and current.chunk_indices and index == current.chunk_indices[-1] + 1
+            if overlap or adjacent:
+                current.text += text[overlap:] if overlap else "\n\n" + text
+                current.rank = min(current.rank, rank)
+                if index is not None:
+                    current.chunk_indices.append(index)
+                continue
+        passages.append(Passage(rank, text, dict(metadata)))
+    return passages
+
+def merge_chunks(documents: List[str], metadatas: List[dict]) -> List[Passage]:
+    """Passages from ranked chunks, ordered by their best chunk's rank."""
+    groups = {}
+    passages: List[Passage] = []
+    for rank, (text, metadata) in enumerate(zip(documents, metadatas)):
+        metadata = metadata or {}
+        key = _source_key(metadata)
+        if key is None:
+            passages.append(Passage(rank, text, dict(metadata)))
+        else:
+            groups.setdefault(key, []).append((rank, text, metadata))
+    for chunks in groups.values():
+        passages.extend(_merge_document(chunks))
+    passages.sort(key=lambda p: p.rank)
+
+    # Repeated spans across documents (e.g. the same file uploaded twice)
+    kept: List[Passage] = []
+    for passage in passages:
+        if any(passage.text.strip() in k.text for k in kept):
+            continue
+        contained = [k for k in kept if k.text.strip() in passage.text]
+        if contained:
+            passage.rank = min(k.rank for k in contained)
+            kept = [k for k in kept if k not in contained]
+        kept.append(passage)
+        kept.sort(key=lambda p: p.rank)
+    return kept
+
+def assemble(documents: List[str], metadatas: List[dict], token_budget: Optional[int] = None) -> Tuple[List[str], List[dict]]:
+    """
+    Merged, de-duplicated passages within token_budget (None or 0: no limit), with their
+    metadata; merged passages list their chunks in metadata["chunk_indices"].
+    """
+    texts, metas = [], []
+    remaining = token_budget or None
+    for passage in merge_chunks(documents, metadatas):
+        text = passage.text
+        if remaining is not None:
+            tokens = estimate_tokens(text)
+            if tokens > remaining:
+                if texts and remaining < MIN_PASSAGE_TOKENS:
+                    break
+                text = truncate_to_tokens(text, remaining)
+                tokens = estimate_tokens(text)
+            remaining -= tokens
+        metadata = passage.metadata
+        if len(passage.chunk_indices) > 1:
+            metadata["chunk_indices"] = passage.chunk_indices
+        texts.append(text)
+        metas.append(metadata)
+        if remaining is not None and remaining <= 0:
+            break
+    return texts, metas
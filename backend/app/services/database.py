@@ -1,21 +1,198 @@
-from supabase import create_client, Client
+"""
+Document and chunk records.
+
+Two interchangeable backends implement the same methods:
+- SupabaseBackend talks to the Supabase REST API (PostgREST) over one pooled HTTP session,
+  inserting chunk rows in pages with retries on transient errors.
+- SQLiteBackend keeps the same tables in a local file, for offline runs and benchmarks.
+DATABASE_BACKEND selects one; the module-level functions below are the interface used by the app.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+import httpx
 from app.core.config import settings
+from app.core.executor import run_blocking
+from app.core.metrics import RETRIES, span
+from app.services.cache import LRUCache
+
+class SupabaseBackend:
+    def __init__(self, url: str, key: str, page_size: int = 500, max_retries: int = 3):
+        self.page_size = page_size
+        self.max_retries = max_retries
+        # Shared by every thread: keeps connections to Supabase alive between requests
+        self.session = httpx.Client(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+            limits=httpx.Limits(max_connections=settings.DATABASE_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.DATABASE_MAX_CONNECTIONS),
+            timeout=30,
+        )
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("supabase"):
+                    response = self.session.request(method, path, **kwargs)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+                error = httpx.HTTPStatusError(f"{response.status_code} {response.text}", request=response.request, response=response)
+            except httpx.TransportError as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            RETRIES.inc(service="supabase")
+            time.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    def insert_document(self, filename: str, total_chunks: int) -> dict:
+        response = self._request("POST", "/documents", json={"filename": filename, "total_chunks": total_chunks},
+                                 headers={"Prefer": "return=representation"})
+        return response.json()[0]
+
+    def update_document(self, document_id, fields: dict) -> list[dict]:
+        response = self._request("PATCH", "/documents", params={"id": f"eq.{document_id}"}, json=fields,
+                                 headers={"Prefer": "return=representation"})
+        return response.json()
+
+    def insert_chunks(self, rows: list[dict]):
+        for start in range(0, len(rows), self.page_size):
+            self._request("POST", "/chunk", json=rows[start:start + self.page_size], headers={"Prefer": "return=minimal"})
+
+    def delete_document(self, document_id):
+        self._request("DELETE", "/chunk", params={"document_id": f"eq.{document_id}"})
+        self._request("DELETE", "/documents", params={"id": f"eq.{document_id}"})
+
+    def list_documents(self) -> list[dict]:
+        return self._request("GET", "/documents", params={"select": "*", "order": "upload_date.desc"}).json()
+
+    def clear(self):
+        self._request("DELETE", "/chunk", params={"id": "gte.0"})
+        self._request("DELETE", "/documents", params={"id": "gte.0"})
+
+class SQLiteBackend:
+    """Same tables as supabase_schema.sql, in a local SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL, "
+                "upload_date TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')), "
+                "total_chunks INTEGER NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS chunk ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "document_id INTEGER REFERENCES documents(id) ON DELETE CASCADE, "
+                "chunk_index INTEGER NOT NULL, content TEXT NOT NULL, embedding_id TEXT NOT NULL);"
+            )
+            self._local.conn = conn
+        return conn
+
+    def insert_document(self, filename: str, total_chunks: int) -> dict:
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("INSERT INTO documents (filename, total_chunks) VALUES (?, ?)", (filename, total_chunks))
+        return dict(conn.execute("SELECT * FROM documents WHERE id = ?", (cursor.lastrowid,)).fetchone())
 
-_supabase = None
+    def update_document(self, document_id, fields: dict) -> list[dict]:
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"UPDATE documents SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                (*fields.values(), document_id),
+            )
+        return [dict(row) for row in conn.execute("SELECT * FROM documents WHERE id = ?", (document_id,))]
 
-def get_supabase() -> Client:
-    global _supabase
-    if _supabase is None:
-        _supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
-    return _supabase
+    def insert_chunks(self, rows: list[dict]):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chunk (document_id, chunk_index, content, embedding_id) "
+                "VALUES (:document_id, :chunk_index, :content, :embedding_id)",
+                rows,
+            )
+
+    def delete_document(self, document_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chunk WHERE document_id = ?", (document_id,))
+            conn.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def list_documents(self) -> list[dict]:
+        rows = self._conn().execute("SELECT * FROM documents ORDER BY upload_date DESC, id DESC")
+        return [dict(row) for row in rows]
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM chunk")
+            conn.execute("DELETE FROM documents")
+
+_backend = None
+_backend_lock = threading.Lock()
+# The library page polls the document list; uploads and deletions invalidate it
+_documents_cache = LRUCache(1, ttl=settings.DOCUMENT_LIST_CACHE_TTL)
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if settings.DATABASE_BACKEND == "sqlite":
+                _backend = SQLiteBackend(settings.DATABASE_SQLITE_PATH)
+            else:
+                _backend = SupabaseBackend(settings.SUPABASE_URL, settings.SUPABASE_KEY, page_size=settings.DATABASE_PAGE_SIZE)
+    return _backend
 
 def insert_document_record(filename: str, total_chunks: int):
-    supabase = get_supabase()
-    data = {"filename": filename, "total_chunks": total_chunks}
-    response = supabase.table("documents").insert(data).execute()
-    return response.data[0]
+    record = get_backend().insert_document(filename, total_chunks)
+    _documents_cache.clear()
+    return record
+
+def update_document_record(document_id, fields: dict):
+    records = get_backend().update_document(document_id, fields)
+    _documents_cache.clear()
+    return records
 
 def insert_chunks_records(chunks_data: list[dict]):
-    supabase = get_supabase()
-    response = supabase.table("chunk").insert(chunks_data).execute()
-    return response.data
+    get_backend().insert_chunks(chunks_data)
+
+def delete_document(document_id):
+    """Removes a document row and its chunk rows."""
+    get_backend().delete_document(document_id)
+    _documents_cache.clear()
+
+def clear_records():
+    """Removes every document and chunk row (database rebuild)."""
+    get_backend().clear()
+    _documents_cache.clear()
+
+def list_documents() -> list[dict]:
+    documents = _documents_cache.get("documents")
+    if documents is None:
+        documents = get_backend().list_documents()
+        _documents_cache.set("documents", documents)
+    return documents
+
+async def insert_document_record_async(filename: str, total_chunks: int):
+    return await run_blocking(insert_document_record, filename, total_chunks)
+
+async def update_document_record_async(document_id, fields: dict):
+    return await run_blocking(update_document_record, document_id, fields)
+
+async def insert_chunks_records_async(chunks_data: list[dict]):
+    return await run_blocking(insert_chunks_records, chunks_data)
+
+async def list_documents_async() -> list[dict]:
+    return await run_blocking(list_documents)
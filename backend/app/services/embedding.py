@@ -1,18 +1,86 @@
+import re
+import threading
+import unicodedata
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from app.core.config import settings
+from app.core.executor import run_blocking
+from app.core.metrics import span
+from app.services.cache import LRUCache
+from app.services.embedding_store import EmbeddingStore
+from app.services.embedding_batcher import EmbeddingBatcher
 
 _gemini_configured = False
 
+# Query embeddings: in-process LRU in front of an optional persistent store
+_query_cache = LRUCache(settings.QUERY_EMBEDDING_CACHE_SIZE)
+_embedding_store = EmbeddingStore(settings.EMBEDDING_CACHE_PATH) if settings.EMBEDDING_CACHE_PATH else None
+_query_stats = {"persistent_hits": 0, "api_calls": 0, "embedded": 0}
+_stats_lock = threading.Lock()
+
 def configure_gemini():
     global _gemini_configured
     if not _gemini_configured:
         genai.configure(api_key=settings.GEMINI_API_KEY)
         _gemini_configured = True
 
+def normalize_query(text: str) -> str:
+    """Canonical form used both as cache key and as the text sent for embedding."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+def embed_queries(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds query variations with a single embed_content call for all cache misses.
+    Lookups go through the in-process LRU, then the persistent store.
+    """
+    task_type = "retrieval_query"
+    model = settings.GEMINI_EMBEDDING_MODEL
+    normalized = [normalize_query(t) for t in texts]
+    keys = [EmbeddingStore.key(model, task_type, t) for t in normalized]
+
+    vectors = {}
+    for key in keys:
+        vector = _query_cache.get(key)
+        if vector is not None:
+            vectors[key] = vector
+    missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+
+    if missing and _embedding_store is not None:
+        stored = _embedding_store.get_many(missing)
+        with _stats_lock:
+            _query_stats["persistent_hits"] += len(stored)
+        for key, vector in stored.items():
+            vectors[key] = vector
+            _query_cache.set(key, vector)
+        missing = [key for key in missing if key not in stored]
+
+    if missing:
+        configure_gemini()
+        to_embed = [normalized[keys.index(key)] for key in missing]
+        with span("gemini_embed_query"):
+            result = genai.embed_content(model=model, content=to_embed, task_type=task_type)
+        new_vectors = dict(zip(missing, result['embedding']))
+        with _stats_lock:
+            _query_stats["api_calls"] += 1
+            _query_stats["embedded"] += len(missing)
+        for key, vector in new_vectors.items():
+            vectors[key] = vector
+            _query_cache.set(key, vector)
+        if _embedding_store is not None:
+            _embedding_store.put_many(new_vectors)
+
+    return [vectors[key] for key in keys]
+
+def get_query_embedding_stats() -> dict:
+    with _stats_lock:
+        return {**_query_cache.stats(), **_query_stats, "persistent": _embedding_store is not None}
+
 def get_embedding(text: str, is_query: bool = False) -> list[float]:
+    if is_query:
+        return embed_queries([text])[0]
     configure_gemini()
     # Use different task_type for queries vs documents
-    task_type = "retrieval_query" if is_query else "retrieval_document"
+    task_type = "retrieval_document"
     result = genai.embed_content(
         model=settings.GEMINI_EMBEDDING_MODEL,
         content=text,
@@ -20,13 +88,69 @@ def get_embedding(text: str, is_query: bool = False) -> list[float]:
     )
     return result['embedding']
 
-def get_batch_embeddings(texts: list[str]) -> list[list[float]]:
+def _embed_documents(texts: list[str]) -> list[list[float]]:
+    """One embed_content request for a batch of document chunks."""
     configure_gemini()
-    # Gemini API supports batch embedding, but for simplicity and error handling we might loop or use batch if supported well.
-    # embed_content supports a list of content.
-    result = genai.embed_content(
-        model=settings.GEMINI_EMBEDDING_MODEL,
-        content=texts,
-        task_type="retrieval_document"
-    )
+    with span("gemini_embed_documents"):
+        result = genai.embed_content(
+            model=settings.GEMINI_EMBEDDING_MODEL,
+            content=texts,
+            task_type="retrieval_document"
+        )
     return result['embedding']
+
+# Document chunks go through size-capped, rate-limited, retried parallel requests
+_document_batcher = EmbeddingBatcher(
+    _embed_documents,
+    max_batch_size=settings.EMBED_BATCH_SIZE,
+    max_batch_chars=settings.EMBED_BATCH_MAX_CHARS,
+    workers=settings.EMBED_WORKERS,
+    requests_per_second=settings.EMBED_REQUESTS_PER_MINUTE / 60,
+    max_retries=settings.EMBED_MAX_RETRIES,
+    retry_on=(
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    ),
+)
+
+_document_stats = {"chunks": 0, "duplicates": 0, "persistent_hits": 0, "embedded": 0}
+
+def get_batch_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds document chunks. Identical texts in the batch are embedded once, and texts
+    already in the persistent store (same model, task type and text) are not re-embedded.
+    """
+    task_type = "retrieval_document"
+    model = settings.GEMINI_EMBEDDING_MODEL
+    keys = [EmbeddingStore.key(model, task_type, t) for t in texts]
+    unique = dict(zip(keys, texts))
+
+    vectors = _embedding_store.get_many(list(unique)) if _embedding_store is not None else {}
+    missing = [key for key in unique if key not in vectors]
+    if missing:
+        new_vectors = dict(zip(missing, _document_batcher.embed([unique[key] for key in missing])))
+        vectors.update(new_vectors)
+        if _embedding_store is not None:
+            _embedding_store.put_many(new_vectors)
+
+    with _stats_lock:
+        _document_stats["chunks"] += len(texts)
+        _document_stats["duplicates"] += len(texts) - len(unique)
+        _document_stats["persistent_hits"] += len(unique) - len(missing)
+        _document_stats["embedded"] += len(missing)
+    return [vectors[key] for key in keys]
+
+def get_document_embedding_stats() -> dict:
+    with _stats_lock:
+        return {**_document_stats, "requests": _document_batcher.stats()}
+
+async def get_embedding_async(text: str, is_query: bool = False) -> list[float]:
+    return await run_blocking(get_embedding, text, is_query)
+
+async def get_batch_embeddings_async(texts: list[str]) -> list[list[float]]:
+    return await run_blocking(get_batch_embeddings, texts)
+
+async def embed_queries_async(texts: list[str]) -> list[list[float]]:
+    return await run_blocking(embed_queries, texts)
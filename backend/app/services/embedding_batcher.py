@@ -0,0 +1,120 @@
+"""
+Batched, rate-limited and retried calls to an embedding function.
+
+Texts are split into batches bounded by count and total characters, sent through a
+small worker pool and reassembled in input order. Every request first takes a token
+from a shared token bucket; transient failures are retried with jittered backoff.
+The embedding function is injected, so the batcher can run against a local stand-in.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Type
+from app.core.metrics import RETRIES
+
+class TokenBucket:
+    """Thread-safe token bucket; rate is in tokens per second (0 disables limiting)."""
+
+    def __init__(self, rate: float, capacity: float = None, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+class EmbeddingBatcher:
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]], max_batch_size: int = 100,
+                 max_batch_chars: int = 100000, workers: int = 4, requests_per_second: float = 0,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 30.0,
+                 retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+                 sleep: Callable[[float], None] = time.sleep):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_chars = max_batch_chars
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self._sleep = sleep
+        self._bucket = TokenBucket(requests_per_second, sleep=sleep)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+        self._stats = {"chunks": 0, "requests": 0, "retries": 0, "seconds": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def split(self, texts: List[str]) -> List[Tuple[int, int]]:
+        """[start, end) ranges of texts, each within the count and character limits (a longer text goes alone)."""
+        ranges = []
+        start = 0
+        chars = 0
+        for i, text in enumerate(texts):
+            if i > start and (i - start == self.max_batch_size or chars + len(text) > self.max_batch_chars):
+                ranges.append((start, i))
+                start = i
+                chars = 0
+            chars += len(text)
+        if start < len(texts):
+            ranges.append((start, len(texts)))
+        return ranges
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            with self._stats_lock:
+                self._stats["requests"] += 1
+            try:
+                vectors = self.embed_fn(batch)
+                if len(vectors) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+                return vectors
+            except self.retry_on as e:
+                if attempt == self.max_retries:
+                    raise
+                # Full jitter: spreads retries of concurrent workers after a shared rate-limit error
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"Embedding batch failed ({e}), retrying in {delay:.1f}s")
+                with self._stats_lock:
+                    self._stats["retries"] += 1
+                RETRIES.inc(service="embedding")
+                self._sleep(delay)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embeds texts, returning one vector per text in input order."""
+        started = time.perf_counter()
+        ranges = self.split(texts)
+        if len(ranges) <= 1:
+            results = [self._embed_batch(texts)] if texts else []
+        else:
+            futures = [self._executor.submit(self._embed_batch, texts[start:end]) for start, end in ranges]
+            try:
+                results = [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        with self._stats_lock:
+            self._stats["chunks"] += len(texts)
+            self._stats["seconds"] += time.perf_counter() - started
+        return [vector for batch in results for vector in batch]
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            seconds = self._stats["seconds"]
+            return {**self._stats, "chunks_per_second": self._stats["chunks"] / seconds if seconds else None}
@@ -1,89 +1,311 @@
+import asyncio
+import re
 import shutil
 import os
+import time
 import uuid
+from typing import Iterable, Iterator
 from fastapi import UploadFile, HTTPException
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from app.services.embedding import get_batch_embeddings
-from app.services.vector_store import add_documents_to_chroma
-from app.services.database import insert_document_record, insert_chunks_records
+# iter_chunks drives the splitter's internals: the version is pinned in requirements.txt
+from langchain_text_splitters.character import _split_text_with_regex
+from app.core.config import settings
+from app.core.executor import run_blocking, run_index_write
+from app.core.metrics import span
+from app.services.embedding import get_batch_embeddings_async
+from app.services.vector_store import add_documents_to_chroma, delete_document_vectors
+from app.services.database import delete_document, insert_document_record_async, insert_chunks_records_async, update_document_record_async
 
 UPLOAD_DIR = "data"
+# Uploads wait here, one directory per job, until their ingestion job has run;
+# an upload with the same name as a queued one must not replace its input
+STAGING_DIR = os.path.join(UPLOAD_DIR, "uploads")
 
-def save_uploaded_file(file: UploadFile) -> str:
-    if not file.filename.endswith(".txt"):
+def save_uploaded_file(file: UploadFile, job_id: str) -> str:
+    filename = os.path.basename(file.filename or "")
+    if not filename.endswith(".txt"):
         raise HTTPException(status_code=400, detail="Only .txt files are allowed")
     
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
+    job_dir = os.path.join(STAGING_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    file_path = os.path.join(job_dir, filename)
     
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
         
     return file_path
 
+async def save_uploaded_file_async(file: UploadFile, job_id: str) -> str:
+    return await run_blocking(save_uploaded_file, file, job_id)
+
+def release_uploaded_file(file_path: str, keep: bool) -> str:
+    """
+    Moves a processed upload from its staging directory to UPLOAD_DIR (where
+    rebuild_database finds it), or deletes it; returns its final path.
+    """
+    job_dir = os.path.dirname(file_path)
+    if os.path.dirname(job_dir) != STAGING_DIR:
+        # Jobs queued before uploads were staged read their file from UPLOAD_DIR
+        return file_path
+    final_path = os.path.join(UPLOAD_DIR, os.path.basename(file_path))
+    if keep:
+        os.replace(file_path, final_path)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return final_path
+
 def read_file_content(file_path: str) -> str:
     with open(file_path, "r", encoding="utf-8") as f:
         return f.read()
 
+def read_file_windows(file_path: str, window_size: int = None) -> Iterator[str]:
+    """Yields the file content in windows of at most window_size characters."""
+    window_size = window_size or settings.INGEST_READ_WINDOW
+    with open(file_path, "r", encoding="utf-8") as f:
+        while True:
+            window = f.read(window_size)
+            if not window:
+                return
+            yield window
+
+# Built once: the splitter holds no per-document state
+CHUNK_SIZE = 512  # Optimized for better context recall
+CHUNK_OVERLAP = 150  # Increased overlap to prevent context loss
+_SEPARATORS = ["\n\n", "\n", "。", ".", " ", ""]
+# Longest paragraph held in memory by iter_chunks before it is cut
+MAX_PARAGRAPH = 100 * CHUNK_SIZE
+_text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=_SEPARATORS,
+    length_function=len,
+)
+
 def chunk_text(text: str) -> list[str]:
     """
     Split text into chunks using RecursiveCharacterTextSplitter.
     Optimized for Arabic text with smaller, more focused chunks.
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=512,  # Optimized for better context recall
-        chunk_overlap=150,  # Increased overlap to prevent context loss
-        separators=["\n\n", "\n", "。", ".", " ", ""],
-        length_function=len,
-    )
-    chunks = text_splitter.split_text(text)
-    return chunks
+    return _text_splitter.split_text(text)
+
+def _merged_chunks(pieces: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Chunks merged from consecutive paragraphs that no later paragraph can change, and
+    the paragraphs of the chunk still being assembled. Mirrors the splitter's greedy
+    merge (separators are kept in the pieces, so they are joined with "").
+    """
+    start = total = 0
+    for i, piece in enumerate(pieces):
+        if total + len(piece) > CHUNK_SIZE and i > start:
+            # The splitter emits a chunk here and drops pieces down to the overlap
+            while total > CHUNK_OVERLAP or (total + len(piece) > CHUNK_SIZE and total > 0):
+                total -= len(pieces[start])
+                start += 1
+        total += len(piece)
+    pending = pieces[start:]
+    chunks = _text_splitter._merge_splits(pieces, "")
+    # Merging the pending pieces alone gives the last chunk, which is not final yet
+    return chunks[:len(chunks) - len(_text_splitter._merge_splits(pending, ""))], pending
+
+def _chunk_paragraphs(paragraphs: list[str], pieces: list[str], last: bool) -> Iterator[str]:
+    """The splitter's top-level loop over complete paragraphs; pieces carries the chunk being assembled."""
+    for paragraph in paragraphs:
+        if len(paragraph) < CHUNK_SIZE:
+            pieces.append(paragraph)
+            continue
+        if pieces:
+            yield from _text_splitter._merge_splits(pieces, "")
+            pieces.clear()
+        yield from _text_splitter._split_text(paragraph, _SEPARATORS[1:])
+    if last:
+        yield from _text_splitter._merge_splits(pieces, "")
+        pieces.clear()
+    else:
+        chunks, pending = _merged_chunks(pieces)
+        yield from chunks
+        pieces[:] = pending
+
+def _cut_position(paragraph: str) -> int:
+    """Where to cut an over-long paragraph: at its last line break, sentence end or space past MAX_PARAGRAPH / 2."""
+    for separator in _SEPARATORS[1:-1]:
+        position = paragraph.rfind(separator, MAX_PARAGRAPH // 2)
+        if position > 0:
+            return position
+    return MAX_PARAGRAPH
+
+def iter_chunks(windows: Iterable[str]) -> Iterator[str]:
+    """
+    Splits a stream of text windows into the same chunks as chunk_text on the whole text.
+    The splitter cuts a text with paragraph breaks at every break, then merges the
+    paragraphs greedily; the paragraph still being read and the paragraphs of the
+    chunk being assembled are carried to the next window.
+    A paragraph longer than MAX_PARAGRAPH characters (or a text without paragraph
+    breaks) is cut at a line break, sentence end or space and split piece by piece,
+    so memory stays under MAX_PARAGRAPH plus one window; the chunks around such a
+    cut can differ from chunk_text.
+    """
+    separator = _SEPARATORS[0]
+    buffer = ""
+    pieces: list[str] = []
+    for window in windows:
+        # Only the new text can hold a new paragraph break (one may straddle the windows)
+        scan_from = max(0, len(buffer) - len(separator) + 1)
+        buffer += window
+        if buffer.find(separator, scan_from) >= 0:
+            paragraphs = _split_text_with_regex(buffer, re.escape(separator), keep_separator=True)
+            # The last paragraph may continue in the next window
+            buffer = paragraphs.pop()
+            yield from _chunk_paragraphs(paragraphs, pieces, last=False)
+        while len(buffer) > MAX_PARAGRAPH:
+            position = _cut_position(buffer)
+            yield from _chunk_paragraphs([buffer[:position]], pieces, last=False)
+            buffer = buffer[position:]
+    yield from _chunk_paragraphs([buffer] if buffer else [], pieces, last=True)
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def build_chunk_records(doc_id, filename: str, chunks: list[str], first_index: int = 0):
+    """Chroma ids, Chroma/BM25 metadatas and Supabase chunk rows for consecutive chunks of a document."""
+    chroma_ids = [str(uuid.uuid4()) for _ in chunks]
+    # chunk_id is shared by Chroma and the BM25 index so retrieval results can be fused by id
+    metadatas = [
+        {"document_id": doc_id, "chunk_index": first_index + i, "filename": filename, "chunk_id": chroma_ids[i]}
+        for i in range(len(chunks))
+    ]
+    supabase_chunks_data = [
+        {
+            "document_id": doc_id,
+            "chunk_index": first_index + i,
+            "content": chunk,
+            "embedding_id": chroma_ids[i]
+        }
+        for i, chunk in enumerate(chunks)
+    ]
+    return chroma_ids, metadatas, supabase_chunks_data
+
+def write_index_batch(ids: list[str], chunks: list[str], metadatas: list[dict], embeddings: list[list[float]]):
+    """Index mutations for one batch; always called on the single index writer thread."""
+    from app.services.bm25_service import bm25_service
+    with span("index_write_vectors"):
+        add_documents_to_chroma(ids=ids, documents=chunks, metadatas=metadatas, embeddings=embeddings)
+    with span("index_write_bm25"):
+        bm25_service.add_documents(chunks, metadatas)
+
+def remove_index_document(doc_id):
+    """Index mutations removing one document's chunks; always called on the single index writer thread."""
+    from app.services.bm25_service import bm25_service
+    delete_document_vectors(doc_id)
+    bm25_service.delete_document(doc_id)
+
+async def discard_document_async(doc_id):
+    """Removes a partly ingested document from the indexes and the database."""
+    await run_index_write(remove_index_document, doc_id)
+    await run_blocking(delete_document, doc_id)
 
 def process_document(file_path: str):
-    content = read_file_content(file_path)
-    chunks = chunk_text(content)
+    """Synchronous entry point for scripts (rebuild_database); the API awaits process_document_async."""
+    return asyncio.run(process_document_async(file_path))
+
+async def process_document_async(file_path: str, on_progress=None):
+    """
+    Streams a document through read -> split -> embed -> store, one batch of chunks at a time.
+    Embedding runs ahead of storage by at most INGEST_QUEUE_SIZE batches, so peak memory
+    does not depend on the file size.
+    on_progress, if given, is awaited with (stage, details) as the document advances.
+    If a batch fails, the chunks stored so far are removed again before the error is raised.
+    """
+    async def report(stage: str, **details):
+        if on_progress is not None:
+            await on_progress(stage, details)
+
     filename = os.path.basename(file_path)
     
-    # 1. Store Document in Supabase
-    doc_record = insert_document_record(filename, len(chunks))
+    # 1. Store Document in Supabase (total_chunks is updated once the whole file is stored)
+    doc_record = await insert_document_record_async(filename, 0)
     doc_id = doc_record['id']
     
-    # 2. Generate Embeddings
-    embeddings = get_batch_embeddings(chunks)
+    total_chars = 0
+    bytes_read = 0
+    file_size = os.path.getsize(file_path)
+    timings = {"embedding": 0.0, "writing": 0.0}
+    def counted_windows():
+        nonlocal total_chars, bytes_read
+        for window in read_file_windows(file_path):
+            total_chars += len(window)
+            bytes_read += len(window.encode("utf-8"))
+            yield window
     
-    # 3. Prepare Data for Chroma and Supabase
-    chroma_ids = [str(uuid.uuid4()) for _ in chunks]
-    metadatas = [{"document_id": doc_id, "chunk_index": i, "filename": filename} for i in range(len(chunks))]
+    await report("embedding", chunks=0, bytes_read=0, file_size=file_size)
     
-    supabase_chunks_data = []
-    for i, chunk in enumerate(chunks):
-        supabase_chunks_data.append({
-            "document_id": doc_id,
-            "chunk_index": i,
-            "content": chunk,
-            "embedding_id": chroma_ids[i]
-        })
-        
-    # 4. Store in ChromaDB
-    add_documents_to_chroma(ids=chroma_ids, documents=chunks, metadatas=metadatas, embeddings=embeddings)
-    
-    # 5. Store Chunks in Supabase
-    insert_chunks_records(supabase_chunks_data)
+    queue = asyncio.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
     
-    # 6. Update BM25 Index
-    # Note: This is inefficient for large datasets as it rebuilds the index every time.
-    # For production, consider a more incremental approach or periodic rebuilds.
-    from app.services.bm25_service import bm25_service
+    async def produce():
+        # 2. Read, split and embed batch by batch
+        try:
+            batches = iter_batches(iter_chunks(counted_windows()), settings.INGEST_BATCH_SIZE)
+            while True:
+                batch = await run_blocking(next, batches, None)
+                if batch is None:
+                    break
+                started = time.perf_counter()
+                embeddings = await get_batch_embeddings_async(batch)
+                timings["embedding"] += time.perf_counter() - started
+                # Blocks while the writer is INGEST_QUEUE_SIZE batches behind
+                await queue.put((batch, embeddings))
+            await queue.put(None)
+        except Exception:
+            await queue.put(None)
+            raise
     
-    # We need to add the new chunks to the existing corpus and rebuild
-    current_corpus = bm25_service.corpus + chunks
-    current_metadatas = bm25_service.metadatas + metadatas
-    bm25_service.build_index(current_corpus, current_metadatas)
+    producer = asyncio.create_task(produce())
+    total_chunks = 0
+    try:
+        while (item := await queue.get()) is not None:
+            chunks, embeddings = item
+            # 3. Prepare Data for Chroma and Supabase
+            chroma_ids, metadatas, supabase_chunks_data = build_chunk_records(doc_id, filename, chunks, total_chunks)
+
+            # 4. Store in ChromaDB and 6. Update BM25 Index on the single index writer,
+            # 5. Store Chunks in Supabase concurrently;
+            # each batch is written as a small BM25 segment, merged in the background.
+            started = time.perf_counter()
+            # Both writes finish before a failure is raised, so the cleanup below sees all of them
+            for outcome in await asyncio.gather(
+                run_index_write(write_index_batch, chroma_ids, chunks, metadatas, embeddings),
+                insert_chunks_records_async(supabase_chunks_data),
+                return_exceptions=True,
+            ):
+                if isinstance(outcome, BaseException):
+                    raise outcome
+            timings["writing"] += time.perf_counter() - started
+            total_chunks += len(chunks)
+            await report("embedding", chunks=total_chunks, bytes_read=bytes_read, file_size=file_size)
+        await producer
+        await update_document_record_async(doc_id, {"total_chunks": total_chunks})
+    except Exception:
+        # The batches stored so far would otherwise be retrieved for a document that failed
+        try:
+            await discard_document_async(doc_id)
+        except Exception as e:
+            print(f"⚠️  Could not remove the chunks of failed document {doc_id}: {e}")
+        raise
+    finally:
+        producer.cancel()
     
     return {
         "file_path": file_path,
-        "total_chars": len(content),
-        "total_chunks": len(chunks),
+        "total_chars": total_chars,
+        "total_chunks": total_chunks,
         "document_id": doc_id,
-        "status": "processed_and_stored"
+        "status": "processed_and_stored",
+        "timings": timings
     }
@@ -0,0 +1,198 @@
+"""
+Background ingestion jobs.
+
+Uploads are recorded as jobs in SQLite and processed by a few worker tasks on the
+API event loop; /api/jobs/{id} reads the stored state. Every uvicorn worker shares the
+job table: a job is claimed atomically (queued -> running) before it runs, with the id
+of the claiming process, which refreshes a heartbeat on its running jobs. Queued jobs
+survive a restart and are picked up again; running jobs whose heartbeat stopped (the
+process is gone) are marked as failed, since their partial writes cannot be resumed.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from typing import Optional
+from app.core.config import settings
+from app.core.executor import run_blocking
+
+class JobStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, filename TEXT NOT NULL, file_path TEXT NOT NULL, status TEXT NOT NULL, "
+                "stage TEXT, progress TEXT, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, worker_id TEXT, heartbeat_at REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("worker_id", "TEXT"), ("heartbeat_at", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            self._local.conn = conn
+        return conn
+
+    def create(self, file_path: str, job_id: Optional[str] = None) -> dict:
+        job_id = job_id or new_job_id()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO jobs (id, filename, file_path, status, stage, created_at) VALUES (?, ?, ?, 'queued', 'queued', ?)",
+                (job_id, os.path.basename(file_path), file_path, time.time()),
+            )
+        return self.get(job_id)
+
+    def update(self, job_id: str, **fields):
+        for name in ("progress", "result"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for name in ("progress", "result"):
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
+
+    def claim(self, job_id: str) -> bool:
+        """Marks a queued job as running in this process; False if another worker claimed it first."""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', stage = 'reading', started_at = ?, worker_id = ?, heartbeat_at = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (now, WORKER_ID, now, job_id),
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self):
+        """Records that the jobs running in this process are still alive."""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker_id = ?",
+                (time.time(), WORKER_ID),
+            )
+
+    def fail_stale(self) -> int:
+        """
+        Marks running jobs whose heartbeat stopped as failed; their process is gone. Jobs
+        of other live workers keep their heartbeat fresh and are left alone.
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted by a server restart', finished_at = ? "
+                "WHERE status = 'running' AND worker_id IS NOT ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (now, WORKER_ID, now - settings.INGEST_JOB_STALE_AFTER),
+            )
+        return cursor.rowcount
+
+    def recover(self) -> list[str]:
+        """Marks the jobs of workers that are gone as failed and returns the ids of queued jobs, oldest first."""
+        self.fail_stale()
+        conn = self._conn()
+        return [row[0] for row in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at")]
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+# Identifies this process in the job table; unlike a pid, it is never reused
+WORKER_ID = uuid.uuid4().hex
+
+job_store = JobStore(settings.JOBS_DB_PATH)
+_queue: Optional[asyncio.Queue] = None
+_workers: list[asyncio.Task] = []
+
+async def _run_job(job_id: str):
+    from app.services.ingestion import process_document_async, release_uploaded_file
+    # Queued jobs are re-queued by every worker that starts: only the one that claims it runs it
+    if not await run_blocking(job_store.claim, job_id):
+        return
+    job = await run_blocking(job_store.get, job_id)
+    started = job["started_at"]
+
+    async def on_progress(stage: str, details: dict):
+        if details.get("file_size"):
+            details["fraction"] = round(details["bytes_read"] / details["file_size"], 4)
+        await run_blocking(job_store.update, job_id, stage=stage, progress=details)
+
+    try:
+        result = await process_document_async(job["file_path"], on_progress=on_progress)
+        result["file_path"] = await run_blocking(release_uploaded_file, job["file_path"], True)
+        result["timings"]["queued"] = started - job["created_at"]
+        result["timings"]["total"] = time.time() - started
+        await run_blocking(job_store.update, job_id, status="done", stage="done", result=result, finished_at=time.time())
+    except Exception as e:
+        print(f"❌ Ingestion job {job_id} failed: {e}")
+        traceback.print_exc()
+        await run_blocking(job_store.update, job_id, status="failed", error=str(e), finished_at=time.time())
+        await run_blocking(release_uploaded_file, job["file_path"], False)
+
+async def _worker():
+    while True:
+        job_id = await _queue.get()
+        try:
+            await _run_job(job_id)
+        finally:
+            _queue.task_done()
+
+async def _heartbeat():
+    """Keeps this process's running jobs alive, and fails those of workers that died since startup."""
+    while True:
+        await asyncio.sleep(settings.INGEST_JOB_HEARTBEAT)
+        try:
+            await run_blocking(job_store.heartbeat)
+            await run_blocking(job_store.fail_stale)
+        except sqlite3.Error as e:
+            print(f"⚠️  Job heartbeat failed: {e}")
+
+async def start_workers():
+    """Starts the ingestion workers and re-queues the jobs left from a previous run."""
+    global _queue
+    _queue = asyncio.Queue()
+    for job_id in await run_blocking(job_store.recover):
+        _queue.put_nowait(job_id)
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(settings.INGEST_JOB_WORKERS))
+    _workers.append(asyncio.create_task(_heartbeat()))
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+async def submit(file_path: str, job_id: Optional[str] = None) -> dict:
+    """Records an ingestion job for an upload saved under job_id and queues it."""
+    if _queue is None:
+        raise RuntimeError("Ingestion workers are not running: call jobs.start_workers() on application startup")
+    job = await run_blocking(job_store.create, file_path, job_id)
+    _queue.put_nowait(job["id"])
+    return job
+
+async def get_job(job_id: str) -> Optional[dict]:
+    return await run_blocking(job_store.get, job_id)
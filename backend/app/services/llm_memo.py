@@ -0,0 +1,112 @@
+"""
+Disk-backed memo of deterministic LLM sub-calls (query expansion, re-ranking).
+
+Raw completions are stored in SQLite keyed by (namespace, model, prompt hash).
+Entries can carry a tag (the corpus generation for re-ranking) and are only
+served while the tag matches. Expired entries are purged and the table is
+trimmed least-recently-used first.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+from app.core.config import settings
+from app.core.metrics import record_llm_usage, span
+
+_EVICT_EVERY = 100  # puts between eviction passes
+
+class LLMMemo:
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS memo ("
+                "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, tag TEXT, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS memo_last_used ON memo (last_used)")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(namespace: str, model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{namespace}\0{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, namespace: str, model: str, prompt: str, tag: str = None) -> Optional[str]:
+        key = self.key(namespace, model, prompt)
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value, tag, created_at FROM memo WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] != tag or now - row[2] > self.ttl:
+            with self._lock:
+                self.misses[namespace] += 1
+            return None
+        with conn:
+            conn.execute("UPDATE memo SET last_used = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits[namespace] += 1
+        return row[0]
+
+    def put(self, namespace: str, model: str, prompt: str, value: str, tag: str = None):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO memo (key, namespace, tag, value, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.key(namespace, model, prompt), namespace, tag, value, now, now),
+            )
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % _EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM memo WHERE created_at < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM memo WHERE key IN (SELECT key FROM memo ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": dict(self.hits), "misses": dict(self.misses)}
+
+llm_memo = LLMMemo(settings.LLM_MEMO_PATH, settings.LLM_MEMO_MAX_ENTRIES, settings.LLM_MEMO_TTL) if settings.LLM_MEMO_PATH else None
+
+def memoized_generate(model, prompt: str, namespace: str, tag: str = None,
+                      is_valid: Callable[[str], bool] = None) -> str:
+    """
+    Returns model.generate_content(prompt).text, served from the memo when possible.
+    Completions rejected by `is_valid` are returned but not stored.
+    """
+    model_name = settings.GEMINI_CHAT_MODEL
+    if llm_memo is not None:
+        cached = llm_memo.get(namespace, model_name, prompt, tag)
+        if cached is not None:
+            return cached
+    with span(f"gemini_{namespace}"):
+        response = model.generate_content(prompt)
+    record_llm_usage(namespace, response)
+    text = response.text
+    if llm_memo is not None and (is_valid is None or is_valid(text)):
+        llm_memo.put(namespace, model_name, prompt, text, tag)
+    return text
@@ -4,6 +4,9 @@ Query expansion service to improve search for short queries
 import google.generativeai as genai
 from app.core.config import settings
 from app.services.embedding import configure_gemini
+from app.core.executor import run_blocking
+from app.core.metrics import FALLBACKS, span
+from app.services.llm_memo import memoized_generate
 
 def expand_query(query: str) -> list[str]:
     """
@@ -35,8 +38,9 @@ def expand_query(query: str) -> list[str]:
 """
     
     try:
-        response = model.generate_content(prompt)
-        lines = response.text.strip().split('\n')
+        with span("expansion"):
+            text = memoized_generate(model, prompt, "expansion")
+        lines = text.strip().split('\n')
         
         # Extract queries (remove numbering and empty lines)
         expanded = [query]  # Always include original
@@ -52,4 +56,8 @@ def expand_query(query: str) -> list[str]:
         
     except Exception as e:
         print(f"Query expansion error: {e}")
+        FALLBACKS.inc(stage="expansion")
         return [query]  # Fallback to original query only
+
+async def expand_query_async(query: str) -> list[str]:
+    return await run_blocking(expand_query, query)
@@ -1,10 +1,32 @@
+import asyncio
+import re
+import threading
+from typing import Optional
+import numpy as np
 import google.generativeai as genai
 from app.core.config import settings
-from app.services.embedding import get_embedding
-from app.services.vector_store import query_chroma
+from app.core.deadline import Deadline, DeadlineExceeded, within
+from app.core.executor import run_blocking
+from app.core.metrics import CONTEXT_TOKENS, FALLBACKS, record_llm_usage, span
+from app.services.embedding import get_embedding_async, embed_queries_async
+from app.services.vector_store import query_chroma_async, query_chroma_many_async
+from app.services.answer_cache import answer_cache
+from app.services.bm25_index import FILTER_FIELDS
+from app.services.context_assembly import assemble, estimate_tokens, truncate_to_tokens
+from app.services.tokenizer import analyzer
+from app.services.llm_memo import memoized_generate
 
 _gemini_configured = False
 
+# Reciprocal Rank Fusion constant and list weights
+RRF_K = 60
+VECTOR_WEIGHT = 0.3
+BM25_WEIGHT = 0.7
+
+# How often the local ranking was confident enough to skip the Gemini re-ranker
+_rerank_stats = {"local": 0, "llm": 0, "llm_overlap": 0.0}
+_rerank_stats_lock = threading.Lock()
+
 def configure_gemini():
     global _gemini_configured
     if not _gemini_configured:
@@ -33,36 +55,38 @@ def detect_language(text: str) -> str:
     
     return "en"  # Default to English
 
-def generate_answer(query: str, context: str, metadatas: list = None) -> str:
-    configure_gemini()
-    model = genai.GenerativeModel(settings.GEMINI_CHAT_MODEL)
-    
+# Language-specific instructions and formatting
+LANG_CONFIG = {
+    "ar": {
+        "instruction": "أجب بالعربية الفصحى",
+        "intro_label": "مقدمة",
+        "refs_label": "المراجع:",
+        "citations_label": "الاستشهادات الكاملة:"
+    },
+    "fr": {
+        "instruction": "Répondez en français",
+        "intro_label": "Introduction",
+        "refs_label": "Références:",
+        "citations_label": "Citations complètes:"
+    },
+    "en": {
+        "instruction": "Answer in English",
+        "intro_label": "Introduction",
+        "refs_label": "References:",
+        "citations_label": "Complete Citations:"
+    }
+}
+
+def source_title(metadata: dict, number: int) -> str:
+    # Use filename and clean it up (remove extension and special chars)
+    filename = (metadata or {}).get('filename', f'مصدر {number}')
+    return filename.replace('.txt', '').replace('-', ' ').replace('_', ' ')
+
+def build_answer_prompt(query: str, context: str, metadatas: list = None) -> str:
     # Detect query language
     lang = detect_language(query)
     
-    # Language-specific instructions and formatting
-    lang_config = {
-        "ar": {
-            "instruction": "أجب بالعربية الفصحى",
-            "intro_label": "مقدمة",
-            "refs_label": "المراجع:",
-            "citations_label": "الاستشهادات الكاملة:"
-        },
-        "fr": {
-            "instruction": "Répondez en français",
-            "intro_label": "Introduction",
-            "refs_label": "Références:",
-            "citations_label": "Citations complètes:"
-        },
-        "en": {
-            "instruction": "Answer in English",
-            "intro_label": "Introduction",
-            "refs_label": "References:",
-            "citations_label": "Complete Citations:"
-        }
-    }
-    
-    lang_settings = lang_config.get(lang, lang_config["ar"])
+    lang_settings = LANG_CONFIG.get(lang, LANG_CONFIG["ar"])
     lang_prompt = lang_settings["instruction"]
     refs_label = lang_settings["refs_label"]
     citations_label = lang_settings["citations_label"]
@@ -75,10 +99,7 @@ def generate_answer(query: str, context: str, metadatas: list = None) -> str:
     for i, chunk in enumerate(context_chunks, 1):
         # Extract title from metadata if available
         if metadatas and i <= len(metadatas):
-            # Use filename and clean it up (remove extension and special chars)
-            filename = metadatas[i-1].get('filename', f'مصدر {i}')
-            # Remove .txt extension and clean up the title
-            title = filename.replace('.txt', '').replace('-', ' ').replace('_', ' ')
+            title = source_title(metadatas[i-1], i)
             source_titles.append(title)
             numbered_context += f"\n\n### [مصدر {i}: {title}]\n{chunk}\n"
         else:
@@ -143,21 +164,96 @@ def generate_answer(query: str, context: str, metadatas: list = None) -> str:
 
 **الإجابة (التزم بالتنسيق المطلوب):**
 """
-    response = model.generate_content(prompt)
-    answer = response.text
-    
-    # Post-processing: فصل المراجع [N] عن الاقتباسات
-    import re
-    # البحث عن نمط: "نص" [رقم] واستبداله بـ "نص"\n[رقم]
-    # نبحث عن علامة تنصيص متبوعة بمسافة ثم [رقم]
-    answer = re.sub(r'(["\u201d\u201c»])\s*(\[\d+\])', r'\1\n\2', answer)
-    
-    return answer
+    return prompt
+
+# Post-processing: فصل المراجع [N] عن الاقتباسات
+# البحث عن نمط: "نص" [رقم] واستبداله بـ "نص"\n[رقم]
+# نبحث عن علامة تنصيص متبوعة بمسافة ثم [رقم]
+CITATION_PATTERN = re.compile(r'(["\u201d\u201c»])\s*(\[\d+\])')
+# Tail that may still turn into a citation match once more text arrives
+PARTIAL_CITATION_PATTERN = re.compile(r'["\u201d\u201c»]\s*(\[\d*)?$')
+
+def format_citations(answer: str) -> str:
+    return CITATION_PATTERN.sub(r'\1\n\2', answer)
+
+class CitationFormatter:
+    """Applies format_citations to a token stream, holding back only a possible partial match."""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str) -> str:
+        self._buffer = format_citations(self._buffer + text)
+        partial = PARTIAL_CITATION_PATTERN.search(self._buffer)
+        cut = partial.start() if partial else len(self._buffer)
+        ready, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        return ready
+
+    def flush(self) -> str:
+        rest, self._buffer = self._buffer, ""
+        return rest
+
+def generate_answer(query: str, context: str, metadatas: list = None) -> str:
+    configure_gemini()
+    model = genai.GenerativeModel(settings.GEMINI_CHAT_MODEL)
+    prompt = build_answer_prompt(query, context, metadatas)
+    with span("generation"):
+        response = model.generate_content(prompt)
+    record_llm_usage("answer", response)
+    return format_citations(response.text)
+
+async def generate_answer_async(query: str, context: str, metadatas: list = None) -> str:
+    return await run_blocking(generate_answer, query, context, metadatas)
+
+def extractive_answer(query: str, documents: list[str], metadatas: list[dict]) -> str:
+    """Answer used when generation misses the deadline: the start of the best source, quoted and cited."""
+    if not documents:
+        return ""
+    refs_label = LANG_CONFIG.get(detect_language(query), LANG_CONFIG["ar"])["refs_label"]
+    quote = truncate_to_tokens(documents[0].strip(), 120)
+    return f'"{quote}"\n[1]\n\n**{refs_label}**\n[1] {source_title(metadatas[0] if metadatas else None, 1)}'
+
+async def stream_answer_async(query: str, context: str, metadatas: list = None):
+    """Yields the answer text as Gemini streams it, with citation post-processing applied incrementally."""
+    configure_gemini()
+    model = genai.GenerativeModel(settings.GEMINI_CHAT_MODEL)
+    prompt = build_answer_prompt(query, context, metadatas)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def produce():
+        # The SDK's stream iterator is blocking: drain it on the executor and hand chunks to the loop
+        try:
+            chunk = None
+            with span("generation"):
+                for chunk in model.generate_content(prompt, stream=True):
+                    loop.call_soon_threadsafe(queue.put_nowait, ("text", chunk.text))
+            # The last chunk carries the usage of the whole response
+            record_llm_usage("answer", chunk)
+            loop.call_soon_threadsafe(queue.put_nowait, ("end", None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", e))
+
+    producer = asyncio.ensure_future(run_blocking(produce))
+    formatter = CitationFormatter()
+    while True:
+        kind, value = await queue.get()
+        if kind == "error":
+            raise value
+        if kind == "end":
+            break
+        text = formatter.feed(value)
+        if text:
+            yield text
+    rest = formatter.flush()
+    if rest:
+        yield rest
+    await producer
 
 def calculate_relevance_score(query: str, document: str) -> float:
     """Calculate relevance score using keyword overlap"""
-    query_words = set(query.lower().split())
-    doc_words = set(document.lower().split())
+    query_words = set(_terms(query))
+    doc_words = set(_terms(document))
     
     if len(query_words) == 0:
         return 0.0
@@ -168,6 +264,107 @@ def calculate_relevance_score(query: str, document: str) -> float:
     
     return len(intersection) / len(union) if len(union) > 0 else 0.0
 
+def _terms(text: str) -> list[str]:
+    # Same normalization, stop words and stemming as the BM25 index
+    return analyzer.analyze(text)
+
+def proximity_score(query_terms: set, doc_terms: list[str]) -> float:
+    """Matched query terms divided by the span of the smallest window containing all of them."""
+    positions = [(i, t) for i, t in enumerate(doc_terms) if t in query_terms]
+    wanted = len({t for _, t in positions})
+    if wanted == 0:
+        return 0.0
+    counts = {}
+    best = len(doc_terms)
+    start = 0
+    for end, (pos, term) in enumerate(positions):
+        counts[term] = counts.get(term, 0) + 1
+        while len(counts) == wanted:
+            best = min(best, pos - positions[start][0] + 1)
+            first = positions[start][1]
+            counts[first] -= 1
+            if counts[first] == 0:
+                del counts[first]
+            start += 1
+    return wanted / best
+
+def local_rerank(query: str, chunks: list[str], rrf_scores: list[float], bm25_scores: list[float]) -> list[tuple[int, float]]:
+    """
+    Scores candidates from the fusion score, the BM25 score, keyword overlap and term
+    proximity, each normalized by its maximum over the candidates.
+    Returns (candidate position, score) tuples sorted by relevance.
+    """
+    query_terms = set(_terms(query))
+    overlap = [calculate_relevance_score(query, chunk) for chunk in chunks]
+    proximity = [proximity_score(query_terms, _terms(chunk)) for chunk in chunks]
+
+    def normalized(values):
+        top = max(values, default=0)
+        return [v / top if top > 0 else 0.0 for v in values]
+
+    signals = zip(normalized(rrf_scores), normalized(bm25_scores), normalized(overlap), normalized(proximity))
+    scores = [0.4 * rrf + 0.25 * bm25 + 0.2 * ov + 0.15 * prox for rrf, bm25, ov, prox in signals]
+    return sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
+
+def ranking_margin(ranked: list[tuple[int, float]], top_k: int) -> float:
+    """Relative gap between the last kept and the first dropped candidate (1 when nothing is dropped)."""
+    if len(ranked) <= top_k or ranked[0][1] <= 0:
+        return 1.0
+    return (ranked[top_k - 1][1] - ranked[top_k][1]) / ranked[0][1]
+
+def get_rerank_stats() -> dict:
+    with _rerank_stats_lock:
+        llm = _rerank_stats["llm"]
+        return {
+            "local": _rerank_stats["local"],
+            "llm": llm,
+            # Mean share of the local top-k kept by Gemini when it was consulted (ranking drift)
+            "llm_agreement": _rerank_stats["llm_overlap"] / llm if llm else None,
+            "confidence_threshold": settings.LOCAL_RERANK_CONFIDENCE,
+        }
+
+async def rerank_async(query: str, chunks: list[str], rrf_scores: list[float], bm25_scores: list[float],
+                       top_k: int = 5, deadline: Optional[Deadline] = None) -> list[tuple[int, float]]:
+    """
+    Local re-ranking first; Gemini is only consulted when the local top-k is ambiguous.
+    Returns (candidate position, score) tuples, so identical chunk texts stay distinct.
+    With a deadline, Gemini must answer within DEADLINE_RERANK_SHARE of it, or the local ranking is kept.
+    """
+    with span("rerank_local"):
+        ranked = local_rerank(query, chunks, rrf_scores, bm25_scores)
+    local_top = ranked[:top_k]
+    if ranking_margin(ranked, top_k) >= settings.LOCAL_RERANK_CONFIDENCE:
+        with _rerank_stats_lock:
+            _rerank_stats["local"] += 1
+        return local_top
+
+    # Ambiguous: let Gemini decide, candidates in local order
+    candidates = ranked
+    if deadline is not None:
+        budget = deadline.remaining(settings.DEADLINE_RERANK_SHARE)
+        if budget < settings.DEADLINE_MIN_RERANK_SECONDS:
+            deadline.degrade("rerank", "skipped")
+            return local_top
+        if budget < 2 * settings.DEADLINE_MIN_RERANK_SECONDS:
+            # Short on time: a shorter prompt, the local top-k and two challengers only
+            candidates = ranked[:top_k + 2]
+            deadline.degrade("rerank", "truncated")
+    try:
+        reranked = await within(rerank_with_gemini_async(query, [chunks[i] for i, _ in candidates], top_k=top_k),
+                                deadline, settings.DEADLINE_RERANK_SHARE)
+    except DeadlineExceeded:
+        deadline.degrade("rerank", "timeout")
+        return local_top
+    positions = {}
+    for i, _ in ranked:
+        positions.setdefault(chunks[i], []).append(i)
+    reranked = [(positions[chunk].pop(0), score) for chunk, score in reranked]
+    kept = {i for i, _ in local_top}
+    with _rerank_stats_lock:
+        _rerank_stats["llm"] += 1
+        _rerank_stats["llm_overlap"] += sum(i in kept for i, _ in reranked) / max(len(local_top), 1)
+    return reranked
+
 def rerank_with_gemini(query: str, chunks: list[str], top_k: int = 3) -> list[tuple[str, float]]:
     """
     Use Gemini to re-rank chunks based on relevance to query.
@@ -206,13 +403,18 @@ def rerank_with_gemini(query: str, chunks: list[str], top_k: int = 3) -> list[tu
 """
     
     try:
-        response = model.generate_content(prompt)
+        # Same query + candidates on the same corpus generation give the same scores
+        from app.services.bm25_service import bm25_service
+        text = memoized_generate(
+            model, prompt, "rerank",
+            tag=str(bm25_service.generation),
+            is_valid=lambda t: re.search(r'\{[^}]+\}', t) is not None,
+        )
         # Extract JSON from response
         import json
-        import re
         
         # Find JSON in response
-        json_match = re.search(r'\{[^}]+\}', response.text)
+        json_match = re.search(r'\{[^}]+\}', text)
         if json_match:
             scores = json.loads(json_match.group())
             
@@ -235,92 +437,283 @@ def rerank_with_gemini(query: str, chunks: list[str], top_k: int = 3) -> list[tu
             
     except Exception as e:
         print(f"Re-ranking error: {e}")
+        FALLBACKS.inc(stage="rerank")
         # Fallback: return top chunks as-is
         return [(chunk, 0.5) for chunk in chunks[:top_k]]
 
-def rag_pipeline(query: str):
-    from app.services.query_expansion import expand_query
-    
-    # 1. Expand query for better coverage (activate for queries with 10 words or less)
-    queries = expand_query(query) if len(query.split()) <= 10 else [query]
-    print(f"Searching with {len(queries)} query variations...")
+async def rerank_with_gemini_async(query: str, chunks: list[str], top_k: int = 3) -> list[tuple[str, float]]:
+    return await run_blocking(rerank_with_gemini, query, chunks, top_k)
+
+def reciprocal_rank_fusion(rank_lists: list[list[int]], weights: list[float], num_candidates: int, k: int = RRF_K) -> np.ndarray:
+    """
+    Weighted RRF: rank_lists[j][r] is the candidate at rank r of list j.
+    Returns the fused score of every candidate.
+    """
+    lengths = [len(ranks) for ranks in rank_lists]
+    if sum(lengths) == 0:
+        return np.zeros(num_candidates)
+    candidates = np.concatenate([np.asarray(ranks, dtype=np.int64) for ranks in rank_lists])
+    ranks = np.concatenate([np.arange(1, n + 1) for n in lengths])
+    list_weights = np.repeat(np.asarray(weights, dtype=np.float64), lengths)
+    return np.bincount(candidates, weights=list_weights / (k + ranks), minlength=num_candidates)
+
+def normalize_filters(filters: Optional[dict]) -> Optional[dict]:
+    """
+    Validates query filters ({"filename": ..., "document_id": ...}, one value or a list each)
+    into {field: [sorted values]}. Raises ValueError on unknown fields or invalid values.
+    """
+    if not filters:
+        return None
+    normalized = {}
+    for field, values in filters.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unsupported filter field: {field}")
+        values = values if isinstance(values, list) else [values]
+        if not values:
+            raise ValueError(f"Empty filter: {field}")
+        try:
+            normalized[field] = sorted({int(v) if field == "document_id" else str(v) for v in values})
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {field} filter: {values}")
+    return normalized
+
+async def vector_search_async(query: str, n_results: int = 20, filters: Optional[dict] = None):
+    """Embeds one query variation and retrieves its nearest chunks from ChromaDB."""
+    # Embed Query with correct task_type
+    query_embedding = await get_embedding_async(query, is_query=True)
+    return await query_chroma_async(query_embedding, n_results=n_results, filters=filters)
+
+def rag_pipeline(query: str, filters: Optional[dict] = None):
+    """Synchronous entry point for scripts (evaluation, CLI); the API awaits rag_pipeline_async."""
+    return asyncio.run(rag_pipeline_async(query, filters))
+
+async def _cached_answer(query: str, filters: Optional[dict] = None, deadline: Optional[Deadline] = None):
+    """Looks the query up in the answer cache; returns (response or None, generation, query embedding)."""
+    from app.services.bm25_service import bm25_service
+    # Reading the generation may reload the index manifest from disk
+    generation = await run_blocking(lambda: bm25_service.generation)
+    query_embedding = None
+    if answer_cache.uses_embeddings:
+        # Near-duplicate lookup; the embedding is cached and reused by retrieval on a miss
+        try:
+            query_embedding = (await within(embed_queries_async([query]), deadline, settings.DEADLINE_RETRIEVAL_SHARE))[0]
+        except DeadlineExceeded:
+            deadline.degrade("answer_cache", "timeout")
+    with span("answer_cache"):
+        cached = answer_cache.get(query, generation, query_embedding, filters)
+    return cached, generation, query_embedding
+
+def assemble_context(query: str, documents: list[str], metadatas: list[dict]) -> tuple[list[str], list[dict], dict]:
+    """
+    Merges overlapping chunks into passages within CONTEXT_TOKEN_BUDGET (see context_assembly.py).
+    Also returns the estimated answer prompt tokens before and after assembly.
+    """
+    with span("context_assembly"):
+        passages, passage_metadatas = assemble(documents, metadatas, settings.CONTEXT_TOKEN_BUDGET)
+    prompt_tokens = {
+        "before": estimate_tokens(build_answer_prompt(query, "\n\n---\n\n".join(documents), metadatas)),
+        "after": estimate_tokens(build_answer_prompt(query, "\n\n---\n\n".join(passages), passage_metadatas)),
+    }
+    for kind, count in prompt_tokens.items():
+        CONTEXT_TOKENS.inc(count, kind=kind)
+    return passages, passage_metadatas, prompt_tokens
+
+async def rag_pipeline_async(query: str, filters: Optional[dict] = None, deadline: Optional[Deadline] = None):
+    """
+    filters ({"filename": [...], "document_id": [...]}, see normalize_filters) scopes retrieval.
+    With a deadline (app/core/deadline.py), optional stages are cut short to answer in time;
+    the response then lists them in "degraded", and is not cached if any was.
+    """
+    cached, generation, query_embedding = await _cached_answer(query, filters, deadline)
+    if cached is not None:
+        cached = {**cached, "query": query, "cached": True}
+        return cached if deadline is None else {**cached, "degraded": dict(deadline.degraded)}
+
+    with span("retrieval"):
+        final_documents, final_metadatas = await retrieve_context_async(query, filters, deadline)
+    # Sources are numbered after merging, so citations [N] match context[N-1]
+    final_documents, final_metadatas, prompt_tokens = assemble_context(query, final_documents, final_metadatas)
+    context = "\n\n---\n\n".join(final_documents)
     
-    # 2. Search with all query variations and collect results
-    all_documents = []
-    all_distances = []
-    all_metadatas = []
+    # 6. Generate Answer with metadata
+    try:
+        answer = await within(generate_answer_async(query, context, final_metadatas), deadline)
+    except DeadlineExceeded:
+        deadline.degrade("generation", "timeout")
+        answer = extractive_answer(query, final_documents, final_metadatas)
     
-    for q in queries:
-        # Embed Query with correct task_type
-        query_embedding = get_embedding(q, is_query=True)
-        
-        # Retrieve from ChromaDB
-        results = query_chroma(query_embedding, n_results=20)
-        
-        # Collect results
-        all_documents.extend(results['documents'][0])
-        all_distances.extend(results['distances'][0] if 'distances' in results else [0] * len(results['documents'][0]))
-        all_metadatas.extend(results.get('metadatas', [[]])[0] if results.get('metadatas') else [{}] * len(results['documents'][0]))
+    result = {
+        "query": query,
+        "context": final_documents,
+        "metadatas": final_metadatas,
+        "answer": answer,
+        "prompt_tokens": prompt_tokens
+    }
+    if deadline is not None:
+        result["degraded"] = dict(deadline.degraded)
+    if not result.get("degraded"):
+        answer_cache.put(query, generation, result, query_embedding, filters)
+    return result
+
+async def rag_pipeline_stream(query: str, filters: Optional[dict] = None, deadline: Optional[Deadline] = None):
+    """
+    Streaming variant of rag_pipeline_async: yields ("sources", {...}) once retrieval
+    and re-ranking are done, then ("token", text) events, then ("done", {"answer": ...}).
+    The deadline bounds the time to the sources event; the answer is streamed as it comes.
+    """
+    cached, generation, query_embedding = await _cached_answer(query, filters, deadline)
+    if cached is not None:
+        yield "sources", {"query": query, "context": cached["context"], "metadatas": cached["metadatas"], "cached": True}
+        yield "token", cached["answer"]
+        yield "done", {"answer": cached["answer"]}
+        return
+
+    with span("retrieval"):
+        final_documents, final_metadatas = await retrieve_context_async(query, filters, deadline)
+    final_documents, final_metadatas, prompt_tokens = assemble_context(query, final_documents, final_metadatas)
+    sources = {"query": query, "context": final_documents, "metadatas": final_metadatas, "prompt_tokens": prompt_tokens}
+    if deadline is not None:
+        sources["degraded"] = dict(deadline.degraded)
+    yield "sources", sources
     
-    # 3. Hybrid Search (Vector + BM25) with Reciprocal Rank Fusion (RRF)
+    context = "\n\n---\n\n".join(final_documents)
+    answer = ""
+    async for text in stream_answer_async(query, context, final_metadatas):
+        answer += text
+        yield "token", text
+    yield "done", {"answer": answer}
+    if deadline is not None and deadline.degraded:
+        return
+    answer_cache.put(query, generation, {
+        "query": query,
+        "context": final_documents,
+        "metadatas": final_metadatas,
+        "answer": answer,
+        "prompt_tokens": prompt_tokens
+    }, query_embedding, filters)
+
+async def _retriever_results(tasks: dict, deadline: Deadline) -> dict:
+    """
+    Results of the retriever tasks ({stage: task}) finished within DEADLINE_RETRIEVAL_SHARE
+    of the deadline. If none is, the first one to finish before the deadline is used.
+    The others are abandoned and recorded as degraded.
+    """
+    await asyncio.wait(tasks.values(), timeout=deadline.remaining(settings.DEADLINE_RETRIEVAL_SHARE))
+    if not any(task.done() for task in tasks.values()):
+        await asyncio.wait(tasks.values(), timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+    results = {}
+    for stage, task in tasks.items():
+        if task.done():
+            results[stage] = task.result()
+        else:
+            task.cancel()
+            deadline.degrade(stage, "timeout")
+    return results
+
+async def retrieve_context_async(query: str, filters: Optional[dict] = None,
+                                 deadline: Optional[Deadline] = None) -> tuple[list[str], list[dict]]:
+    """
+    Expansion, hybrid retrieval, RRF fusion and re-ranking; returns the final chunks and their metadata.
+    filters are pushed down into both the BM25 and the vector search.
+    With a deadline, expansion variants are only used if they are searched within
+    DEADLINE_RETRIEVAL_SHARE of it, and a retriever that misses it is left out.
+    """
+    from app.services.query_expansion import expand_query_async
     from app.services.bm25_service import bm25_service
     
-    # Get BM25 results (Increased to 20 to capture more candidates)
-    bm25_results = bm25_service.search(query, top_k=20)
-    
-    # RRF Constants
-    k = 60
-    doc_scores = {}
-    doc_metadatas = {}
+    # 1. Start BM25 and original-query retrieval right away, in parallel with query expansion
+    # (expansion is activated for queries with 10 words or less)
+    bm25_task = asyncio.create_task(run_blocking(bm25_service.search, query, top_k=20, filters=filters))
+    vector_task = asyncio.create_task(vector_search_async(query, filters=filters))
     
-    # Process Vector Results (Weight: 0.3)
-    vector_weight = 0.3
-    for rank, (doc, dist, meta) in enumerate(zip(all_documents, all_distances, all_metadatas)):
-        if doc not in doc_scores:
-            doc_scores[doc] = 0
-            doc_metadatas[doc] = meta
-        # Vector rank contribution
-        doc_scores[doc] += vector_weight * (1 / (k + rank + 1))
-        
-    # Process BM25 Results (Weight: 0.7)
-    bm25_weight = 0.7
-    for rank, (doc, score, meta) in enumerate(bm25_results):
-        if doc not in doc_scores:
-            doc_scores[doc] = 0
-            doc_metadatas[doc] = meta
-        # BM25 rank contribution
-        doc_scores[doc] += bm25_weight * (1 / (k + rank + 1))
+    async def search_variants():
+        variants = (await expand_query_async(query))[1:]
+        if not variants:
+            return variants, None
+        # 2. Embed all expansion variants in one batch call, then search them in one call
+        # (the original is already in flight)
+        variant_embeddings = await embed_queries_async(variants)
+        return variants, await query_chroma_many_async(variant_embeddings, n_results=20, filters=filters)
     
-    # Sort by RRF score
-    ranked_items = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
+    try:
+        queries = [query]
+        variant_results = None
+        if len(query.split()) <= 10:
+            try:
+                variants, variant_results = await within(search_variants(), deadline, settings.DEADLINE_RETRIEVAL_SHARE)
+                queries += variants
+            except DeadlineExceeded:
+                deadline.degrade("expansion", "timeout")
+        print(f"Searching with {len(queries)} query variations...")
+
+        # 3. Hybrid Search (Vector + BM25) with Reciprocal Rank Fusion (RRF)
+        # BM25 results (20 candidates) were computed concurrently with the vector branches
+        if deadline is None:
+            vector_results = [await vector_task]
+            bm25_results = await bm25_task
+        else:
+            found = await _retriever_results({"vector_search": vector_task, "bm25": bm25_task}, deadline)
+            vector_results = [found["vector_search"]] if "vector_search" in found else []
+            bm25_results = found.get("bm25", [])
+    finally:
+        # If expansion or a retriever failed, the speculative searches must not be left running
+        for task in (bm25_task, vector_task):
+            task.cancel()
+        await asyncio.gather(bm25_task, vector_task, return_exceptions=True)
+    if variant_results is not None:
+        vector_results.append(variant_results)
+
+    # Candidates are identified by chunk id (the Chroma id, also stored in BM25 metadata)
+    candidate_index = {}
+    documents = []
+    metadatas = []
+
+    def candidate(key, doc, meta):
+        idx = candidate_index.get(key)
+        if idx is None:
+            idx = candidate_index[key] = len(documents)
+            documents.append(doc)
+            metadatas.append(meta or {})
+        return idx
+
+    # One ranked list of candidate indices per query variation, ranks restart for each list
+    rank_lists = []
+    for results in vector_results:
+        for q, ids in enumerate(results['ids']):
+            docs = results['documents'][q]
+            metas = results['metadatas'][q] if results.get('metadatas') else [{}] * len(docs)
+            rank_lists.append([candidate(i, d, m) for i, d, m in zip(ids, docs, metas)])
+
+    # Chunks indexed before chunk ids were stored in BM25 are matched on (document_id, chunk_index)
+    legacy_ids = None
+    bm25_list = []
+    for doc, score, meta in bm25_results:
+        key = meta.get("chunk_id")
+        if key is None and "document_id" in meta:
+            if legacy_ids is None:
+                legacy_ids = {(m.get("document_id"), m.get("chunk_index")): cid
+                              for cid, m in zip(candidate_index, metadatas) if "document_id" in m}
+            key = legacy_ids.get((meta["document_id"], meta.get("chunk_index")))
+        bm25_list.append(candidate(key if key is not None else doc, doc, meta))
+
+    # Vector weight 0.3 per query variation, BM25 weight 0.7
+    weights = [VECTOR_WEIGHT] * len(rank_lists) + [BM25_WEIGHT]
+    rrf_scores = reciprocal_rank_fusion(rank_lists + [bm25_list], weights, len(documents))
+    bm25_scores = np.zeros(len(documents))
+    bm25_scores[bm25_list] = [score for doc, score, meta in bm25_results]
     
     # Take top 15 for re-ranking (Optimized for speed/accuracy balance)
-    top_10_documents = [doc for doc, score in ranked_items[:15]]
-    top_10_metadatas = [doc_metadatas[doc] for doc, score in ranked_items[:15]]
+    top = np.argsort(-rrf_scores, kind="stable")[:15]
+    top_10_documents = [documents[i] for i in top]
+    top_10_metadatas = [metadatas[i] for i in top]
     
-    # Create a map of chunk -> metadata for reliable retrieval
-    chunk_to_meta = {doc: meta for doc, meta in zip(top_10_documents, top_10_metadatas)}
+    # 5. Re-rank locally, with Gemini only for ambiguous rankings
+    reranked = await rerank_async(query, top_10_documents, rrf_scores[top].tolist(), bm25_scores[top].tolist(),
+                                  top_k=5, deadline=deadline)
     
-    # 5. Re-rank with Gemini for better accuracy
-    reranked = rerank_with_gemini(query, top_10_documents, top_k=5)
-    
-    # Extract documents and find their metadata
-    final_documents = []
-    final_metadatas = []
-    for chunk, score in reranked:
-        final_documents.append(chunk)
-        # Retrieve metadata using the map, defaulting to empty dict if not found (unlikely)
-        final_metadatas.append(chunk_to_meta.get(chunk, {}))
-    
-    context = "\n\n---\n\n".join(final_documents)
+    # Re-ranking returns candidate positions, so each chunk keeps its own metadata
+    final_documents = [top_10_documents[i] for i, score in reranked]
+    final_metadatas = [top_10_metadatas[i] for i, score in reranked]
     
-    # 6. Generate Answer with metadata
-    answer = generate_answer(query, context, final_metadatas)
-    
-    return {
-        "query": query,
-        "context": final_documents,
-        "metadatas": final_metadatas,
-        "answer": answer
-    }
+    return final_documents, final_metadatas
 
@@ -0,0 +1,94 @@
+"""
+Text analysis shared by BM25 indexing and querying (and the local re-ranker).
+
+normalize() folds the variants that should match: case, Latin accents, Arabic
+diacritics (tashkeel) and tatweel, alef/ya/ta-marbuta/hamza-carrier forms and
+Arabic-Indic digits. It is one NFKD pass plus one precompiled translate table.
+Tokens are runs of letters and digits. Stop words (Arabic, French, English) are dropped,
+and a light stemmer strips Arabic clitic prefixes and suffixes and Latin plurals.
+Per-token results are cached, since a corpus has far fewer distinct tokens than tokens.
+
+Analyzer.name identifies the options; the BM25 index stores it and re-tokenizes its
+chunks when it changes, so indexing and querying always agree.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+from typing import List, Optional
+from app.core.config import settings
+
+TOKENIZER_VERSION = 1  # Bump whenever normalize() or the stemmer change
+
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+def _translate_table() -> dict:
+    table = {}
+    # Combining marks left by NFKD (Latin accents, hamza/madda above alef, waw, ya) and tashkeel
+    for start, end in ((0x0300, 0x036F), (0x0610, 0x061A), (0x064B, 0x065F), (0x06D6, 0x06ED)):
+        table.update({cp: None for cp in range(start, end + 1)})
+    table[0x0670] = None  # superscript alef
+    table[0x0640] = None  # tatweel
+    table.update({ord("ٱ"): "ا", ord("ى"): "ي", ord("ة"): "ه", ord("œ"): "oe", ord("æ"): "ae"})
+    table.update({0x0660 + d: str(d) for d in range(10)})  # ٠-٩
+    table.update({0x06F0 + d: str(d) for d in range(10)})  # ۰-۹
+    return table
+
+_TABLE = _translate_table()
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKD", text.casefold()).translate(_TABLE)
+
+# Stop words, written in normalized form
+STOP_WORDS = frozenset("""
+في من على الي عن مع هذا هذه ذلك تلك هولاء التي الذي الذين اللذين اللتين هو هي هم هن انا نحن انت
+ان او ام ثم قد لا ما لم لن ليس كان كانت يكون تكون بين كل بعض بعد قبل عند حتي اذا اذ كما ايضا غير
+هناك هنا حيث لقد منذ الا انه انها وهو وهي وان ولا وما وقد ولم فان فقد لكن بل اي كيف متي لماذا
+le la les un une des du de d l et ou en au aux ce cet cette ces qui que qu quoi dont est sont etait
+a pour par sur dans avec sans pas ne n se s sa son ses leur leurs il elle ils elles nous vous je j
+tu on y plus mais comme tres aussi
+the a an and or of to in on for with is are was were be been by as at it its this that these those
+from not but which who whom what when where how why do does did has have had can will would
+""".split())
+
+_AR_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")  # longest first
+_AR_SUFFIXES = ("ها", "ان", "ات", "ون", "ين", "يه", "ه", "ي")
+_ARABIC_RE = re.compile(r"[؀-ۿ]")
+
+def stem(token: str) -> str:
+    """
+    Light stemming: Arabic clitics (Light10-style, without the lone و, keeping at least
+    three letters, the usual root length) and Latin plurals.
+    """
+    if _ARABIC_RE.match(token):
+        for prefix in _AR_PREFIXES:
+            if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+                token = token[len(prefix):]
+                break
+        for suffix in _AR_SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+                token = token[:-len(suffix)]
+        return token
+    if len(token) > 3 and token[-1] in "sx" and token[-2] not in "su" and not token.isdigit():
+        return token[:-1]
+    return token
+
+class Analyzer:
+    def __init__(self, stemming: bool = True, stop_words: bool = True, cache_size: int = 200_000):
+        self.stemming = stemming
+        self.stop_words = stop_words
+        self.name = f"v{TOKENIZER_VERSION}{'+stem' if stemming else ''}{'+stop' if stop_words else ''}"
+        self._term = lru_cache(maxsize=cache_size)(self._term_uncached)
+
+    def _term_uncached(self, token: str) -> Optional[str]:
+        if self.stop_words and token in STOP_WORDS:
+            return None
+        return stem(token) if self.stemming else token
+
+    def analyze(self, text: str) -> List[str]:
+        """Index terms of a text, in order (stop words removed)."""
+        terms = map(self._term, _TOKEN_RE.findall(normalize(text)))
+        return [term for term in terms if term]
+
+    __call__ = analyze
+
+analyzer = Analyzer(settings.BM25_STEMMING, settings.BM25_STOP_WORDS)
@@ -0,0 +1,300 @@
+"""
+In-process vector index: a memory-mapped embedding matrix searched with matrix multiplies.
+
+Vectors are L2-normalized and kept on disk in three files:
+- vectors.f16 or vectors.i8 (+ scales.f32, one symmetric scale per row): the quantized copy
+  scanned by every search, 2x or 4x smaller than float32;
+- vectors.f32: the exact copy, only read for the few shortlisted rows being re-scored;
+- records.sqlite3: ids, texts and metadata of each row.
+manifest.json holds the row count and is written last, so readers never see a partial append.
+Rows of deleted documents are listed in the manifest and skipped by searches (their
+records are removed; the vectors stay until the next rebuild).
+Writes (append, delete, reset) from any uvicorn worker hold an exclusive lock on the directory and
+reload the manifest first, so concurrent appends never overwrite each other's rows.
+
+All query variants are scored together: one matrix product per block of rows, followed by
+a top-k partition. Results use the ChromaDB query() layout, with
+cosine distances. Filtered searches look the matching rows up in records.sqlite3
+(expression indexes on the filter fields) and only score those rows.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+import numpy as np
+from app.services.bm25_index import FILTER_FIELDS
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, run a single worker
+    fcntl = None
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "write.lock"
+BLOCK_ROWS = 8192  # Rows de-quantized per matrix multiply, bounds the temporary float32 block
+RESCORE_FACTOR = 4  # Shortlist size per query, relative to n_results, when re-scoring
+DTYPES = {"float16": ("vectors.f16", np.float16), "int8": ("vectors.i8", np.int8)}
+
+class MatrixVectorIndex:
+    def __init__(self, directory: str, dtype: str = "int8", rescore: bool = True):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector index dtype: {dtype}")
+        self.directory = directory
+        self.dtype = dtype
+        self.rescore = rescore
+        self.dim = None
+        self.count = 0
+        self._manifest_mtime = None
+        self._quantized = None
+        self._scales = None
+        self._exact = None
+        self._deleted = np.zeros(0, dtype=np.int64)
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._write_depth = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self._path("records.sqlite3"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS records (row INTEGER PRIMARY KEY, id TEXT NOT NULL, document TEXT, metadata TEXT)")
+            for field in FILTER_FIELDS:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS records_{field} ON records (json_extract(metadata, '$.{field}'))")
+            self._local.conn = conn
+        return conn
+
+    def _load(self):
+        """(Re)maps the matrices when the manifest changed (rows appended by any worker)."""
+        path = self._path(MANIFEST_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._manifest_mtime:
+            return
+        with self._lock:
+            if mtime is None:
+                self.dim, self.count = None, 0
+                self._quantized = self._scales = self._exact = None
+                self._deleted = np.zeros(0, dtype=np.int64)
+            else:
+                with open(path, encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if manifest["dtype"] != self.dtype:
+                    raise ValueError(f"Vector index was built as {manifest['dtype']}, not {self.dtype}; rebuild it")
+                self.dim, self.count = manifest["dim"], manifest["count"]
+                name, np_dtype = DTYPES[self.dtype]
+                shape = (self.count, self.dim)
+                self._quantized = np.memmap(self._path(name), dtype=np_dtype, mode="r", shape=shape) if self.count else None
+                self._exact = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=shape) if self.count else None
+                self._scales = (np.fromfile(self._path("scales.f32"), dtype=np.float32, count=self.count)
+                                if self.dtype == "int8" else None)
+                self._deleted = np.asarray(manifest.get("deleted", []), dtype=np.int64)
+            self._manifest_mtime = mtime
+
+    @contextmanager
+    def writer(self):
+        """
+        Exclusive write access to the index, across threads and worker processes
+        (flock on the index directory). The manifest is reloaded on entry, so rows
+        appended by other workers are seen. Re-entrant.
+        """
+        with self._lock:
+            if self._write_depth == 0:
+                os.makedirs(self.directory, exist_ok=True)
+                self._lock_file = open(self._path(LOCK_FILE), "a+")
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._write_depth += 1
+            try:
+                if self._write_depth == 1:
+                    self._manifest_mtime = -1
+                    self._load()
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def reset(self):
+        with self.writer():
+            for name in (MANIFEST_FILE, DTYPES[self.dtype][0], "scales.f32", "vectors.f32"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM records")
+            self._manifest_mtime = None
+            self._load()
+
+    def add(self, ids: List[str], documents: List[str], metadatas: List[dict], embeddings: List[List[float]]):
+        """Appends rows after the latest ones, whichever worker wrote them."""
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self.writer():
+            if self.dim is not None and vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({self.dim})")
+            dim, start = vectors.shape[1], self.count
+            name, np_dtype = DTYPES[self.dtype]
+            if self.dtype == "int8":
+                scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+                quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+            else:
+                quantized = vectors.astype(np.float16)
+
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM records WHERE row >= ?", (start,))
+                conn.executemany(
+                    "INSERT INTO records (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(start + i, id_, doc, json.dumps(meta or {}, ensure_ascii=False))
+                     for i, (id_, doc, meta) in enumerate(zip(ids, documents, metadatas))],
+                )
+            # Rows past the manifest count are leftovers of an interrupted append
+            self._append(name, quantized, start * dim * np.dtype(np_dtype).itemsize)
+            self._append("vectors.f32", vectors, start * dim * 4)
+            if self.dtype == "int8":
+                self._append("scales.f32", scales.astype(np.float32), start * 4)
+
+            self._save_manifest(dim, start + len(ids), self._deleted)
+
+    def delete(self, filters: dict):
+        """Leaves the rows whose metadata matches filters ({field: [values]}) out of every later search."""
+        with self.writer():
+            if not self.count:
+                return
+            rows = self._filter_rows(filters, self.count)
+            if not len(rows):
+                return
+            conn = self._conn()
+            with conn:
+                conn.executemany("DELETE FROM records WHERE row = ?", [(row,) for row in rows.tolist()])
+            self._save_manifest(self.dim, self.count, np.union1d(self._deleted, rows))
+
+    def _save_manifest(self, dim: int, count: int, deleted: np.ndarray):
+        tmp_path = self._path(MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dtype": self.dtype, "dim": dim, "count": count, "deleted": deleted.tolist()}, f)
+        os.replace(tmp_path, self._path(MANIFEST_FILE))
+        self._manifest_mtime = -1
+        self._load()
+
+    def _append(self, name: str, array: np.ndarray, offset: int):
+        with open(self._path(name), "ab") as f:
+            f.truncate(offset)
+            f.write(array.tobytes())
+
+    def search(self, query_embeddings: List[List[float]], n_results: int = 5, filters: Optional[dict] = None) -> dict:
+        """
+        Nearest rows for every query embedding, in ChromaDB's query() layout.
+        filters ({field: [values]}) restricts the search to rows whose metadata matches.
+        """
+        self._load()
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        num_queries = len(queries)
+        with self._lock:
+            quantized, scales, exact, count, dim = self._quantized, self._scales, self._exact, self.count, self.dim
+            deleted = self._deleted
+        # Deleted rows have no record left, so filtered searches never select them
+        selected = self._filter_rows(filters, count) if filters and count else None
+        if selected is None and len(deleted):
+            selected = np.setdiff1d(np.arange(count), deleted)
+        total = count if selected is None else len(selected)
+        k = min(n_results, total)
+        if k == 0:
+            return {key: [[] for _ in range(num_queries)] for key in ("ids", "documents", "metadatas", "distances")}
+
+        # Approximate scores over the quantized matrix (or its filtered rows), keeping the best
+        # `shortlist` rows per query of every block, then of all blocks
+        shortlist = min(total, k * RESCORE_FACTOR if self.rescore else k)
+        buffer = np.empty((min(BLOCK_ROWS, total), dim), dtype=np.float32)
+        candidate_rows = []
+        candidate_scores = []
+        for start in range(0, total, BLOCK_ROWS):
+            block = buffer[:min(BLOCK_ROWS, total - start)]
+            if selected is None:
+                rows = np.arange(start, start + len(block))
+                source = slice(start, start + len(block))
+            else:
+                rows = source = selected[start:start + len(block)]
+            np.copyto(block, quantized[source], casting="unsafe")
+            scores = (block @ queries.T).T
+            if scales is not None:
+                scores *= scales[source]
+            if len(block) > shortlist:
+                keep = np.argpartition(-scores, shortlist - 1, axis=1)[:, :shortlist]
+                candidate_rows.append(rows[keep])
+                candidate_scores.append(np.take_along_axis(scores, keep, axis=1))
+            else:
+                candidate_rows.append(np.broadcast_to(rows, scores.shape))
+                candidate_scores.append(scores)
+        best_rows = np.concatenate(candidate_rows, axis=1)
+        best_scores = np.concatenate(candidate_scores, axis=1)
+        if best_scores.shape[1] > shortlist:
+            keep = np.argpartition(-best_scores, shortlist - 1, axis=1)[:, :shortlist]
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+        if self.rescore:
+            # Exact cosine for the shortlisted rows only (reads shortlist rows of vectors.f32)
+            best_scores = np.einsum("qsd,qd->qs", exact[best_rows.ravel()].reshape(*best_rows.shape, -1), queries)
+        order = np.argsort(-best_scores, axis=1, kind="stable")[:, :k]
+        top_rows = np.take_along_axis(best_rows, order, axis=1)
+        top_scores = np.take_along_axis(best_scores, order, axis=1)
+
+        records = self._records(np.unique(top_rows).tolist())
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for rows, scores in zip(top_rows.tolist(), top_scores.tolist()):
+            results["ids"].append([records[r][0] for r in rows])
+            results["documents"].append([records[r][1] for r in rows])
+            results["metadatas"].append([records[r][2] for r in rows])
+            results["distances"].append([1 - s for s in scores])
+        return results
+
+    def _filter_rows(self, filters: dict, count: int) -> np.ndarray:
+        """Sorted rows (below count) whose metadata matches every filter field (any of its values)."""
+        clauses, params = [], []
+        for field, values in filters.items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unsupported filter field: {field}")
+            values = list(values)
+            clauses.append(f"json_extract(metadata, '$.{field}') IN ({','.join('?' * len(values))})")
+            params.extend(values)
+        rows = self._conn().execute(
+            f"SELECT row FROM records WHERE row < ? AND {' AND '.join(clauses)} ORDER BY row", (count, *params)
+        )
+        return np.fromiter((row for row, in rows), dtype=np.int64)
+
+    def _records(self, rows: List[int]) -> dict:
+        found = {}
+        for start in range(0, len(rows), 500):  # stay under SQLite's bound-parameter limit
+            batch = rows[start:start + 500]
+            for row, id_, doc, meta in self._conn().execute(
+                f"SELECT row, id, document, metadata FROM records WHERE row IN ({','.join('?' * len(batch))})", batch
+            ):
+                found[row] = (id_, doc, json.loads(meta))
+        return found
+
+    def __len__(self) -> int:
+        self._load()
+        return self.count - len(self._deleted)
+
+    def memory_bytes_per_row(self) -> int:
+        """Resident bytes per chunk scanned by search (quantized vector + scale)."""
+        if self.dim is None:
+            return 0
+        return self.dim * np.dtype(DTYPES[self.dtype][1]).itemsize + (4 if self.dtype == "int8" else 0)
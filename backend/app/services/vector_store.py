@@ -1,17 +1,51 @@
+"""
+Vector storage behind one interface, selected by VECTOR_BACKEND:
+"chroma" (ChromaDB PersistentClient) or "matrix" (in-process quantized index, see vector_index.py).
+"""
+import threading
 import chromadb
 from chromadb.config import Settings
+from app.core.config import settings
+from app.core.executor import run_blocking
+from app.core.metrics import span
+from app.services.vector_index import MatrixVectorIndex
 
 _chroma_client = None
 _collection = None
+_matrix_index = None
+# Concurrent first queries would otherwise open several clients on the same directory
+_init_lock = threading.Lock()
+
+def get_matrix_index() -> MatrixVectorIndex:
+    global _matrix_index
+    with _init_lock:
+        if _matrix_index is None:
+            _matrix_index = MatrixVectorIndex(settings.VECTOR_INDEX_PATH, settings.VECTOR_INDEX_DTYPE, rescore=settings.VECTOR_INDEX_RESCORE)
+    return _matrix_index
 
 def get_collection():
     global _chroma_client, _collection
-    if _collection is None:
-        _chroma_client = chromadb.PersistentClient(path="data/chroma_db")
-        _collection = _chroma_client.get_or_create_collection(name="rag_collection")
+    with _init_lock:
+        if _collection is None:
+            _chroma_client = chromadb.PersistentClient(path="data/chroma_db")
+            _collection = _chroma_client.get_or_create_collection(name="rag_collection")
+    return _collection
+
+def reset_collection():
+    """Drops every vector and recreates an empty collection."""
+    global _collection
+    if settings.VECTOR_BACKEND == "matrix":
+        get_matrix_index().reset()
+        return
+    get_collection()
+    _chroma_client.delete_collection(name="rag_collection")
+    _collection = _chroma_client.get_or_create_collection(name="rag_collection")
     return _collection
 
 def add_documents_to_chroma(ids: list[str], documents: list[str], metadatas: list[dict], embeddings: list[list[float]]):
+    if settings.VECTOR_BACKEND == "matrix":
+        get_matrix_index().add(ids, documents, metadatas, embeddings)
+        return
     collection = get_collection()
     collection.add(
         ids=ids,
@@ -20,11 +54,50 @@ def add_documents_to_chroma(ids: list[str], documents: list[str], metadatas: lis
         embeddings=embeddings
     )
 
-def query_chroma(query_embedding: list[float], n_results: int = 5):
-    collection = get_collection()
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=n_results,
-        include=['documents', 'distances', 'metadatas']
-    )
-    return results
+def delete_document_vectors(document_id):
+    """Removes the vectors of one document's chunks."""
+    if settings.VECTOR_BACKEND == "matrix":
+        get_matrix_index().delete({"document_id": [document_id]})
+        return
+    get_collection().delete(where={"document_id": document_id})
+
+def chroma_where(filters: dict | None) -> dict | None:
+    """Chroma `where` clause for {field: [values]} filters: any value of each field, all fields."""
+    if not filters:
+        return None
+    clauses = [{field: {"$in": list(values)}} for field, values in filters.items()]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def query_chroma(query_embedding: list[float], n_results: int = 5, filters: dict | None = None):
+    return query_chroma_many([query_embedding], n_results=n_results, filters=filters)
+
+def query_chroma_many(query_embeddings: list[list[float]], n_results: int = 5, filters: dict | None = None):
+    """
+    Searches several query embeddings in one call; results hold one list per query.
+    filters ({field: [values]}) restricts the search to matching chunks.
+    """
+    with span("vector_search"):
+        if settings.VECTOR_BACKEND == "matrix":
+            return get_matrix_index().search(query_embeddings, n_results=n_results, filters=filters)
+        collection = get_collection()
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=chroma_where(filters),
+            include=['documents', 'distances', 'metadatas']
+        )
+        return results
+
+def count_vectors() -> int:
+    if settings.VECTOR_BACKEND == "matrix":
+        return len(get_matrix_index())
+    return get_collection().count()
+
+async def add_documents_to_chroma_async(ids: list[str], documents: list[str], metadatas: list[dict], embeddings: list[list[float]]):
+    return await run_blocking(add_documents_to_chroma, ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+
+async def query_chroma_async(query_embedding: list[float], n_results: int = 5, filters: dict | None = None):
+    return await run_blocking(query_chroma, query_embedding, n_results=n_results, filters=filters)
+
+async def query_chroma_many_async(query_embeddings: list[list[float]], n_results: int = 5, filters: dict | None = None):
+    return await run_blocking(query_chroma_many, query_embeddings, n_results=n_results, filters=filters)
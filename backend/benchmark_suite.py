@@ -0,0 +1,301 @@
+"""
+Offline performance benchmark of the ingestion and query hot paths.
+
+Gemini is replaced by the deterministic fakes of fake_backends.py and Supabase by the
+SQLite record backend, so runs need no network and are repeatable. A synthetic
+Arabic/French corpus is ingested in steps up to each requested size (indexes are
+append-only, so every step only ingests the new chunks). At each size the suite measures:
+- ingestion throughput (process_document_async, several documents at a time);
+- BM25 and vector search latency (one query, and groups of query variants);
+- fusion cost (reciprocal_rank_fusion and local_rerank on real candidate lists);
+- end-to-end rag_pipeline_async latency, with its per-stage breakdown.
+Results are written as JSON; --compare prints the ratios against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+
+BACKEND_DIR = Path(__file__).resolve().parent
+CHARS_PER_CHUNK = 360  # New characters per chunk with CHUNK_SIZE 512 and CHUNK_OVERLAP 150
+
+class SyntheticCorpus:
+    """
+    Deterministic Arabic/French text: pseudo-words built from syllables of each script,
+    drawn with a Zipf distribution and mixed with real function words.
+    """
+    SYLLABLES = {
+        "ar": ["با", "تي", "جو", "دا", "را", "سي", "شو", "عا", "فو", "قي", "كا", "لي", "مو", "نا", "هي",
+               "وا", "يو", "خا", "حي", "صو", "طا", "ظي", "غو", "ثا", "زي", "ضو", "ذا", "مس", "كت", "عل"],
+        "fr": ["ba", "de", "ri", "mo", "lu", "sa", "te", "vi", "no", "pa", "que", "tion", "ment", "con",
+               "pre", "lo", "gi", "ra", "en", "on", "eu", "ai", "tra", "ser", "ver", "cla", "pro", "dis"],
+    }
+    FUNCTION_WORDS = {
+        "ar": ["في", "من", "على", "إلى", "عن", "مع", "هذا", "التي", "الذي", "كان", "بين", "كل", "أن", "و"],
+        "fr": ["le", "la", "les", "de", "des", "et", "en", "un", "une", "pour", "dans", "sur", "avec", "est"],
+    }
+
+    def __init__(self, seed: int = 0, vocabulary: int = 50_000, arabic_share: float = 0.7):
+        self.rng = np.random.default_rng(seed)
+        self.arabic_share = arabic_share
+        self.vocab = {lang: self._vocabulary(lang, vocabulary) for lang in self.SYLLABLES}
+        ranks = np.arange(1, vocabulary + 1)
+        self.zipf = (1 / ranks) / (1 / ranks).sum()
+
+    def _vocabulary(self, lang: str, size: int) -> np.ndarray:
+        syllables = self.SYLLABLES[lang]
+        words = set()
+        while len(words) < size:
+            parts = self.rng.integers(0, len(syllables), self.rng.integers(2, 5))
+            word = "".join(syllables[p] for p in parts)
+            words.add(("ال" + word) if lang == "ar" and self.rng.random() < 0.3 else word)
+        return np.array(sorted(words))
+
+    def sentence(self, lang: str) -> str:
+        length = int(self.rng.integers(8, 20))
+        words = self.vocab[lang][self.rng.choice(len(self.zipf), length, p=self.zipf)].tolist()
+        function_words = self.FUNCTION_WORDS[lang]
+        for position in self.rng.integers(0, length, length // 3):
+            words.insert(int(position), function_words[int(self.rng.integers(len(function_words)))])
+        return " ".join(words) + "."
+
+    def document(self, chars: int) -> str:
+        lang = "ar" if self.rng.random() < self.arabic_share else "fr"
+        paragraphs, size = [], 0
+        while size < chars:
+            paragraph = " ".join(self.sentence(lang) for _ in range(int(self.rng.integers(3, 8))))
+            paragraphs.append(paragraph)
+            size += len(paragraph) + 2
+        return "\n\n".join(paragraphs)
+
+def write_documents(corpus: SyntheticCorpus, directory: Path, first: int, chunks: int, chunks_per_document: int) -> list[Path]:
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(first, first + max(1, round(chunks / chunks_per_document))):
+        path = directory / f"synthetic_{i:06d}.txt"
+        path.write_text(corpus.document(chunks_per_document * CHARS_PER_CHUNK), encoding="utf-8")
+        paths.append(path)
+    return paths
+
+def sample_queries(corpus: SyntheticCorpus, paths: list[Path], count: int) -> list[str]:
+    """Short phrases taken from ingested documents, so every query has lexical matches."""
+    queries = []
+    for i in corpus.rng.choice(len(paths), count):
+        words = paths[int(i)].read_text(encoding="utf-8").split()
+        start = int(corpus.rng.integers(0, max(1, len(words) - 6)))
+        queries.append(" ".join(words[start:start + int(corpus.rng.integers(3, 7))]))
+    return list(dict.fromkeys(queries))
+
+def summary(seconds: list[float]) -> dict:
+    ms = np.asarray(seconds) * 1000
+    return {
+        "n": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+def timed(func, *args, **kwargs) -> tuple:
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+async def ingest(paths: list[Path], concurrency: int) -> dict:
+    from app.services.ingestion import process_document_async
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = {"embedding": 0.0, "writing": 0.0}
+
+    async def one(path: Path) -> int:
+        async with semaphore:
+            result = await process_document_async(str(path))
+        for stage in timings:
+            timings[stage] += result["timings"][stage]
+        return result["total_chunks"]
+
+    started = time.perf_counter()
+    chunks = sum(await asyncio.gather(*(one(path) for path in paths)))
+    seconds = time.perf_counter() - started
+    return {"documents": len(paths), "chunks": chunks, "seconds": seconds,
+            "chunks_per_second": chunks / seconds if seconds else None,
+            "embedding_seconds": timings["embedding"], "writing_seconds": timings["writing"]}
+
+def measure_search(queries: list[str], variants: int) -> dict:
+    from app.services.bm25_service import bm25_service
+    from app.services.embedding import embed_queries
+    from app.services.vector_store import query_chroma_many
+    from app.services.rag import reciprocal_rank_fusion, local_rerank, VECTOR_WEIGHT, BM25_WEIGHT
+
+    embeddings = embed_queries(queries)
+    bm25, vector, vector_group, fusion, rerank = [], [], [], [], []
+    for i, query in enumerate(queries):
+        bm25_results, seconds = timed(bm25_service.search, query, top_k=20)
+        bm25.append(seconds)
+        results, seconds = timed(query_chroma_many, [embeddings[i]], n_results=20)
+        vector.append(seconds)
+        group = [embeddings[(i + v) % len(embeddings)] for v in range(variants)]
+        group_results, seconds = timed(query_chroma_many, group, n_results=20)
+        vector_group.append(seconds)
+
+        # Fusion over the candidates retrieval would see: one list per variant plus BM25
+        started = time.perf_counter()
+        candidate_index, texts = {}, []
+
+        def candidate(key, text) -> int:
+            if key not in candidate_index:
+                candidate_index[key] = len(texts)
+                texts.append(text)
+            return candidate_index[key]
+
+        rank_lists = [[candidate(id_, doc) for id_, doc in zip(ids, documents)]
+                      for ids, documents in zip(group_results["ids"], group_results["documents"])]
+        bm25_list = [candidate(meta.get("chunk_id", doc), doc) for doc, score, meta in bm25_results]
+        rrf = reciprocal_rank_fusion(rank_lists + [bm25_list], [VECTOR_WEIGHT] * len(rank_lists) + [BM25_WEIGHT], len(texts))
+        top = np.argsort(-rrf, kind="stable")[:15]
+        fusion.append(time.perf_counter() - started)
+
+        bm25_scores = np.zeros(len(texts))
+        bm25_scores[bm25_list] = [score for _, score, _ in bm25_results]
+        _, seconds = timed(local_rerank, query, [texts[t] for t in top], rrf[top].tolist(), bm25_scores[top].tolist())
+        rerank.append(seconds)
+
+    return {
+        "bm25": summary(bm25),
+        "vector": summary(vector),
+        f"vector_x{variants}": summary(vector_group),
+        "fusion": summary(fusion),
+        "local_rerank": summary(rerank),
+    }
+
+async def measure_pipeline(queries: list[str]) -> dict:
+    from app.core import metrics
+    from app.services.rag import rag_pipeline_async
+    latencies = []
+    stages = {}
+    for query in queries:
+        with metrics.trace() as trace:
+            started = time.perf_counter()
+            await rag_pipeline_async(query)
+            latencies.append(time.perf_counter() - started)
+        for stage, _, seconds in trace.spans:
+            stages.setdefault(stage, []).append(seconds)
+    # Spans per stage are summed per query (e.g. several vector searches) before averaging
+    return {**summary(latencies),
+            "stages_mean_ms": {stage: 1000 * sum(values) / len(queries) for stage, values in stages.items()}}
+
+def run(args, gemini) -> list[dict]:
+    from app.services.bm25_service import bm25_service
+    from app.services.vector_store import count_vectors
+
+    corpus = SyntheticCorpus(seed=args.seed)
+    corpus_dir = Path("corpus")
+    paths: list[Path] = []
+    results = []
+    for size in sorted(args.sizes):
+        ingested = bm25_service.index.stats()["documents"]
+        if size > ingested:
+            new_paths, seconds = timed(write_documents, corpus, corpus_dir, len(paths), size - ingested, args.chunks_per_document)
+            print(f"📝 {len(new_paths)} documents generated in {seconds:.1f}s")
+            ingestion = asyncio.run(ingest(new_paths, args.concurrency))
+            paths.extend(new_paths)
+            print(f"📥 Ingested {ingestion['chunks']} chunks at {ingestion['chunks_per_second']:.0f} chunks/s")
+        else:
+            ingestion = None
+
+        queries = sample_queries(corpus, paths, args.queries)
+        entry = {
+            "target_chunks": size,
+            "chunks": bm25_service.index.stats()["documents"],
+            "vectors": count_vectors(),
+            "ingestion": ingestion,
+            "bm25_index": bm25_service.index.stats(),
+            **measure_search(queries, args.variants),
+        }
+        if not args.skip_pipeline:
+            calls = dict(gemini.calls)
+            entry["rag_pipeline"] = asyncio.run(measure_pipeline(queries[:args.pipeline_queries]))
+            entry["rag_pipeline"]["fake_calls"] = {k: gemini.calls[k] - calls[k] for k in calls}
+        results.append(entry)
+        print(f"✅ {entry['chunks']} chunks: BM25 {entry['bm25']['mean_ms']:.2f} ms, "
+              f"vector {entry['vector']['mean_ms']:.2f} ms, fusion {entry['fusion']['mean_ms']:.3f} ms"
+              + (f", rag_pipeline {entry['rag_pipeline']['mean_ms']:.1f} ms" if "rag_pipeline" in entry else ""))
+    return results
+
+def compare(current: dict, previous: dict):
+    """Prints mean latency ratios (current / previous) for the sizes both runs measured."""
+    print(f"\n⚖️  {current['commit']} vs {previous['commit']} (ratio of means, < 1 is faster)")
+    old = {r["target_chunks"]: r for r in previous["results"]}
+    for entry in current["results"]:
+        before = old.get(entry["target_chunks"])
+        if before is None:
+            continue
+        ratios = []
+        for name, value in entry.items():
+            if isinstance(value, dict) and "mean_ms" in value and name in before and before[name].get("mean_ms"):
+                ratios.append(f"{name} {value['mean_ms'] / before[name]['mean_ms']:.2f}x")
+        if entry["ingestion"] and before.get("ingestion"):
+            ratios.append(f"ingestion {entry['ingestion']['chunks_per_second'] / before['ingestion']['chunks_per_second']:.2f}x throughput")
+        print(f"  {entry['target_chunks']:>9} chunks: {', '.join(ratios)}")
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark suite (fake Gemini, SQLite records)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="corpus sizes in chunks")
+    parser.add_argument("--queries", type=int, default=200, help="queries sampled per size")
+    parser.add_argument("--pipeline-queries", type=int, default=50, help="queries run through rag_pipeline_async")
+    parser.add_argument("--variants", type=int, default=3, help="query variants per grouped vector search")
+    parser.add_argument("--chunks-per-document", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=2, help="documents ingested at a time")
+    parser.add_argument("--dim", type=int, default=768, help="fake embedding dimension")
+    parser.add_argument("--latency-ms", type=float, default=0, help="simulated latency of each fake Gemini call")
+    parser.add_argument("--vector-backend", choices=["chroma", "matrix"], help="overrides VECTOR_BACKEND")
+    parser.add_argument("--skip-pipeline", action="store_true", help="skip the end-to-end measurements")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep indexes and corpus here (default: a temporary directory)")
+    parser.add_argument("--json", default="benchmark_results.json", help="results file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    import fake_backends
+    gemini = fake_backends.install(dim=args.dim, latency=args.latency_ms / 1000)
+    if args.vector_backend:
+        os.environ["VECTOR_BACKEND"] = args.vector_backend
+    # Caches that would hide the measured work across queries
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+    os.environ.setdefault("LLM_MEMO_PATH", "")
+    output = Path(args.json).resolve()
+    previous = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir or tmp).resolve()
+        workdir.mkdir(parents=True, exist_ok=True)
+        # Stores use paths relative to the working directory (data/...)
+        os.chdir(workdir)
+        sys.path.insert(0, str(BACKEND_DIR))
+        from app.core.config import settings
+        print(f"🏁 Benchmark in {workdir} (vectors: {settings.VECTOR_BACKEND}, records: {settings.DATABASE_BACKEND})")
+        report = {
+            "commit": git_commit(),
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "config": {**vars(args), "vector_backend": settings.VECTOR_BACKEND},
+            "results": run(args, gemini),
+        }
+        os.chdir(BACKEND_DIR)
+
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"💾 Results written to {output}")
+    if previous:
+        compare(report, previous)
@@ -0,0 +1,74 @@
+"""
+BM25 vocabulary and index size with whitespace splitting versus the text analyzer.
+
+Chunks the documents in data/ (or another directory) like ingestion does, builds one
+BM25 index per tokenization in a temporary directory, and reports vocabulary size,
+postings, index bytes, build time and query latency.
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from app.services.bm25_index import BM25Index
+from app.services.ingestion import chunk_text
+from app.services.tokenizer import Analyzer
+
+QUERIES = [
+    "ما العلاقة بين اللغة والهوية الثقافية؟",
+    "من هو ابن الهيثم وما هي إسهاماته في علم البصريات؟",
+    "Quelles sont les offres de Hajj et Omra ?",
+    "Qu'est-ce que l'apprentissage profond ?",
+    "What is the remote work policy?",
+]
+
+def tokenizers() -> dict:
+    return {
+        "split(' ')": lambda text: text.split(" "),
+        "normalize": Analyzer(stemming=False, stop_words=False),
+        "normalize + stop words": Analyzer(stemming=False, stop_words=True),
+        "normalize + stop words + stem": Analyzer(stemming=True, stop_words=True),
+    }
+
+def run(chunks: list[str], queries: list[str]) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, tokenize) in enumerate(tokenizers().items()):
+            index = BM25Index(f"{tmp}/{i}")
+            started = time.perf_counter()
+            index.add([tokenize(chunk) for chunk in chunks], chunks, [{} for _ in chunks])
+            build_seconds = time.perf_counter() - started
+
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                index.top_k(tokenize(query), 20)
+                latencies.append(time.perf_counter() - started)
+            stats = index.stats()
+            results.append({
+                "tokenizer": name,
+                "vocabulary": stats["vocabulary"],
+                "postings": stats["postings"],
+                "bytes": stats["bytes"],
+                "build_s": build_seconds,
+                "query_ms": float(np.mean(latencies) * 1000),
+            })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BM25 tokenization comparison")
+    parser.add_argument("--data", default="data", help="directory of .txt documents")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    chunks = [chunk for path in sorted(Path(args.data).glob("*.txt"))
+              for chunk in chunk_text(path.read_text(encoding="utf-8"))]
+    print(f"📊 {len(chunks)} chunks from {args.data}, {len(QUERIES)} queries")
+    results = run(chunks, QUERIES)
+    for r in results:
+        print(f"{r['tokenizer']:<30} vocab {r['vocabulary']:7d}  postings {r['postings']:8d}  "
+              f"{r['bytes'] / 1e6:6.2f} MB  build {r['build_s']:.2f}s  query {r['query_ms']:.3f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,110 @@
+"""
+Benchmark of the in-process matrix vector index against the ChromaDB PersistentClient path.
+
+Both are built from the same vectors (the current Chroma collection, or a synthetic
+clustered corpus) and queried with groups of query variants: a Chroma call per variant,
+as retrieval used to do, versus one matrix search for the whole group.
+Reports latency per group, recall@k against exact float32 search, and bytes per chunk.
+"""
+import argparse
+import json
+import tempfile
+import time
+import numpy as np
+import chromadb
+from app.services.vector_index import MatrixVectorIndex
+
+def synthetic_corpus(count: int, dim: int, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.5 * rng.normal(size=(count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def collection_corpus() -> np.ndarray:
+    from app.services.vector_store import get_collection
+    data = get_collection().get(include=["embeddings"])
+    return np.asarray(data["embeddings"], dtype=np.float32)
+
+def query_groups(vectors: np.ndarray, groups: int, variants: int, seed: int = 1) -> np.ndarray:
+    """Noisy copies of stored vectors, shaped (groups, variants, dim)."""
+    rng = np.random.default_rng(seed)
+    base = vectors[rng.integers(0, len(vectors), groups)]
+    noise = 0.3 * rng.normal(size=(groups, variants, vectors.shape[1])).astype(np.float32) / np.sqrt(vectors.shape[1])
+    return base[:, None, :] + noise * np.linalg.norm(base, axis=1)[:, None, None]
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.argsort(-(q @ normalized.T), axis=1)[:, :k]
+
+def measure(search, groups: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    latencies = []
+    hits = 0
+    for g, group in enumerate(groups):
+        started = time.perf_counter()
+        ids = search(group)
+        latencies.append(time.perf_counter() - started)
+        for v, row_ids in enumerate(ids):
+            expected = set(truth[g * len(group) + v].tolist())
+            hits += len(expected & {int(i) for i in row_ids})
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "mean_ms": float(latencies.mean()),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        f"recall@{k}": hits / truth.size,
+    }
+
+def run(vectors: np.ndarray, groups: int, variants: int, k: int) -> list[dict]:
+    ids = [str(i) for i in range(len(vectors))]
+    documents = [""] * len(vectors)
+    metadatas = [{"row": i} for i in range(len(vectors))]
+    queries = query_groups(vectors, groups, variants)
+    truth = exact_top_k(vectors, queries.reshape(-1, vectors.shape[1]), k)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = chromadb.PersistentClient(path=f"{tmp}/chroma")
+        collection = client.create_collection(name="benchmark", metadata={"hnsw:space": "cosine"})
+        for start in range(0, len(vectors), 5000):
+            collection.add(ids=ids[start:start + 5000], documents=documents[start:start + 5000],
+                           metadatas=metadatas[start:start + 5000], embeddings=vectors[start:start + 5000].tolist())
+
+        def chroma_search(group):
+            return [collection.query(query_embeddings=[q.tolist()], n_results=k, include=[])["ids"][0] for q in group]
+
+        results.append({"backend": "chroma", "bytes_per_chunk": vectors.shape[1] * 4,
+                        **measure(chroma_search, queries, truth, k)})
+
+        for dtype in ("float16", "int8"):
+            index = MatrixVectorIndex(f"{tmp}/matrix_{dtype}", dtype=dtype)
+            index.add(ids, documents, metadatas, vectors)
+            for rescore in (False, True):
+                index.rescore = rescore
+
+                def matrix_search(group):
+                    return index.search(group, n_results=k)["ids"]
+
+                results.append({"backend": f"matrix {dtype}{' + rescore' if rescore else ''}",
+                                "bytes_per_chunk": index.memory_bytes_per_row(),
+                                **measure(matrix_search, queries, truth, k)})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Matrix vector index vs ChromaDB")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic vectors (default: current collection)")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--groups", type=int, default=50, help="query groups")
+    parser.add_argument("--variants", type=int, default=3, help="query variants per group")
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    vectors = synthetic_corpus(args.synthetic, args.dim) if args.synthetic else collection_corpus()
+    print(f"📊 {len(vectors)} vectors of dimension {vectors.shape[1]}, {args.groups} groups of {args.variants} queries")
+    results = run(vectors, args.groups, args.variants, args.k)
+    for r in results:
+        print(f"{r['backend']:<26} {r['mean_ms']:8.2f} ms  p95 {r['p95_ms']:8.2f} ms  "
+              f"recall@{args.k} {r[f'recall@{args.k}']:.3f}  {r['bytes_per_chunk']} B/chunk")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
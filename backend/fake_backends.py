@@ -0,0 +1,104 @@
+"""
+Deterministic local stand-ins for the Gemini API, for offline benchmarks and evaluation.
+
+install() must run before any app module is imported. It:
+- replaces google.generativeai's configure, embed_content and GenerativeModel with fakes;
+- stores document and chunk records in SQLite (DATABASE_BACKEND=sqlite) instead of Supabase.
+
+Fake embeddings are hashed bags of words projected to `dim` dimensions, so texts that
+share words are close and retrieval stays meaningful. The fake chat model recognizes
+the expansion and re-ranking prompts and answers them in the expected format.
+An optional fixed latency per call simulates the network round trip.
+"""
+import os
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+import numpy as np
+
+_WORD_RE = re.compile(r"[^\W_]+")
+_CHUNK_RE = re.compile(r"### Chunk (\d+):\n(.*?)(?=\n\n### Chunk |\n\n\*\*|\Z)", re.S)
+
+OFFLINE_ENV = {
+    "DATABASE_BACKEND": "sqlite",
+    "GEMINI_API_KEY": "offline",
+    "VITE_GEMINI_CHAT_MODEL": "fake-chat",
+    "VITE_GEMINI_EMBEDDING_MODEL": "fake-embedding",
+}
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall(text.casefold())
+
+def _section(prompt: str, title: str) -> str:
+    """Text between a **title** line and the next bold heading of a prompt."""
+    match = re.search(rf"\*\*{re.escape(title)}\*\*\s*\n(.*?)(?:\n\*\*|\Z)", prompt, re.S)
+    return match.group(1).strip() if match else ""
+
+class FakeGemini:
+    def __init__(self, dim: int = 768, buckets: int = 4096, latency: float = 0.0, seed: int = 0):
+        self.dim = dim
+        self.buckets = buckets
+        self.latency = latency
+        self._table = np.random.default_rng(seed).standard_normal((buckets, dim), dtype=np.float32)
+        self._lock = threading.Lock()
+        self.calls = {"embed": 0, "generate": 0}
+
+    def _call(self, kind: str):
+        with self._lock:
+            self.calls[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def embed(self, text: str) -> list[float]:
+        rows = [zlib.crc32(word.encode("utf-8")) % self.buckets for word in _words(text)] or [0]
+        vector = self._table[rows].sum(axis=0)
+        return (vector / max(float(np.linalg.norm(vector)), 1e-12)).tolist()
+
+    def embed_content(self, model: str, content, task_type: str = None, **kwargs) -> dict:
+        self._call("embed")
+        if isinstance(content, str):
+            return {"embedding": self.embed(content)}
+        return {"embedding": [self.embed(text) for text in content]}
+
+    def complete(self, prompt: str) -> str:
+        if "الصيغ البديلة" in prompt:
+            question = _section(prompt, "السؤال الأصلي:")
+            return "\n".join(f"{i}. {question} {suffix}" for i, suffix in
+                             enumerate(("بالتفصيل", "مع الأمثلة", "وأهم الجوانب"), 1))
+        if "قيّم مدى صلة" in prompt:
+            query = set(_words(_section(prompt, "السؤال:")))
+            scores = {}
+            for number, chunk in _CHUNK_RE.findall(prompt):
+                words = set(_words(chunk))
+                scores[number] = round(10 * len(query & words) / max(len(query), 1))
+            return "{" + ", ".join(f'"{n}": {s}' for n, s in scores.items()) + "}"
+        return 'إجابة تجريبية مبنية على المصادر "مقتطف" [1]\n\n**المراجع:**\n[1] المصدر الأول'
+
+    def generative_model(self, model_name: str = None, *args, **kwargs):
+        return _FakeModel(self)
+
+class _FakeModel:
+    def __init__(self, gemini: FakeGemini):
+        self._gemini = gemini
+
+    def generate_content(self, prompt: str, stream: bool = False, **kwargs):
+        self._gemini._call("generate")
+        text = self._gemini.complete(prompt)
+        usage = SimpleNamespace(prompt_token_count=len(prompt.split()), candidates_token_count=len(text.split()))
+        if not stream:
+            return SimpleNamespace(text=text, usage_metadata=usage)
+        pieces = re.findall(r"\S+\s*", text) or [text]
+        return iter([SimpleNamespace(text=piece, usage_metadata=usage) for piece in pieces])
+
+def install(dim: int = 768, latency: float = 0.0) -> FakeGemini:
+    """Routes Gemini and Supabase calls to local stand-ins; call before importing app modules."""
+    for name, value in OFFLINE_ENV.items():
+        os.environ.setdefault(name, value)
+    import google.generativeai as genai
+    gemini = FakeGemini(dim=dim, latency=latency)
+    genai.configure = lambda *args, **kwargs: None
+    genai.embed_content = gemini.embed_content
+    genai.GenerativeModel = gemini.generative_model
+    return gemini
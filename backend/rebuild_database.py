@@ -1,48 +1,182 @@
 """
 Script to rebuild the vector database with correct embeddings
+
+Files are chunked, embedded and stored in Supabase in parallel; the results are staged
+under data/rebuild/ and the ChromaDB collection and BM25 index are built once at the end.
+An interrupted rebuild continues where it stopped with --resume.
 """
+import argparse
+import hashlib
+import json
 import os
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from app.services.ingestion import process_document
-from app.services.database import get_supabase
+import numpy as np
+from app.services.ingestion import read_file_windows, iter_chunks, iter_batches, build_chunk_records
+from app.services.embedding import get_batch_embeddings, get_document_embedding_stats
+from app.services.database import clear_records, insert_document_record, insert_chunks_records, update_document_record, delete_document
+from app.core.config import settings
 
-def rebuild_database():
-    print("🔄 Starting database rebuild...")
-    
+STAGING_DIR = Path("data/rebuild")
+MANIFEST_PATH = STAGING_DIR / "manifest.json"
+CHROMA_ADD_BATCH = 5000  # Stays under Chroma's maximum batch size
+
+class Checkpoint:
+    """Per-file rebuild state, saved atomically after every change."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        if path.exists():
+            self.files = json.loads(path.read_text(encoding="utf-8"))["files"]
+
+    def update(self, name: str, **fields):
+        with self.lock:
+            self.files.setdefault(name, {}).update(fields)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps({"files": self.files}, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+
+def clear_stores():
     # 1. Delete ChromaDB
     chroma_path = Path("data/chroma_db")
     if chroma_path.exists():
         print("🗑️  Deleting old ChromaDB...")
         shutil.rmtree(chroma_path)
         print("✅ ChromaDB deleted")
-    
+
     # 2. Clear Supabase
     print("🗑️  Clearing Supabase tables...")
-    supabase = get_supabase()
     try:
-        supabase.table("chunks").delete().neq("id", "00000000-0000-0000-0000-000000000000").execute()
-        supabase.table("documents").delete().neq("id", "00000000-0000-0000-0000-000000000000").execute()
+        clear_records()
         print("✅ Supabase cleared")
     except Exception as e:
         print(f"⚠️  Supabase clear warning: {e}")
-    
+
+    if STAGING_DIR.exists():
+        shutil.rmtree(STAGING_DIR)
+
+def stage_name(name: str) -> str:
+    """Staging file name of a source file; derived from its name so that it does not change on --resume."""
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+
+def stage_file(file_path: Path, stage: str, checkpoint: Checkpoint) -> int:
+    """
+    Chunks and embeds one file, stores its Supabase rows, and stages chunks, metadata
+    and embeddings for the bulk build. Returns the number of chunks.
+    """
+    name = file_path.name
+    doc_record = insert_document_record(name, 0)
+    doc_id = doc_record['id']
+    checkpoint.update(name, status="started", document_id=doc_id, stage=stage)
+
+    total_chunks = 0
+    with open(STAGING_DIR / f"{stage}.jsonl", "w", encoding="utf-8") as records, \
+            open(STAGING_DIR / f"{stage}.f32", "wb") as vectors:
+        for chunks in iter_batches(iter_chunks(read_file_windows(str(file_path))), settings.INGEST_BATCH_SIZE):
+            embeddings = get_batch_embeddings(chunks)
+            chroma_ids, metadatas, supabase_chunks_data = build_chunk_records(doc_id, name, chunks, total_chunks)
+            insert_chunks_records(supabase_chunks_data)
+            for chroma_id, chunk, metadata in zip(chroma_ids, chunks, metadatas):
+                records.write(json.dumps({"id": chroma_id, "text": chunk, "metadata": metadata}, ensure_ascii=False) + "\n")
+            vectors.write(np.asarray(embeddings, dtype=np.float32).tobytes())
+            total_chunks += len(chunks)
+
+    update_document_record(doc_id, {"total_chunks": total_chunks})
+    checkpoint.update(name, status="staged", chunks=total_chunks)
+    return total_chunks
+
+def load_stage(stage: str):
+    with open(STAGING_DIR / f"{stage}.jsonl", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    vectors = np.fromfile(STAGING_DIR / f"{stage}.f32", dtype=np.float32)
+    return records, vectors.reshape(len(records), -1) if records else vectors
+
+def build_indexes(checkpoint: Checkpoint, names: list[str]):
+    """Builds the ChromaDB collection and the BM25 index from every staged file in one pass."""
+    from app.services.vector_store import reset_collection, add_documents_to_chroma
+    from app.services.bm25_service import bm25_service
+
+    print("\n🧱 Building ChromaDB collection and BM25 index...")
+    started = time.perf_counter()
+    reset_collection()
+    corpus = []
+    bm25_metadatas = []
+    for name in names:
+        records, vectors = load_stage(checkpoint.files[name]["stage"])
+        for start in range(0, len(records), CHROMA_ADD_BATCH):
+            batch = records[start:start + CHROMA_ADD_BATCH]
+            add_documents_to_chroma(
+                ids=[r["id"] for r in batch],
+                documents=[r["text"] for r in batch],
+                metadatas=[r["metadata"] for r in batch],
+                embeddings=vectors[start:start + CHROMA_ADD_BATCH].tolist()
+            )
+        corpus.extend(r["text"] for r in records)
+        bm25_metadatas.extend(r["metadata"] for r in records)
+    bm25_service.build_index(corpus, bm25_metadatas)
+    print(f"✅ Indexed {len(corpus)} chunks in {time.perf_counter() - started:.1f}s")
+
+def rebuild_database(resume: bool = False, workers: int = 4):
+    print("🔄 Starting database rebuild...")
+
+    if not resume:
+        clear_stores()
+    STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    checkpoint = Checkpoint(MANIFEST_PATH)
+
     # 3. Re-process all documents
     data_dir = Path("data")
-    txt_files = list(data_dir.glob("*.txt"))
-    
-    print(f"\n📚 Found {len(txt_files)} documents to process")
-    
-    for i, file_path in enumerate(txt_files, 1):
-        print(f"\n[{i}/{len(txt_files)}] Processing: {file_path.name}")
-        try:
-            result = process_document(str(file_path))
-            print(f"  ✅ Processed {result['total_chunks']} chunks")
-        except Exception as e:
-            print(f"  ❌ Error: {e}")
-    
+    txt_files = sorted(data_dir.glob("*.txt"))
+    pending = [p for p in txt_files if checkpoint.files.get(p.name, {}).get("status") != "staged"]
+
+    print(f"\n📚 Found {len(txt_files)} documents, {len(pending)} to process")
+
+    # Files interrupted mid-way: drop their partial Supabase rows before staging them again
+    for file_path in pending:
+        entry = checkpoint.files.get(file_path.name)
+        if entry and entry.get("status") == "started":
+            delete_document(entry["document_id"])
+
+    started = time.perf_counter()
+    done_chunks = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(stage_file, file_path, stage_name(file_path.name), checkpoint): file_path
+            for file_path in pending
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            file_path = futures[future]
+            try:
+                chunks = future.result()
+                done_chunks += chunks
+                elapsed = time.perf_counter() - started
+                print(f"[{i}/{len(pending)}] ✅ {file_path.name}: {chunks} chunks "
+                      f"({done_chunks / elapsed:.1f} chunks/s overall)")
+            except Exception as e:
+                print(f"[{i}/{len(pending)}] ❌ {file_path.name}: {e}")
+
+    print(f"📈 Embedding: {get_document_embedding_stats()}")
+
+    failed = [p.name for p in txt_files if checkpoint.files.get(p.name, {}).get("status") != "staged"]
+    if failed:
+        print(f"\n⚠️  {len(failed)} file(s) failed: {', '.join(failed)}")
+        print("Indexes are not built; fix the errors and run again with --resume")
+        return
+
+    build_indexes(checkpoint, [p.name for p in txt_files])
+    shutil.rmtree(STAGING_DIR)
+
     print("\n🎉 Database rebuild complete!")
     print("🔍 Test with: 'ما العلاقة بين اللغة والهوية الثقافية؟'")
 
 if __name__ == "__main__":
-    rebuild_database()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted rebuild")
+    parser.add_argument("--workers", type=int, default=4, help="files processed in parallel")
+    args = parser.parse_args()
+    rebuild_database(resume=args.resume, workers=args.workers)
@@ -1,87 +1,215 @@
-import pandas as pd
-import sys
+"""
+Evaluates the RAG pipeline on the golden dataset.
+
+Questions run concurrently (--concurrency) and start at most --rpm times per minute.
+Each result is appended to the output CSV as soon as it is ready, so an interrupted
+run continues where it stopped with --resume; questions that failed are retried.
+
+--deadline-ms runs every question under that latency budget and records the stages
+that were cut short (degraded column).
+
+--retrieval-only stops before answer generation and scores the retrieved chunks
+against the expected source file (context_file column): recall@k is the share of
+expected files among the first k chunks, MRR the mean reciprocal rank of the first
+chunk from an expected file. Rows whose context_file names no file (placeholders
+such as "All AI Files" or "Multiple Files") are not scored and are listed apart.
+"""
+import argparse
+import asyncio
+import csv
 import os
+import random
+import sys
 import time
-from app.services.rag import rag_pipeline
+from collections import defaultdict
 
 # Add project root to path
 sys.path.append(os.getcwd())
 
-def evaluate_dataset(input_file='golden_dataset_test.csv', output_file='test_results.csv'):
+from app.core.deadline import Deadline
+from app.core.executor import run_blocking
+from app.services.embedding_batcher import TokenBucket
+from app.services.rag import rag_pipeline_async, retrieve_context_async
+
+RECALL_KS = (1, 3, 5)
+MAX_RETRIES = 3
+
+ANSWER_FIELDS = ['index', 'question', 'ground_truth', 'generated_answer', 'sources',
+                 'retrieved_context', 'question_type', 'time_taken', 'degraded', 'error']
+RETRIEVAL_FIELDS = ['index', 'question', 'context_file', 'sources', 'question_type',
+                    *(f'recall@{k}' for k in RECALL_KS), 'reciprocal_rank', 'time_taken', 'degraded', 'error']
+
+def expected_files(row: dict) -> set:
+    """
+    context_file may list several files, separated by ';' or ','. Entries that are not
+    file names (placeholders like "All AI Files") cannot be matched and are left out.
+    """
+    value = row.get('context_file') or ''
+    names = (name.strip() for name in value.replace(';', ',').split(','))
+    return {name for name in names if name.lower().endswith('.txt')}
+
+def retrieval_scores(sources: list, expected: set) -> dict:
+    scores = {f'recall@{k}': len(expected & set(sources[:k])) / len(expected) for k in RECALL_KS}
+    rank = next((i for i, name in enumerate(sources, 1) if name in expected), None)
+    scores['reciprocal_rank'] = 1 / rank if rank else 0.0
+    return scores
+
+def source_names(metadatas: list) -> list:
+    return [meta.get('filename', '') if meta else '' for meta in metadatas]
+
+async def evaluate_row(index: int, row: dict, retrieval_only: bool, deadline_ms: float = None) -> dict:
+    question = row['question']
+    result = {'index': index, 'question': question, 'question_type': row.get('question_type', '')}
+    if retrieval_only:
+        result['context_file'] = row.get('context_file', '')
+    else:
+        result['ground_truth'] = row.get('ground_truth', '')
+
+    start_time = time.time()
+    for attempt in range(MAX_RETRIES):
+        deadline = Deadline(deadline_ms / 1000) if deadline_ms else None
+        try:
+            if retrieval_only:
+                documents, metadatas = await retrieve_context_async(question, deadline=deadline)
+                response = {'context': documents, 'metadatas': metadatas}
+            else:
+                response = await rag_pipeline_async(question, deadline=deadline)
+            break
+        except Exception as e:
+            if attempt == MAX_RETRIES - 1:
+                print(f"Error processing Q{index+1}: {e}")
+                result['error'] = str(e)
+                result['time_taken'] = round(time.time() - start_time, 2)
+                return result
+            print(f"  Q{index+1}: retry {attempt+1}/{MAX_RETRIES} due to error: {e}")
+            await asyncio.sleep(random.uniform(0, 2 ** (attempt + 1)))
+
+    sources = source_names(response.get('metadatas', []))
+    result['sources'] = ", ".join(sources)
+    if retrieval_only:
+        expected = expected_files(row)
+        if expected:
+            result.update({name: round(score, 4) for name, score in retrieval_scores(sources, expected).items()})
+    else:
+        result['generated_answer'] = response['answer']
+        result['retrieved_context'] = " ||| ".join(response.get('context', []))
+    if deadline is not None:
+        result['degraded'] = ", ".join(f"{stage}:{reason}" for stage, reason in deadline.degraded.items())
+    result['error'] = ''
+    result['time_taken'] = round(time.time() - start_time, 2)
+    return result
+
+def load_rows(path: str) -> list:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return list(csv.DictReader(f))
+
+def load_results(path: str) -> dict:
+    """Latest result per question index; failed questions are left out so they are retried."""
+    if not os.path.exists(path):
+        return {}
+    results = {}
+    for row in load_rows(path):
+        if row.get('error'):
+            results.pop(int(row['index']), None)
+        else:
+            results[int(row['index'])] = row
+    return results
+
+def compact_results(path: str, fields: list):
+    """Rewrites the output with one row per question, in dataset order."""
+    latest = {int(row['index']): row for row in load_rows(path)}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(latest[i] for i in sorted(latest))
+    os.replace(tmp_path, path)
+    return [latest[i] for i in sorted(latest)]
+
+def print_summary(results: list, retrieval_only: bool):
+    done = [r for r in results if not r.get('error')]
+    failed = len(results) - len(done)
+    times = [float(r['time_taken']) for r in done]
+    print(f"\n{len(done)} questions evaluated, {failed} failed"
+          + (f", {sum(times) / len(times):.2f}s per question" if times else ""))
+    if not retrieval_only:
+        return
+    scored = [r for r in done if r.get('reciprocal_rank') not in (None, '')]
+    unscored = [r for r in done if r.get('reciprocal_rank') in (None, '')]
+    groups = defaultdict(list)
+    for r in scored:
+        groups["all"].append(r)
+        groups[r.get('question_type') or "-"].append(r)
+    metrics = [f'recall@{k}' for k in RECALL_KS] + ['reciprocal_rank']
+    print(f"{'question type':<40} {'n':>3} " + " ".join(f"{m.replace('reciprocal_rank', 'MRR'):>9}" for m in metrics))
+    for name, rows in groups.items():
+        means = [sum(float(r[m]) for r in rows) / len(rows) for m in metrics]
+        print(f"{name:<40} {len(rows):>3} " + " ".join(f"{v:>9.3f}" for v in means))
+    if unscored:
+        print(f"\n{len(unscored)} question(s) not scored, context_file names no file:")
+        for r in unscored:
+            print(f"  Q{int(r['index']) + 1}: {r.get('context_file') or '(empty)'}")
+
+async def evaluate_dataset_async(input_file: str = 'golden_dataset_test.csv', output_file: str = None,
+                                 retrieval_only: bool = False, concurrency: int = 4, rpm: float = 0,
+                                 resume: bool = False, limit: int = None, deadline_ms: float = None):
+    output_file = output_file or ('retrieval_results.csv' if retrieval_only else 'test_results.csv')
+    fields = RETRIEVAL_FIELDS if retrieval_only else ANSWER_FIELDS
     print(f"Loading dataset from {input_file}...")
     try:
-        df = pd.read_csv(input_file)
+        rows = load_rows(input_file)[:limit]
     except FileNotFoundError:
         print(f"Error: File {input_file} not found.")
         return
 
-    results = []
-    
-    print(f"Starting evaluation of {len(df)} questions...")
-    
-    for index, row in df.iterrows():
-        question = row['question']
-        ground_truth = row['ground_truth']
-        question_type = row['question_type']
-        
-        print(f"\nProcessing Q{index+1}/{len(df)}: {question}")
-        
-        start_time = time.time()
-        try:
-            # Add a simple retry mechanism
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = rag_pipeline(question)
-                    break
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise e
-                    print(f"  Retry {attempt+1}/{max_retries} due to error: {e}")
-                    time.sleep(2)
-            
-            generated_answer = response['answer']
-            
-            # Extract source titles if available
-            sources = []
-            if 'metadatas' in response:
-                for meta in response['metadatas']:
-                    if meta and 'filename' in meta:
-                        sources.append(meta['filename'])
-            
-            sources_str = ", ".join(sources)
-
-            # Extract retrieved context text
-            retrieved_contexts = response.get('context', [])
-            contexts_str = " ||| ".join(retrieved_contexts)
-            
-        except Exception as e:
-            print(f"Error processing question: {e}")
-            generated_answer = f"ERROR: {str(e)}"
-            sources_str = ""
-            contexts_str = ""
-            
-        elapsed_time = time.time() - start_time
-        
-        results.append({
-            'question': question,
-            'ground_truth': ground_truth,
-            'generated_answer': generated_answer,
-            'sources': sources_str,
-            'retrieved_context': contexts_str,
-            'question_type': question_type,
-            'time_taken': round(elapsed_time, 2)
-        })
-        
-        # Optional: Add a small delay to avoid hitting rate limits too hard
-        time.sleep(1)
-
-    # Create results DataFrame
-    results_df = pd.DataFrame(results)
-    
-    # Save to CSV
-    results_df.to_csv(output_file, index=False, encoding='utf-8-sig')
+    if not resume and os.path.exists(output_file):
+        os.remove(output_file)
+    done = load_results(output_file)
+    pending = [(i, row) for i, row in enumerate(rows) if i not in done]
+    print(f"Starting evaluation of {len(pending)} questions"
+          + (f" ({len(done)} already done)" if done else "") + "...")
+
+    new_file = not os.path.exists(output_file)
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(rpm / 60)
+    finished = 0
+
+    with open(output_file, 'a', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+
+        async def run(index: int, row: dict):
+            nonlocal finished
+            async with semaphore:
+                await run_blocking(bucket.acquire)
+                result = await evaluate_row(index, row, retrieval_only, deadline_ms)
+            # Written from the event loop only, one complete row at a time
+            writer.writerow(result)
+            f.flush()
+            finished += 1
+            status = "ERROR" if result['error'] else f"{result['time_taken']}s"
+            print(f"[{finished}/{len(pending)}] Q{index+1} {status}: {row['question'][:60]}")
+
+        await asyncio.gather(*(run(i, row) for i, row in pending))
+
+    results = compact_results(output_file, fields)
     print(f"\nEvaluation complete. Results saved to {output_file}")
+    print_summary(results, retrieval_only)
+
+def evaluate_dataset(input_file: str = 'golden_dataset_test.csv', output_file: str = None, **options):
+    asyncio.run(evaluate_dataset_async(input_file, output_file, **options))
 
 if __name__ == "__main__":
-    evaluate_dataset()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="golden_dataset_test.csv", help="golden dataset CSV")
+    parser.add_argument("--output", help="results CSV (default: test_results.csv, or retrieval_results.csv)")
+    parser.add_argument("--retrieval-only", action="store_true", help="skip generation, report recall@k and MRR")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions evaluated in parallel")
+    parser.add_argument("--rpm", type=float, default=0, help="questions started per minute (0: unlimited)")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run")
+    parser.add_argument("--limit", type=int, help="evaluate only the first N questions")
+    parser.add_argument("--deadline-ms", type=float, help="latency budget of each question")
+    args = parser.parse_args()
+    evaluate_dataset(args.input, args.output, retrieval_only=args.retrieval_only, concurrency=args.concurrency,
+                     rpm=args.rpm, resume=args.resume, limit=args.limit, deadline_ms=args.deadline_ms)
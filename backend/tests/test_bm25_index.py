@@ -0,0 +1,212 @@
+import math
+import multiprocessing
+import random
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from app.services.bm25_index import MERGE_FACTOR, BM25Index, Segment, _value_ranges
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa", "common"]
+
+
+def make_chunks(rng: random.Random, document_ids: list, chunks_per_document: int):
+    tokens, texts, metadatas = [], [], []
+    for doc_id in document_ids:
+        for i in range(chunks_per_document):
+            words = [rng.choice(WORDS[:-1]) for _ in range(rng.randint(3, 12))]
+            tokens.append(words)
+            texts.append(" ".join(words))
+            metadatas.append({"document_id": doc_id, "chunk_index": i, "filename": f"doc{doc_id}.txt"})
+    return tokens, texts, metadatas
+
+
+def wait_for_merges(index: BM25Index, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while index._merging or index._pick_merge():
+        assert time.monotonic() < deadline, "background merges did not finish"
+        time.sleep(0.01)
+
+
+def post_filtered(index: BM25Index, query: list, k: int, filters: dict) -> list:
+    hits = index.top_k(query, index.num_docs)
+    matching = [
+        (seg, i, score) for seg, i, score in hits
+        if all(str(seg.metadata(i).get(field)) in {str(v) for v in values} for field, values in filters.items())
+    ]
+    return matching[:k]
+
+
+def as_keys(hits: list) -> list:
+    return [(seg.name, i, round(score, 9)) for seg, i, score in hits]
+
+
+def test_scoped_search_with_term_outside_scope(tmp_path):
+    # One segment holding several documents, as rebuild_database writes it;
+    # "common" only occurs outside the filtered document, and enough chunks
+    # match to reach the pruning phase of top_k
+    tokens = [["alpha", "beta"]] * 30 + [["common", "gamma"]] * 30 + [["beta", "delta"]] * 40
+    metadatas = [{"document_id": 2}] * 30 + [{"document_id": 3}] * 30 + [{"document_id": 4}] * 40
+    index = BM25Index(str(tmp_path))
+    index.add(tokens, [" ".join(t) for t in tokens], metadatas)
+    filters = {"document_id": [2]}
+    hits = index.top_k(["alpha", "common"], 20, filters=filters)
+    assert as_keys(hits) == as_keys(post_filtered(index, ["alpha", "common"], 20, filters))
+    assert len(hits) == 20
+    assert {seg.metadata(i)["document_id"] for seg, i, _ in hits} == {2}
+
+
+def test_scoped_search_matches_post_filtering(tmp_path):
+    rng = random.Random(7)
+    index = BM25Index(str(tmp_path))
+    next_document = 0
+    for _ in range(12):
+        count = rng.randint(1, 4)
+        index.add(*make_chunks(rng, list(range(next_document, next_document + count)), rng.randint(1, 6)))
+        next_document += count
+    # Rare terms that only occur in a few documents exercise empty scoped posting lists
+    index.add([["common", "alpha"]] * 3, ["x", "y", "z"], [{"document_id": 0, "filename": "doc0.txt"}] * 3)
+    wait_for_merges(index)
+
+    for _ in range(300):
+        query = [rng.choice(WORDS) for _ in range(rng.randint(1, 4))]
+        field = rng.choice(["document_id", "filename"])
+        documents = rng.sample(range(next_document), rng.randint(1, 3))
+        values = documents if field == "document_id" else [f"doc{d}.txt" for d in documents]
+        filters = {field: values}
+        k = rng.choice([1, 3, 5, 20])
+        assert as_keys(index.top_k(query, k, filters=filters)) == as_keys(post_filtered(index, query, k, filters))
+
+
+def test_filter_ranges_are_stored_in_segments(tmp_path):
+    rng = random.Random(1)
+    index = BM25Index(str(tmp_path))
+    for start in range(0, MERGE_FACTOR * 3, 3):
+        index.add(*make_chunks(rng, [start, start + 1, start + 2], 4))
+    wait_for_merges(index)
+    for seg in index.segments:
+        assert seg._filter_ranges is not None
+        reopened = Segment(seg.path)
+        expected = _value_ranges([seg.metadata(i) for i in range(seg.num_docs)])
+        assert reopened.value_ranges() == expected
+
+
+def test_equal_adds_keep_logarithmic_segments(tmp_path):
+    rng = random.Random(3)
+    index = BM25Index(str(tmp_path))
+    adds = 300
+    for n in range(adds):
+        index.add(*make_chunks(rng, [n], 10))
+    wait_for_merges(index)
+    tiers = math.ceil(math.log(index.num_docs, MERGE_FACTOR)) + 1
+    assert len(index.segments) <= (MERGE_FACTOR - 1) * tiers
+    assert sum(seg.num_docs for seg in index.segments) == adds * 10
+    # Merges keep the corpus order
+    documents = [seg.metadata(i)["document_id"] for seg in index.segments for i in range(seg.num_docs)]
+    assert documents == sorted(documents)
+
+
+def _writer(directory: str, worker: int, adds: int):
+    index = BM25Index(directory)
+    if index.exists():
+        index.load()
+    for n in range(adds):
+        index.add([["w", f"t{worker}"]], [f"{worker}-{n}"], [{"document_id": worker * 1000 + n}])
+    wait_for_merges(index)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_writer_processes_keep_every_chunk(tmp_path):
+    context = multiprocessing.get_context("fork")
+    workers, adds = 3, 20
+    processes = [context.Process(target=_writer, args=(str(tmp_path), w, adds)) for w in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(60)
+        assert p.exitcode == 0
+
+    index = BM25Index(str(tmp_path))
+    index.load()
+    texts = sorted(seg.text(i) for seg in index.segments for i in range(seg.num_docs))
+    assert texts == sorted(f"{w}-{n}" for w in range(workers) for n in range(adds))
+    assert index.num_docs == workers * adds
+    assert index.generation == workers * adds
+    assert index.df_hist == {workers * adds: 1, adds: workers}
+
+
+def test_rebuild_never_publishes_an_empty_index(tmp_path, monkeypatch):
+    rng = random.Random(9)
+    index = BM25Index(str(tmp_path))
+    index.add(*make_chunks(rng, [0, 1], 3))
+    published = []
+    save_manifest = index._save_manifest
+    def recording_save():
+        published.append([seg.name for seg in index.segments])
+        save_manifest()
+    monkeypatch.setattr(index, "_save_manifest", recording_save)
+
+    tokens, texts, metadatas = make_chunks(rng, [2, 3, 4], 5)
+    index.rebuild(tokens, texts, metadatas)
+    assert published and all(published)
+    assert index.num_docs == len(texts)
+    expected = Counter(len({i for i, words in enumerate(tokens) if term in words}) for term in {w for words in tokens for w in words})
+    assert index.df_hist == expected
+
+
+def test_deleted_documents_are_left_out_of_searches(tmp_path):
+    rng = random.Random(13)
+    index = BM25Index(str(tmp_path))
+    for start in range(0, 12, 3):
+        index.add(*make_chunks(rng, [start, start + 1, start + 2], 4))
+    generation = index.generation
+    index.delete_documents([4, 7])
+    assert index.generation == generation + 1
+
+    reopened = BM25Index(str(tmp_path))
+    reopened.load()
+    kept = [d for d in range(12) if d not in (4, 7)]
+    searched = 0
+    for _ in range(50):
+        query = [rng.choice(WORDS[:-1]) for _ in range(rng.randint(1, 3))]
+        hits = reopened.top_k(query, 10)
+        searched += bool(hits)
+        assert {seg.metadata(i)["document_id"] for seg, i, _ in hits}.isdisjoint({4, 7})
+        # Same ranking as a search restricted to the other documents
+        assert as_keys(hits) == as_keys(reopened.top_k(query, 10, filters={"document_id": kept}))
+        assert reopened.top_k(query, 10, filters={"document_id": [4]}) == []
+    assert searched
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_top_k_matches_bm25okapi(tmp_path, seed):
+    rank_bm25 = pytest.importorskip("rank_bm25")
+    rng = random.Random(seed)
+    index = BM25Index(str(tmp_path))
+    corpus, metadatas = [], []
+    for document in range(rng.randint(8, 20)):
+        tokens, _, metas = make_chunks(rng, [document], rng.randint(1, 8))
+        # Rare terms give the query lists of very different lengths
+        tokens = [words + [f"rare{rng.randint(0, 30)}"] * rng.randint(0, 2) for words in tokens]
+        index.add(tokens, [" ".join(words) for words in tokens], metas)
+        corpus.extend(tokens)
+        metadatas.extend(metas)
+    wait_for_merges(index)
+    assert len(index.segments) > 1
+    okapi = rank_bm25.BM25Okapi(corpus)
+    positions = {(seg.name, i): base + i for seg, base in zip(index.segments, np.cumsum([0] + [s.num_docs for s in index.segments]))
+                 for i in range(seg.num_docs)}
+
+    for _ in range(40):
+        query = [rng.choice(WORDS[:-1] + [f"rare{n}" for n in range(30)]) for _ in range(rng.randint(1, 4))]
+        k = rng.choice([1, 5, 10, 50])
+        filters = rng.choice([None, {"document_id": rng.sample(range(len(set(m["document_id"] for m in metadatas))), 3)}])
+        scores = okapi.get_scores(query)
+        matching = [i for i in range(len(corpus))
+                    if filters is None or metadatas[i]["document_id"] in filters["document_id"]]
+        expected = sorted((i for i in matching if scores[i] > 0), key=lambda i: -scores[i])[:k]
+        hits = index.top_k(query, k, filters=filters)
+        assert [positions[(seg.name, i)] for seg, i, _ in hits] == expected
+        assert [score for _, _, score in hits] == pytest.approx([scores[i] for i in expected])
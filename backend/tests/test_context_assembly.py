@@ -0,0 +1,126 @@
+from app.services.context_assembly import (
+    MIN_OVERLAP,
+    MIN_PASSAGE_TOKENS,
+    assemble,
+    estimate_tokens,
+    merge_chunks,
+    overlap_length,
+    truncate_to_tokens,
+)
+
+
+def words(prefix: str, n: int) -> str:
+    # One token per word: up to 4 letters or digits
+    return " ".join(f"{prefix}{i:03d}" for i in range(n))
+
+
+def chunk(text: str, document_id: str, chunk_index: int) -> dict:
+    return {"text": text, "metadata": {"document_id": document_id, "filename": f"{document_id}.pdf", "chunk_index": chunk_index}}
+
+
+def ranked(*chunks):
+    return [c["text"] for c in chunks], [c["metadata"] for c in chunks]
+
+
+def test_overlap_length_finds_the_repeated_span():
+    shared = "the shared span between chunks"
+    assert overlap_length("head text, " + shared, shared + ", tail text") == len(shared)
+    # The longest suffix of head that starts tail wins
+    assert overlap_length("xxxxx" + "ab" * 20, "ab" * 20 + "yz" * 15) == 40
+
+
+def test_overlap_length_ignores_short_or_missing_overlaps():
+    short = "s" * (MIN_OVERLAP - 1)
+    assert overlap_length("head " + short, short + " tail") == 0
+    assert overlap_length(words("a", 20), words("b", 20)) == 0
+    assert overlap_length("", words("a", 20)) == 0
+
+
+def test_overlapping_chunks_are_merged_without_the_repeated_span():
+    text = words("w", 60)
+    first, second, third = text[0:100], text[70:170], text[140:240]
+    documents, metadatas = ranked(chunk(second, "d", 1), chunk(third, "d", 2), chunk(first, "d", 0))
+    passages = merge_chunks(documents, metadatas)
+    assert len(passages) == 1
+    assert passages[0].text == text[0:240]
+    assert passages[0].chunk_indices == [0, 1, 2]
+    assert passages[0].rank == 0
+
+
+def test_adjacent_chunks_are_merged_and_distant_ones_kept_apart():
+    documents, metadatas = ranked(
+        chunk(words("a", 30), "d", 3),
+        chunk(words("b", 30), "d", 4),
+        chunk(words("c", 30), "d", 9),
+    )
+    texts, metas = assemble(documents, metadatas)
+    assert texts == [words("a", 30) + "\n\n" + words("b", 30), words("c", 30)]
+    assert metas[0]["chunk_indices"] == [3, 4]
+    assert "chunk_indices" not in metas[1]
+    # The input metadata is left untouched
+    assert "chunk_indices" not in metadatas[0]
+
+
+def test_chunks_of_different_documents_are_not_merged():
+    documents, metadatas = ranked(chunk(words("a", 30), "d", 0), chunk(words("b", 30), "e", 1))
+    assert assemble(documents, metadatas)[0] == documents
+
+
+def test_sources_are_renumbered_by_their_best_chunk():
+    text = words("w", 60)
+    documents, metadatas = ranked(
+        chunk(words("b", 30), "e", 0),
+        chunk(text[70:170], "d", 1),
+        chunk(words("c", 30), "f", 0),
+        chunk(text[0:100], "d", 0),
+    )
+    texts, metas = assemble(documents, metadatas)
+    # Four chunks become three sources; the merged one keeps the rank of its best chunk
+    assert texts == [words("b", 30), text[0:170], words("c", 30)]
+    assert [m["document_id"] for m in metas] == ["e", "d", "f"]
+    assert metas[1]["chunk_indices"] == [0, 1]
+
+
+def test_contained_passages_are_dropped_across_documents():
+    passage = words("a", 40)
+    documents, metadatas = ranked(
+        chunk(passage[20:120], "copy", 0),
+        chunk(words("b", 30), "e", 0),
+        chunk(passage, "d", 0),
+    )
+    texts, metas = assemble(documents, metadatas)
+    # The full passage replaces the excerpt and takes its rank
+    assert texts == [passage, words("b", 30)]
+    assert [m["document_id"] for m in metas] == ["d", "e"]
+
+
+def test_truncate_to_tokens_cuts_at_a_sentence_end_or_space():
+    assert truncate_to_tokens("one two six. ten red big cat ran far", 6) == "one two six."
+    assert truncate_to_tokens("aa bb cc dd ee ff", 4) == "aa bb cc …"
+    assert truncate_to_tokens("aa bb cc", 10) == "aa bb cc"
+    assert truncate_to_tokens("aa bb cc", 0) == ""
+
+
+def test_assemble_truncates_the_last_passage_to_the_budget():
+    documents, metadatas = ranked(chunk(words("a", 100), "d", 0), chunk(words("b", 100), "e", 0))
+    texts, _ = assemble(documents, metadatas, token_budget=180)
+    assert texts[0] == words("a", 100)
+    assert texts[1].startswith("b000") and texts[1].endswith("…")
+    assert estimate_tokens(texts[1]) <= 80
+    assert sum(estimate_tokens(t) for t in texts) <= 180
+
+
+def test_assemble_stops_when_too_little_budget_is_left():
+    documents, metadatas = ranked(chunk(words("a", 100), "d", 0), chunk(words("b", 100), "e", 0))
+    texts, metas = assemble(documents, metadatas, token_budget=100 + MIN_PASSAGE_TOKENS - 1)
+    assert texts == [words("a", 100)]
+    assert len(metas) == 1
+    # The first passage is always kept, cut to the budget if needed
+    texts, _ = assemble(documents, metadatas, token_budget=10)
+    assert len(texts) == 1 and estimate_tokens(texts[0]) <= 10
+
+
+def test_assemble_without_budget_keeps_everything():
+    documents, metadatas = ranked(chunk(words("a", 100), "d", 0), chunk(words("b", 100), "e", 0))
+    assert assemble(documents, metadatas, token_budget=None)[0] == documents
+    assert assemble(documents, metadatas, token_budget=0)[0] == documents
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from app.core.deadline import Deadline, DeadlineExceeded, from_milliseconds, within
+from app.core.metrics import FALLBACKS
+from app.services import rag
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def fallbacks(stage: str) -> float:
+    return FALLBACKS._snapshot().get((stage,), 0)
+
+
+def test_remaining_shrinks_with_time_and_share():
+    clock = FakeClock()
+    deadline = Deadline(2.0, clock=clock)
+    assert deadline.remaining() == pytest.approx(2.0)
+    assert deadline.remaining(0.25) == pytest.approx(0.5)
+    clock.now += 1.0
+    assert deadline.remaining() == pytest.approx(1.0)
+    # A spent share is 0, never negative
+    assert deadline.remaining(0.25) == 0.0
+
+
+def test_degrade_records_each_stage_once():
+    deadline = Deadline(1.0)
+    before = fallbacks("rerank")
+    deadline.degrade("rerank", "timeout")
+    deadline.degrade("rerank", "skipped")
+    assert deadline.degraded == {"rerank": "skipped"}
+    assert fallbacks("rerank") == before + 1
+
+
+def test_from_milliseconds():
+    assert from_milliseconds(1500).seconds == 1.5
+    assert from_milliseconds(None, default_seconds=3).seconds == 3
+    assert from_milliseconds(None) is None
+    with pytest.raises(ValueError):
+        from_milliseconds(0)
+
+
+def test_within_raises_deadline_exceeded_once_the_share_is_spent():
+    async def slow():
+        await asyncio.sleep(10)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(within(slow(), Deadline(0.05)))
+    # Only the share counts: 1% of 5 seconds
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(within(slow(), Deadline(5.0), share=0.01))
+
+
+def test_within_returns_the_result_in_time():
+    async def fast():
+        return "done"
+
+    assert asyncio.run(within(fast(), Deadline(1.0))) == "done"
+    assert asyncio.run(within(fast(), None)) == "done"
+
+
+def test_within_reraises_a_timeout_of_the_awaited_call():
+    async def timing_out():
+        raise asyncio.TimeoutError()
+
+    with pytest.raises(asyncio.TimeoutError) as error:
+        asyncio.run(within(timing_out(), Deadline(10.0)))
+    assert not isinstance(error.value, DeadlineExceeded)
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """rag_pipeline_async with retrieval, the answer cache and generation replaced."""
+    calls = {"put": 0, "generation_delay": 0.0}
+
+    async def cached_answer(query, filters=None, deadline=None):
+        return None, 0, None
+
+    async def retrieve(query, filters=None, deadline=None):
+        return ["Le premier passage. La suite du texte."], [{"filename": "a.pdf", "document_id": "a", "chunk_index": 0}]
+
+    async def generate(query, context, metadatas):
+        await asyncio.sleep(calls["generation_delay"])
+        return "generated [1]"
+
+    def put(*args, **kwargs):
+        calls["put"] += 1
+
+    monkeypatch.setattr(rag, "_cached_answer", cached_answer)
+    monkeypatch.setattr(rag, "retrieve_context_async", retrieve)
+    monkeypatch.setattr(rag, "generate_answer_async", generate)
+    monkeypatch.setattr(rag.answer_cache, "put", put)
+    return calls
+
+
+def test_pipeline_response_lists_degraded_stages(pipeline):
+    pipeline["generation_delay"] = 10
+    result = asyncio.run(rag.rag_pipeline_async("Quel est le premier passage ?", deadline=Deadline(0.1)))
+    assert result["degraded"] == {"generation": "timeout"}
+    # The extractive fallback quotes and cites the best source
+    assert result["answer"].startswith('"Le premier passage.')
+    assert "[1]" in result["answer"]
+    # Degraded answers are not cached
+    assert pipeline["put"] == 0
+
+
+def test_pipeline_response_in_time_is_not_degraded(pipeline):
+    result = asyncio.run(rag.rag_pipeline_async("Quel est le premier passage ?", deadline=Deadline(5.0)))
+    assert result["degraded"] == {}
+    assert result["answer"] == "generated [1]"
+    assert pipeline["put"] == 1
+    result = asyncio.run(rag.rag_pipeline_async("Quel est le premier passage ?"))
+    assert "degraded" not in result
@@ -0,0 +1,143 @@
+import threading
+
+import pytest
+
+from app.services.embedding_batcher import EmbeddingBatcher, TokenBucket
+
+
+class FakeEmbedder:
+    """Local stand-in for the embedding API: one vector per text, encoding the text itself."""
+
+    def __init__(self, failures: int = 0, error: type = ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self._lock:
+            self.batches.append(list(batch))
+            if self.failures:
+                self.failures -= 1
+                raise self.error("transient")
+        return [[float(text.split("-")[1].rstrip(".")), float(len(text))] for text in batch]
+
+
+def texts(n: int, size: int = 10):
+    return [f"t-{i}".ljust(size, ".") for i in range(n)]
+
+
+def test_batches_respect_item_limit():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=4, max_batch_chars=10 ** 6, sleep=lambda s: None)
+    assert batcher.split(texts(10)) == [(0, 4), (4, 8), (8, 10)]
+    batcher.embed(texts(10))
+    assert sorted(len(batch) for batch in embedder.batches) == [2, 4, 4]
+
+
+def test_batches_respect_character_limit():
+    batcher = EmbeddingBatcher(FakeEmbedder(), max_batch_size=100, max_batch_chars=25, sleep=lambda s: None)
+    assert batcher.split(texts(5, size=10)) == [(0, 2), (2, 4), (4, 5)]
+    # A text longer than the limit goes alone instead of being dropped
+    assert batcher.split(["a" * 30, "b" * 5, "c" * 30]) == [(0, 1), (1, 2), (2, 3)]
+    assert batcher.split([]) == []
+
+
+def test_output_keeps_input_order_across_workers():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=3, workers=4, sleep=lambda s: None)
+    inputs = texts(50)
+    vectors = batcher.embed(inputs)
+    assert [int(v[0]) for v in vectors] == list(range(50))
+    assert len(embedder.batches) == 17
+    assert batcher.stats()["chunks"] == 50
+
+
+def test_transient_errors_are_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr("app.services.embedding_batcher.random.uniform", lambda low, high: high)
+    sleeps = []
+    embedder = FakeEmbedder(failures=3)
+    batcher = EmbeddingBatcher(embedder, max_retries=5, base_delay=1.0, max_delay=3.0, sleep=sleeps.append)
+    vectors = batcher.embed(texts(2))
+    assert [int(v[0]) for v in vectors] == [0, 1]
+    # Exponential backoff, capped at max_delay
+    assert sleeps == [1.0, 2.0, 3.0]
+    assert batcher.stats()["retries"] == 3
+    assert batcher.stats()["requests"] == 4
+
+
+def test_retries_give_up_after_max_retries():
+    embedder = FakeEmbedder(failures=10)
+    batcher = EmbeddingBatcher(embedder, max_retries=2, sleep=lambda s: None)
+    with pytest.raises(ConnectionError):
+        batcher.embed(texts(2))
+    assert len(embedder.batches) == 3
+
+
+def test_errors_outside_retry_on_are_not_retried():
+    embedder = FakeEmbedder(failures=1, error=KeyError)
+    batcher = EmbeddingBatcher(embedder, retry_on=(ConnectionError,), sleep=lambda s: None)
+    with pytest.raises(KeyError):
+        batcher.embed(texts(2))
+    assert len(embedder.batches) == 1
+
+
+def test_wrong_vector_count_is_an_error():
+    batcher = EmbeddingBatcher(lambda batch: [[0.0]], max_retries=0, sleep=lambda s: None)
+    with pytest.raises(ValueError, match="Expected 2 embeddings"):
+        batcher.embed(texts(2))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_throttles_to_its_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    for _ in range(10):
+        bucket.acquire()
+    # The first two tokens are the burst capacity, the next eight come at 2 per second
+    assert clock.now == pytest.approx(4.0)
+    assert clock.sleeps[0] == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_while_idle():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 10
+    for _ in range(3):
+        bucket.acquire()
+    # Refill is capped at the capacity: no wait for three, but the fourth waits
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_token_bucket_with_zero_rate_never_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=0, clock=clock, sleep=clock.sleep)
+    for _ in range(100):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+
+def test_batcher_requests_take_bucket_tokens():
+    clock = FakeClock()
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=1, workers=1, sleep=clock.sleep)
+    batcher._bucket = TokenBucket(4, capacity=1, clock=clock, sleep=clock.sleep)
+    batcher.embed(texts(6))
+    # One request right away, then one every 1/4 s
+    assert clock.now == pytest.approx(1.25)
@@ -0,0 +1,119 @@
+import asyncio
+import random
+from pathlib import Path
+
+import pytest
+
+from app.services import database, ingestion, vector_store
+from app.services.bm25_index import BM25Index
+from app.services.ingestion import CHUNK_SIZE, MAX_PARAGRAPH, chunk_text, iter_chunks
+from app.services.vector_index import MatrixVectorIndex
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+WINDOW_SIZES = [1, 7, 100, CHUNK_SIZE, 700, 1000, 10000]
+
+
+def windows(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def synthetic_texts():
+    rng = random.Random(5)
+    words = ["نص", "عربي", "word", "phrase.", "longer-token", "x" * 40]
+    def paragraph(n):
+        lines = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 12))) for _ in range(rng.randint(1, n))]
+        return "\n".join(lines)
+    return [
+        # Short paragraphs merged into chunks, and paragraphs longer than a chunk
+        "\n\n".join(paragraph(rng.choice([1, 3, 40])) for _ in range(60)),
+        # Runs of blank lines, which the window boundary can cut
+        "\n\n\n\n".join(paragraph(2) for _ in range(30)) + "\n\n",
+        # No paragraph break at all
+        "\n".join(paragraph(3) for _ in range(40)),
+        "a" * (CHUNK_SIZE * 3),
+        "\n\n" + "b " * 2000,
+        "",
+    ]
+
+
+@pytest.mark.parametrize("size", WINDOW_SIZES)
+def test_iter_chunks_matches_chunk_text_on_data_files(size):
+    files = sorted(DATA_DIR.glob("*.txt"))
+    if not files:
+        pytest.skip("no documents in data/")
+    for path in files:
+        text = path.read_text(encoding="utf-8")
+        assert list(iter_chunks(windows(text, size))) == chunk_text(text), path.name
+
+
+@pytest.mark.parametrize("size", WINDOW_SIZES)
+def test_iter_chunks_matches_chunk_text_on_edge_cases(size):
+    for text in synthetic_texts():
+        assert list(iter_chunks(windows(text, size))) == chunk_text(text)
+
+
+@pytest.mark.parametrize("separator", ["\n", " "])
+def test_iter_chunks_bounds_memory_without_paragraph_breaks(separator):
+    rng = random.Random(11)
+    text = separator.join(" ".join(rng.choice(["كلمة", "word", "phrase."]) for _ in range(rng.randint(1, 20)))
+                          for _ in range(MAX_PARAGRAPH // 20))
+    assert len(text) > 3 * MAX_PARAGRAPH and "\n\n" not in text
+    size = 1000
+    consumed = 0
+    def counted_windows():
+        nonlocal consumed
+        for window in windows(text, size):
+            consumed += 1
+            yield window
+
+    chunks = iter_chunks(counted_windows())
+    first = next(chunks)
+    # Chunks come out once MAX_PARAGRAPH characters are buffered, not at the end of the file
+    assert consumed * size <= MAX_PARAGRAPH + size
+    position = 0
+    for chunk in [first, *chunks]:
+        assert len(chunk) <= CHUNK_SIZE
+        # In document order; consecutive chunks may overlap
+        found = text.find(chunk, max(0, position - CHUNK_SIZE))
+        assert found >= 0
+        position = found + len(chunk)
+    assert position >= len(text.rstrip()) - 1
+
+
+def test_failed_ingestion_removes_the_stored_batches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    from app.services.bm25_service import bm25_service
+    monkeypatch.setattr(bm25_service, "index", BM25Index(str(tmp_path / "bm25")))
+    monkeypatch.setattr(database, "_backend", database.SQLiteBackend(str(tmp_path / "records.sqlite3")))
+    monkeypatch.setattr(vector_store.settings, "VECTOR_BACKEND", "matrix")
+    monkeypatch.setattr(vector_store, "_matrix_index", MatrixVectorIndex(str(tmp_path / "vectors")))
+    monkeypatch.setattr(ingestion.settings, "INGEST_BATCH_SIZE", 2)
+
+    batches = 0
+    async def flaky_embeddings(chunks):
+        nonlocal batches
+        batches += 1
+        if batches == 4:
+            raise RuntimeError("embedding API down")
+        return [[float(len(chunk)), 1.0, float(i)] for i, chunk in enumerate(chunks)]
+    monkeypatch.setattr(ingestion, "get_batch_embeddings_async", flaky_embeddings)
+
+    kept = tmp_path / "kept.txt"
+    kept.write_text("kept paragraph " + "word " * 50, encoding="utf-8")
+    failing = tmp_path / "failing.txt"
+    failing.write_text("\n\n".join(f"failing paragraph {i} " + "word " * 150 for i in range(8)), encoding="utf-8")
+
+    kept_result = asyncio.run(ingestion.process_document_async(str(kept)))
+    # The third batch of this document fails, after two were stored
+    with pytest.raises(RuntimeError, match="embedding API down"):
+        asyncio.run(ingestion.process_document_async(str(failing)))
+
+    assert batches == 4 and bm25_service.index.num_docs > kept_result["total_chunks"]
+    kept_id = kept_result["document_id"]
+    assert [doc["id"] for doc in database.list_documents()] == [kept_id]
+    chunk_rows = database.get_backend()._conn().execute("SELECT DISTINCT document_id FROM chunk").fetchall()
+    assert [row[0] for row in chunk_rows] == [kept_id]
+    hits = bm25_service.search("kept failing", top_k=50)
+    assert hits and {meta["document_id"] for _, _, meta in hits} == {kept_id}
+    vectors = vector_store.query_chroma([1.0, 1.0, 0.0], n_results=50)
+    assert {meta["document_id"] for meta in vectors["metadatas"][0]} == {kept_id}
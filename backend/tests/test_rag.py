@@ -0,0 +1,44 @@
+import asyncio
+import sys
+import threading
+import types
+
+import pytest
+
+from app.services import query_expansion, rag
+
+
+def test_failed_expansion_does_not_leave_searches_running(monkeypatch):
+    release = threading.Event()
+    searches = {}
+
+    def bm25_search(query, top_k=20, filters=None):
+        release.wait(5)
+        return []
+
+    async def vector_search(query, filters=None):
+        searches["vector"] = "started"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            searches["vector"] = "cancelled"
+            raise
+
+    async def failing_expansion(query):
+        await asyncio.sleep(0)
+        raise RuntimeError("expansion failed")
+
+    monkeypatch.setitem(sys.modules, "app.services.bm25_service",
+                        types.SimpleNamespace(bm25_service=types.SimpleNamespace(search=bm25_search)))
+    monkeypatch.setattr(rag, "vector_search_async", vector_search)
+    monkeypatch.setattr(query_expansion, "expand_query_async", failing_expansion)
+
+    async def retrieve():
+        with pytest.raises(RuntimeError):
+            await rag.retrieve_context_async("short query")
+        return dict(searches)
+
+    try:
+        assert asyncio.run(retrieve()) == {"vector": "cancelled"}
+    finally:
+        release.set()
@@ -0,0 +1,62 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from app.services.vector_index import MatrixVectorIndex
+
+DIM = 16
+
+
+def vector(worker: int, n: int) -> list:
+    rng = np.random.default_rng(worker * 1000 + n)
+    return rng.standard_normal(DIM).tolist()
+
+
+def _writer(directory: str, worker: int, adds: int):
+    index = MatrixVectorIndex(directory)
+    for n in range(adds):
+        index.add([f"{worker}-{n}"], [f"text {worker}-{n}"], [{"document_id": worker}], [vector(worker, n)])
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_writer_processes_keep_every_row(tmp_path):
+    context = multiprocessing.get_context("fork")
+    workers, adds = 3, 15
+    processes = [context.Process(target=_writer, args=(str(tmp_path), w, adds)) for w in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(60)
+        assert p.exitcode == 0
+
+    index = MatrixVectorIndex(str(tmp_path), rescore=True)
+    assert len(index) == workers * adds
+    for w in range(workers):
+        for n in range(adds):
+            # Every row's exact vector, text and id still belong together
+            hit = index.search([vector(w, n)], n_results=1)
+            assert hit["ids"] == [[f"{w}-{n}"]]
+            assert hit["documents"] == [[f"text {w}-{n}"]]
+            assert hit["distances"][0][0] == pytest.approx(0, abs=1e-5)
+    filtered = index.search([vector(1, 0)], n_results=adds * workers, filters={"document_id": [1]})
+    assert sorted(filtered["ids"][0]) == sorted(f"1-{n}" for n in range(adds))
+
+
+def test_deleted_rows_are_left_out_of_searches(tmp_path):
+    index = MatrixVectorIndex(str(tmp_path))
+    for w in range(3):
+        index.add([f"{w}-{n}" for n in range(5)], [f"text {w}-{n}" for n in range(5)],
+                  [{"document_id": w} for _ in range(5)], [vector(w, n) for n in range(5)])
+    index.delete({"document_id": [1]})
+
+    reopened = MatrixVectorIndex(str(tmp_path))
+    assert len(reopened) == 10
+    hits = reopened.search([vector(1, 2), vector(0, 0)], n_results=15)
+    for ids in hits["ids"]:
+        assert sorted(ids) == sorted(f"{w}-{n}" for w in (0, 2) for n in range(5))
+    assert reopened.search([vector(1, 2)], n_results=5, filters={"document_id": [1]})["ids"] == [[]]
+    # Appends after a deletion keep the deleted rows out
+    reopened.add(["3-0"], ["text 3-0"], [{"document_id": 3}], [vector(3, 0)])
+    assert reopened.search([vector(3, 0)], n_results=1)["ids"] == [["3-0"]]
+    assert len(reopened) == 11
@@ -161,6 +161,10 @@ function addMessage(content, isUser = false) {
     renderMessageToUI(content, isUser);
 
     // 2. Save to State
+    saveMessage(content, isUser);
+}
+
+function saveMessage(content, isUser) {
     ensureCurrentConversation();
     conversations[currentConversationId].messages.push({ content, isUser });
 
@@ -189,7 +193,7 @@ async function sendMessage() {
     chatMessages.appendChild(loadingDiv);
 
     try {
-        const response = await fetch(`${API_URL}/query`, {
+        const response = await fetch(`${API_URL}/query/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -197,20 +201,60 @@ async function sendMessage() {
             body: JSON.stringify({ query: text }),
         });
 
-        chatMessages.removeChild(loadingDiv);
+        if (!response.ok || !response.body) throw new Error('Erreur réseau');
+
+        // The answer is rendered token by token as soon as retrieval is done
+        let answer = '';
+        let answerContent = null;
+        await readEventStream(response, (event, data) => {
+            if (event === 'token') {
+                if (!answerContent) {
+                    chatMessages.removeChild(loadingDiv);
+                    renderMessageToUI('', false);
+                    answerContent = chatMessages.lastElementChild.querySelector('.message-content');
+                }
+                answer += data.text;
+                answerContent.innerHTML = answer.replace(/\n/g, '<br>');
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            } else if (event === 'error') {
+                throw new Error(data.detail);
+            }
+        });
 
-        if (!response.ok) throw new Error('Erreur réseau');
-
-        const data = await response.json();
-        addMessage(data.answer);
+        if (!answerContent) throw new Error('Réponse vide');
+        saveMessage(answer, false);
 
     } catch (error) {
-        chatMessages.removeChild(loadingDiv);
+        if (loadingDiv.parentNode) chatMessages.removeChild(loadingDiv);
         addMessage("Désolé, une erreur est survenue. Veuillez vérifier que le backend est lancé. / عذراً، حدث خطأ. يرجى التأكد من تشغيل الخادم.", false);
         console.error(error);
     }
 }
 
+// Minimal Server-Sent Events reader for a fetch() response (EventSource cannot POST)
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            onEvent(event, data ? JSON.parse(data) : {});
+        }
+    }
+}
+
 sendBtn.addEventListener('click', sendMessage);
 userInput.addEventListener('keypress', (e) => {
     if (e.key === 'Enter' && !e.shiftKey) {
@@ -265,12 +309,18 @@ async function handleFiles(e) {
                 body: formData
             });
 
-            if (response.ok) {
-                uploadStatus.innerHTML = `<span style="color: var(--success-color)"><i class="fa-solid fa-check"></i> ${file.name} téléchargé avec succès!</span>`;
-                loadDocuments(); // Refresh list
-            } else {
-                throw new Error('Upload failed');
-            }
+            if (!response.ok) throw new Error('Upload failed');
+
+            // Ingestion runs in the background: follow the job until it is done
+            const { job_id } = await response.json();
+            const job = await waitForJob(job_id, (progress) => {
+                const percent = progress && progress.fraction !== undefined ? ` ${Math.round(progress.fraction * 100)}%` : '';
+                uploadStatus.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> Traitement de ${file.name}...${percent}`;
+            });
+            if (job.status !== 'done') throw new Error(job.error || 'Processing failed');
+
+            uploadStatus.innerHTML = `<span style="color: var(--success-color)"><i class="fa-solid fa-check"></i> ${file.name} téléchargé avec succès!</span>`;
+            loadDocuments(); // Refresh list
         } catch (error) {
             uploadStatus.innerHTML = `<span style="color: var(--error-color)"><i class="fa-solid fa-xmark"></i> Erreur lors du téléchargement de ${file.name}</span>`;
         }
@@ -282,6 +332,17 @@ async function handleFiles(e) {
     }, 3000);
 }
 
+async function waitForJob(jobId, onProgress) {
+    while (true) {
+        const response = await fetch(`${API_URL}/jobs/${jobId}`);
+        if (!response.ok) throw new Error('Job status unavailable');
+        const job = await response.json();
+        if (job.status === 'done' || job.status === 'failed') return job;
+        onProgress(job.progress);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 // Load Documents
 async function loadDocuments() {
     try {